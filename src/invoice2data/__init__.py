@@ -1 +1 @@
-from .main import extract_data  # noqa: F401
+from .main import extract_data, Extractor, ExtractionResult  # noqa: F401
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+File operations done next to extraction instead of in between.
+
+Copying or moving processed files and storing results can take as long as
+the extraction itself on network mounts. `BackgroundIO` runs them in a
+thread, so the next file is extracted meanwhile. Jobs run one after the
+other in submission order, so all operations of a file happen in the order
+they were submitted. The queue is bounded: `submit` blocks when the I/O
+falls behind instead of piling up results in memory.
+"""
+
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundIO(object):
+    """
+    Thread running submitted jobs in order.
+
+    Parameters
+    ----------
+    max_pending : int
+        Number of jobs waiting before `submit` blocks
+    """
+
+    def __init__(self, max_pending=100):
+        self.queue = queue.Queue(max_pending)
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, name="invoice2data-io")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                name, func, args = job
+                try:
+                    func(*args)
+                except Exception as ex:
+                    logger.error("I/O for %s failed: %s", name, ex)
+                    self.errors.append((name, ex))
+            finally:
+                self.queue.task_done()
+
+    def submit(self, name, func, *args):
+        """Queue func(*args), `name` identifies the job in errors"""
+        if not self.thread.is_alive():
+            raise RuntimeError("background I/O is closed")
+        self.queue.put((name, func, args))
+
+    def flush(self):
+        """Wait until all submitted jobs are done"""
+        self.queue.join()
+
+    def close(self):
+        """Run remaining jobs, stop the thread and return the errors"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        return self.errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Detect duplicate bills before running OCR.
+
+The same bill is sometimes delivered several times under different file
+names. `DuplicateIndex` remembers the extraction result of recently seen
+files, keyed by content hash and, optionally, by a perceptual image hash
+(difference hash computed with Pillow). A perceptual hash also catches
+re-encoded or resized copies of the same image. As bills of one issuer
+often look alike, perceptual matches are only made between files with the
+same tid and should use a low `max_distance`.
+
+The index keeps at most `max_size` entries, dropping the oldest first.
+"""
+
+import copy
+import logging
+from collections import OrderedDict
+
+from .utils import file_hash
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".gif")
+
+
+def image_hash(path, hash_size=16):
+    """Return difference hash of an image as int of hash_size * hash_size bits"""
+    from PIL import Image
+
+    with Image.open(path) as img:
+        # Lets JPEG decode at reduced size, no-op for other formats
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        pixels = list(img.convert("L").resize((hash_size + 1, hash_size)).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+class Fingerprint(object):
+    """Hashes identifying one input file"""
+
+    __slots__ = ("content_hash", "image_hash", "tid")
+
+    def __init__(self, content_hash, image_hash=None, tid=None):
+        self.content_hash = content_hash
+        self.image_hash = image_hash
+        self.tid = tid
+
+
+class DuplicateIndex(object):
+    """
+    Bounded index of recent extraction results.
+
+    Parameters
+    ----------
+    max_size : int
+        Number of results kept
+    perceptual : bool
+        Also match images by perceptual hash
+    max_distance : int
+        Maximum number of differing bits for a perceptual match
+    hash_size : int
+        Side of the perceptual hash grid
+    """
+
+    def __init__(self, max_size=10000, perceptual=False, max_distance=0, hash_size=16):
+        self.max_size = max_size
+        self.perceptual = perceptual
+        self.max_distance = max_distance
+        self.hash_size = hash_size
+        self.entries = OrderedDict()
+
+    def fingerprint(self, path, tid=None, content_hash=None):
+        """Hash a file. Pass content_hash if it's already known."""
+        if content_hash is None:
+            content_hash = file_hash(path)
+        phash = None
+        if self.perceptual and path.lower().endswith(IMAGE_EXTENSIONS):
+            try:
+                phash = image_hash(path, self.hash_size)
+            except (IOError, OSError) as e:
+                logger.warning("Can't compute image hash of %s: %s", path, e)
+        return Fingerprint(content_hash, phash, tid)
+
+    def find(self, fingerprint):
+        """Return copy of the result of an earlier duplicate, or None"""
+        entry = self.entries.get(fingerprint.content_hash)
+        if entry is None and fingerprint.image_hash is not None:
+            for key in reversed(self.entries):
+                other, result = self.entries[key]
+                if other.image_hash is None or other.tid != fingerprint.tid:
+                    continue
+                if bin(other.image_hash ^ fingerprint.image_hash).count("1") <= self.max_distance:
+                    entry = (other, result)
+                    break
+        if entry is None:
+            return None
+        self.entries.move_to_end(entry[0].content_hash)
+        # Output modules may modify results, don't share them
+        return copy.deepcopy(entry[1])
+
+    def add(self, fingerprint, result):
+        """Remember result of a processed file"""
+        self.entries[fingerprint.content_hash] = (fingerprint, result)
+        self.entries.move_to_end(fingerprint.content_hash)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
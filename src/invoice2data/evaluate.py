@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluate accuracy and speed of templates on a corpus of invoices.
+
+Every input reader and OCR config given is run on all files, using a pool
+of threads sharing one `Extractor` per run. Results are compared with
+ground truth where available: `<name>.json` next to `<name>.png` (or in
+`--truth`), in the format written by `--output-format json`.
+
+Reported per run and tid (the template name if files have no tid): field
+accuracy, line item reconciliation (missed, corrected, qty mismatches),
+files per second and latency percentiles per stage.
+
+Usage::
+
+    invoice2data evaluate --input-reader png --input-reader tesseract4 \\
+        --ocr-config "tesseract+--psm+6" --tid-pattern "^_(\\d+)_" bills/
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from .extract.loader import load_templates
+from .utils import iter_files
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return None
+    index = max(0, int(math.ceil(p / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def load_truth(path, truth_folder=None):
+    """Expected fields of an input file, None without ground truth"""
+    name = os.path.splitext(os.path.basename(path))[0] + ".json"
+    truth_path = os.path.join(truth_folder or os.path.dirname(path), name)
+    if not os.path.exists(truth_path):
+        return None
+    with open(truth_path) as json_file:
+        truth = json.load(json_file)
+    # Output files of `--output-format json` are lists
+    if isinstance(truth, list):
+        truth = truth[0] if truth else {}
+    return truth
+
+
+def field_matches(expected, actual):
+    """Compare an extracted value with its JSON ground truth"""
+    if actual is None:
+        return expected is None
+    if isinstance(actual, (datetime.date, datetime.datetime)):
+        return actual.strftime("%Y-%m-%d") == str(expected)[:10]
+    if isinstance(actual, (int, float)) and not isinstance(actual, bool):
+        try:
+            return abs(float(expected) - actual) < 0.005
+        except (TypeError, ValueError):
+            return False
+    if isinstance(actual, list):
+        if not isinstance(expected, list) or len(expected) != len(actual):
+            return False
+        return all(field_matches(e, a) for e, a in zip(expected, actual))
+    if isinstance(actual, dict):
+        return isinstance(expected, dict) and all(field_matches(v, actual.get(k)) for k, v in expected.items())
+    return str(expected).strip() == str(actual).strip()
+
+
+class RunStats(object):
+    """Results of one run for files of one tid"""
+
+    def __init__(self):
+        self.files = 0
+        self.extracted = 0
+        self.failed = 0
+        self.no_template = 0
+        self.reconciled = 0
+        self.missed = 0
+        self.corrected = 0
+        self.issue_lines = 0
+        self.qty_mismatches = 0
+        self.with_truth = 0
+        self.exact = 0
+        self.fields = defaultdict(lambda: [0, 0])
+        self.latencies = defaultdict(list)
+
+    def add(self, result, truth, seconds):
+        self.files += 1
+        self.latencies["total"].append(seconds)
+        for stage, stage_seconds in result.timings.items():
+            self.latencies[stage].append(stage_seconds)
+        if result.error is not None:
+            self.failed += 1
+        elif result.template is None:
+            self.no_template += 1
+        elif result.output:
+            self.extracted += 1
+            self.missed += max(result.missed, 0)
+            self.corrected += max(result.corrected, 0)
+            self.issue_lines += len(result.issue_lines)
+            self.qty_mismatches += int(result.qtyerr == "NoMatch")
+            if result.missed in (0, -1) and not result.issue_lines and result.qtyerr != "NoMatch":
+                self.reconciled += 1
+        if truth is None:
+            return
+        self.with_truth += 1
+        output = result.output or {}
+        all_match = True
+        for field, expected in truth.items():
+            match = field_matches(expected, output.get(field))
+            all_match = all_match and match
+            self.fields[field][0] += int(match)
+            self.fields[field][1] += 1
+        self.exact += int(all_match)
+
+    def report(self):
+        report = OrderedDict()
+        for name in ("files", "extracted", "failed", "no_template", "reconciled", "missed", "corrected",
+                     "issue_lines", "qty_mismatches", "with_truth", "exact"):
+            report[name] = getattr(self, name)
+        report["field_accuracy"] = OrderedDict(
+            (field, correct / float(total)) for field, (correct, total) in sorted(self.fields.items())
+        )
+        report["latency"] = OrderedDict()
+        for stage, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            report["latency"][stage] = OrderedDict(("p%d" % p, percentile(values, p)) for p in PERCENTILES)
+        return report
+
+
+class Evaluation(object):
+    """
+    Runs an `Extractor` per input reader and OCR config on a corpus.
+
+    Parameters
+    ----------
+    templates : list of InvoiceTemplate
+    readers : list of str
+        keys of `input_mapping`
+    ocr_configs : list of sequence of str, optional
+        tesseract commands, used instead of the templates' own; None for
+        the templates' settings
+    workers : int, optional
+        threads extracting files of a run, default: number of CPUs
+    truth_folder : str, optional
+        folder of the ground truth JSON files, default: next to the inputs
+    """
+
+    def __init__(self, templates, readers, ocr_configs=None, workers=None, truth_folder=None):
+        self.templates = templates
+        self.readers = readers
+        self.ocr_configs = ocr_configs or [None]
+        self.workers = workers or os.cpu_count() or 1
+        self.truth_folder = truth_folder
+
+    def runs(self):
+        """(name, reader, ocr config) of all combinations"""
+        for reader in self.readers:
+            for config in self.ocr_configs:
+                name = reader if config is None else "%s %s" % (reader, " ".join(config))
+                yield name, reader, config
+
+    def _evaluate_file(self, extractor, path, tid):
+        started = time.perf_counter()
+        result = extractor.extract(path, tid)
+        return result, time.perf_counter() - started
+
+    def evaluate(self, files):
+        """Run all combinations on files, a list of (path, tid)
+
+        Returns the report as dict
+        """
+        from .main import Extractor
+
+        truths = [load_truth(path, self.truth_folder) for path, tid in files]
+        report = OrderedDict()
+        for name, reader, config in self.runs():
+            extractor = Extractor(self.templates, reader, config, force_commands=config is not None)
+            stats = defaultdict(RunStats)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [pool.submit(self._evaluate_file, extractor, path, tid) for path, tid in files]
+                for (path, tid), truth, future in zip(files, truths, futures):
+                    result, seconds = future.result()
+                    stats[tid or result.template_name or "-"].add(result, truth, seconds)
+            wall = time.perf_counter() - started
+            logger.info("%s: %d files in %.1fs", name, len(files), wall)
+            report[name] = OrderedDict(
+                [
+                    ("reader", reader),
+                    ("ocr_config", list(config) if config is not None else None),
+                    ("seconds", wall),
+                    ("files_per_second", len(files) / wall if wall else None),
+                    ("tids", OrderedDict((tid, stats[tid].report()) for tid in sorted(stats))),
+                ]
+            )
+        return report
+
+
+def _ms(seconds):
+    return "%8.0fms" % (seconds * 1000) if seconds is not None else "%10s" % "-"
+
+
+def format_report(report):
+    """Render report as plain text"""
+    lines = []
+    for name, run in report.items():
+        lines.append("%s: %.2f files/s" % (name, run["files_per_second"] or 0))
+        for tid, stats in run["tids"].items():
+            lines.append(
+                "  %s: %d files, %d extracted, %d failed, %d without template, %d reconciled, "
+                "missed %d, corrected %d, qty mismatches %d"
+                % (tid, stats["files"], stats["extracted"], stats["failed"], stats["no_template"],
+                   stats["reconciled"], stats["missed"], stats["corrected"], stats["qty_mismatches"])
+            )
+            if stats["with_truth"]:
+                lines.append("    exact: %d of %d" % (stats["exact"], stats["with_truth"]))
+                for field, accuracy in stats["field_accuracy"].items():
+                    lines.append("    %5.1f%%  %s" % (accuracy * 100, field))
+            for stage, values in stats["latency"].items():
+                lines.append("    %-8s " % stage + " ".join("%s %s" % (p, _ms(v)) for p, v in values.items()))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def create_parser():
+    """Returns argument parser"""
+    parser = argparse.ArgumentParser(
+        prog="invoice2data evaluate",
+        description="Compare accuracy and speed of input readers and OCR configs on a folder of invoices.",
+    )
+    parser.add_argument(
+        "--template-folder",
+        "-t",
+        dest="template_folder",
+        help="Folder containing invoice templates in yml file. Always adds built-in templates.",
+    )
+    parser.add_argument(
+        "--exclude-built-in-templates",
+        dest="exclude_built_in_templates",
+        default=False,
+        help="Ignore built-in templates.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--input-reader",
+        dest="readers",
+        action="append",
+        help="Input reader to evaluate, repeat to compare readers. Default: png",
+    )
+    parser.add_argument(
+        "--ocr-config",
+        dest="ocr_configs",
+        action="append",
+        help="Tesseract command separated by +, used instead of the templates' settings. "
+        "Repeat to compare configs. Default: the templates' settings",
+    )
+    parser.add_argument("--tid", dest="tid", help="Use template with this tid for all files.")
+    parser.add_argument(
+        "--tid-pattern",
+        dest="tid_pattern",
+        help="Regex on the file name, group 1 is the tid of the file. Files not matching are skipped.",
+    )
+    parser.add_argument(
+        "--extension",
+        dest="extensions",
+        action="append",
+        help="Extension of files when walking folders, can be repeated. Default: all files",
+    )
+    parser.add_argument("--truth", dest="truth_folder", help="Folder of ground truth JSON files. Default: next to "
+                        "the inputs")
+    parser.add_argument("--workers", type=int, help="Files extracted in parallel. Default: number of CPUs")
+    parser.add_argument("--json", dest="json_file", help="Also write the full report to this JSON file.")
+    parser.add_argument("--debug", action="store_true", help="Enable debug information.")
+    parser.add_argument("input_files", nargs="+", help="Files, folders or glob patterns of invoices.")
+    return parser
+
+
+def select_files(paths, extensions=None, tid=None, tid_pattern=None):
+    """List of (path, tid) to evaluate"""
+    pattern = re.compile(tid_pattern) if tid_pattern else None
+    files = []
+    for path in iter_files(paths, extensions):
+        if os.path.splitext(path)[1].lower() == ".json":
+            # Ground truth
+            continue
+        file_tid = tid
+        if pattern is not None:
+            match = pattern.search(os.path.basename(path))
+            if not match:
+                continue
+            if match.groups():
+                file_tid = match.group(1)
+        files.append((path, file_tid))
+    return files
+
+
+def run(argv=None):
+    """Run `invoice2data evaluate`, return its report"""
+    args = create_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.ERROR)
+
+    templates = load_templates(args.template_folder, not args.exclude_built_in_templates)
+    ocr_configs = [config.split("+") for config in args.ocr_configs] if args.ocr_configs else None
+    evaluation = Evaluation(templates, args.readers or ["png"], ocr_configs, args.workers, args.truth_folder)
+    files = select_files(args.input_files, args.extensions, args.tid, args.tid_pattern)
+
+    report = evaluation.evaluate(files)
+    print(format_report(report))
+    if args.json_file:
+        with open(args.json_file, "w") as json_file:
+            json.dump(report, json_file, indent=4)
+    return report
+
+
+def main(argv=None):
+    """Entry point of `invoice2data evaluate`"""
+    run(argv)
@@ -0,0 +1,157 @@
+# SPDX-License-Identifier: MIT
+
+"""
+Columnar representation of line items.
+
+By default the `lines` parser returns a list of dicts, one per row. With
+the template option `columnar_lines` (or `columnar: true` in the parser
+settings) it returns a `LineColumns` instead: one list per field, float
+columns stored as `array('d')`. Iterating or indexing it yields `LineRow`
+views that read and write the columns in place, so code written for
+lists of dicts keeps working. `to_dicts()` converts to the old format.
+"""
+
+from array import array
+from collections import OrderedDict
+
+
+class _Missing(object):
+    """Marks a field absent from a row"""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+
+class LineRow(object):
+    """Dict-like view of one row of a `LineColumns`"""
+
+    __slots__ = ("_lines", "_index")
+
+    def __init__(self, lines, index):
+        self._lines = lines
+        self._index = index
+
+    def __getitem__(self, name):
+        column = self._lines.columns.get(name)
+        if column is None or column[self._index] is MISSING:
+            raise KeyError(name)
+        return column[self._index]
+
+    def __setitem__(self, name, value):
+        self._lines.set_value(self._index, name, value)
+
+    def __contains__(self, name):
+        column = self._lines.columns.get(name)
+        return column is not None and column[self._index] is not MISSING
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def keys(self):
+        return [name for name in self._lines.columns if name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class LineColumns(object):
+    """Line items stored as one array per field"""
+
+    __slots__ = ("columns", "length")
+
+    def __init__(self, columns=None, length=0):
+        self.columns = columns if columns is not None else OrderedDict()
+        self.length = length
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build from a list of row dicts"""
+        columns = OrderedDict()
+        for index, row in enumerate(rows):
+            for name, value in row.items():
+                if name not in columns:
+                    columns[name] = [MISSING] * len(rows)
+                columns[name][index] = value
+        return cls(columns, len(rows))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("line index out of range")
+        return LineRow(self, index)
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield LineRow(self, index)
+
+    def __eq__(self, other):
+        if isinstance(other, LineColumns):
+            other = other.to_dicts()
+        return self.to_dicts() == other
+
+    def __repr__(self):
+        return repr(self.to_dicts())
+
+    def column(self, name):
+        """Values of a field, `MISSING` where a row doesn't have it"""
+        return self.columns[name]
+
+    def set_column(self, name, values):
+        """Replace a column, float columns without gaps become `array('d')`"""
+        if all(type(v) is float for v in values):
+            values = array("d", values)
+        self.columns[name] = values
+
+    def set_value(self, index, name, value):
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = [MISSING] * self.length
+        elif isinstance(column, array) and type(value) is not float:
+            column = self.columns[name] = list(column)
+        column[index] = value
+
+    def coerce(self, name, convert):
+        """Convert present values of a column with `convert(list) -> list`"""
+        column = self.columns[name]
+        indexes = [i for i, v in enumerate(column) if v is not MISSING]
+        if len(indexes) == self.length:
+            self.set_column(name, convert(list(column)))
+            return
+        column = list(column)
+        for i, value in zip(indexes, convert([column[i] for i in indexes])):
+            column[i] = value
+        self.columns[name] = column
+
+    def iter_dicts(self):
+        """Yield rows as plain dicts"""
+        names = list(self.columns.items())
+        for index in range(self.length):
+            yield dict((name, column[index]) for name, column in names if column[index] is not MISSING)
+
+    def to_dicts(self):
+        """Rows as list of dicts, the default `lines` format"""
+        return list(self.iter_dicts())
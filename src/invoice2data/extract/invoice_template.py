@@ -5,11 +5,17 @@ Templates are initially read from .yml files and then kept as class.
 """
 
 import re
+import time
+from decimal import Decimal
 import dateparser
 from unidecode import unidecode
 import logging
 from collections import OrderedDict
+from contextlib import contextmanager
 from . import parsers
+from . import regex_engine
+from .numbers import NumberParser
+from .ocr_profile import OCRProfile
 from .plugins import lines, tables
 
 logger = logging.getLogger(__name__)
@@ -23,9 +29,23 @@ OPTIONS_DEFAULT = {
     "languages": [],
     "decimal_separator": ".",
     "replace": [],  # example: see templates/fr/fr.free.mobile.yml
+    "regex_engine": None,  # one of regex_engine.ENGINE_MAPPING, None = global default
+    "regex_timeout": None,
+    "columnar_lines": False,  # lines parser returns columns.LineColumns
+    "header_region": None,  # part of the image holding the keywords, see header_region
+    "ocr_alternatives": [],  # extra OCR configs (psm, imgcmd) raced against the template's own
+    "reocr_lines": False,  # OCR line items again that don't reconcile, see main.reocr_lines
+    "reocr_whitelist": "0123456789.,",
+    "reocr_scale": 3,
 }
 
-PARSERS_MAPPING = {"lines": parsers.lines, "regex": parsers.regex, "static": parsers.static}
+PARSERS_MAPPING = {
+    "boxes": parsers.boxes,
+    "fixed_width": parsers.fixed_width,
+    "lines": parsers.lines,
+    "regex": parsers.regex,
+    "static": parsers.static,
+}
 
 PLUGIN_MAPPING = {"lines": lines, "tables": tables}
 
@@ -40,13 +60,23 @@ class InvoiceTemplate(OrderedDict):
         Input raw string and do transformations, as set in template file.
     matches_input(optimized_str)
         See if string matches keywords set in template file
+    matches_tid(tid)
+        See if tid is listed in the template `tid` option
+    needs_layout()
+        See if extraction needs word boxes besides the text
     parse_number(value)
         Parse number, remove decimal separator and add other options
     parse_date(value)
         Parses date and returns date after parsing
     coerce_type(value, target_type)
         change type of values
-    extract(optimized_str)
+    coerce_types(values, target_type)
+        change type of a list of values at once
+    iter_patterns()
+        Yield all regexes used by the template
+    check_regex_engine(engine=None)
+        Report patterns the regex engine can't handle
+    extract(optimized_str, timings=None)
         Given a template file and a string, extract matching data fields.
     """
 
@@ -55,6 +85,7 @@ class InvoiceTemplate(OrderedDict):
 
         # Merge template-specific options with defaults
         self.options = OPTIONS_DEFAULT.copy()
+        self._engine = None
 
         for lang in self.options["languages"]:
             assert len(lang) == 2, "lang code must have 2 letters"
@@ -62,10 +93,94 @@ class InvoiceTemplate(OrderedDict):
         if "options" in self:
             self.options.update(self["options"])
 
+        self.number_parser = NumberParser(self.options["decimal_separator"])
+        self.header_region = self._parse_region(self.options["header_region"])
+        # OCR commands of the template, then of each of its ocr_alternatives
+        self.ocr_profile = OCRProfile.from_options(self.options)
+        self.ocr_profiles = [self.ocr_profile] + [
+            OCRProfile.from_options(dict(self.options, **alternative))
+            for alternative in self.options["ocr_alternatives"]
+        ]
+
         # Set issuer, if it doesn't exist.
         if "issuer" not in self.keys():
             self["issuer"] = self["keywords"][0]
 
+    @staticmethod
+    def _parse_region(region):
+        """
+        Region as (left, top, right, bottom) fractions of the image.
+
+        A single number is the top part of the image, e.g. 0.2 = top 20%.
+        """
+        if region is None:
+            return None
+        if isinstance(region, (int, float)):
+            region = (0.0, 0.0, 1.0, float(region))
+        assert len(region) == 4, "header_region must be a fraction or [left, top, right, bottom]"
+        region = tuple(float(v) for v in region)
+        assert all(0 <= v <= 1 for v in region), "header_region values must be between 0 and 1"
+        return region
+
+    @property
+    def engine(self):
+        """Regex engine used by parsers and plugins for this template"""
+        if self._engine is not None:
+            return self._engine
+        return regex_engine.get_engine(self.options["regex_engine"], self.options["regex_timeout"])
+
+    @engine.setter
+    def engine(self, engine):
+        """Override engine, e.g. to instrument it. None restores the configured one."""
+        self._engine = engine
+
+    @contextmanager
+    def wrapped_engine(self, wrap):
+        """Use `wrap(engine)` as engine within the context, then the engine used before"""
+        previous = self._engine
+        self._engine = wrap(self.engine)
+        try:
+            yield self._engine
+        finally:
+            self._engine = previous
+
+    def iter_patterns(self):
+        """Yield all regexes used by fields, lines and tables of the template"""
+        regex_keys = ("regex", "start", "end", "line", "first_line", "last_line", "line_separator")
+        for k, v in self.get("fields", {}).items():
+            if isinstance(v, dict):
+                for key in regex_keys:
+                    if key in v:
+                        for pattern in v[key] if isinstance(v[key], list) else [v[key]]:
+                            yield pattern
+            elif not k.startswith("static_"):
+                for pattern in v if isinstance(v, list) else [v]:
+                    yield pattern
+        if "lines" in self:
+            for key in regex_keys:
+                if key in self["lines"]:
+                    yield self["lines"][key]
+        for table in self.get("tables", []):
+            for key in ("start", "end", "body", "line_separator"):
+                if key in table:
+                    yield table[key]
+
+    def check_regex_engine(self, engine=None):
+        """Return dict of pattern -> reasons for patterns the engine can't handle
+
+        `engine` is an engine name, defaults to the one configured for the template.
+        """
+        if engine is None:
+            engine = self.engine
+        else:
+            engine = regex_engine.get_engine(engine)
+        result = OrderedDict()
+        for pattern in self.iter_patterns():
+            reasons = engine.unsupported(pattern)
+            if reasons:
+                result[pattern] = reasons
+        return result
+
     def prepare_input(self, extracted_str):
         """
         Input raw string and do transformations, as set in template file.
@@ -99,25 +214,13 @@ class InvoiceTemplate(OrderedDict):
             logger.debug("Matched template %s", self["template_name"])
             return True
 
+    def matches_tid(self, tid):
+        """See if tid is listed in the template `tid` option"""
+        return tid is not None and any(str(t) == str(tid) for t in self.options.get("tid", []))
+
     def parse_number(self, value):
-        assert (
-            value.count(self.options["decimal_separator"]) < 3
-        ), "Decimal separator cannot be present several times"
-        # Remove any leading spaces
-        value = value.lstrip()
-        last_comma_index = value.rfind(self.options["decimal_separator"])
-        # replace decimal separator by a |
-        amount_pipe = value[:last_comma_index] + "|" + value[last_comma_index+1:]
-        #amount_pipe = value.replace(self.options["decimal_separator"], "|")
-        # remove all possible thousands separators
-        amount_pipe_no_thousand_sep = re.sub(r"[^0-9| ]", "", amount_pipe)
-        logger.debug("amount is "+ str(amount_pipe_no_thousand_sep))
-
-        if " " in amount_pipe_no_thousand_sep:
-            # remove values before space
-            amount_pipe_no_thousand_sep = amount_pipe_no_thousand_sep.split(" ")[1]
-        # put dot as decimal sep
-        return float(amount_pipe_no_thousand_sep.replace("|", "."))
+        """Parse number using the template decimal separator, see `NumberParser`"""
+        return self.number_parser.parse(value)
 
     def parse_date(self, value):
         """Parses date and returns date after parsing"""
@@ -138,13 +241,37 @@ class InvoiceTemplate(OrderedDict):
             if not value.strip():
                 return 0.0
             return float(self.parse_number(value))
+        elif target_type == "decimal":
+            if not value.strip():
+                return Decimal(0)
+            return self.number_parser.parse(value, decimal=True)
         elif target_type == "date":
             return self.parse_date(value)
         assert False, "Unknown type"
 
-    def extract(self, optimized_str):
+    def coerce_types(self, values, target_type):
+        """Same as `coerce_type` for a whole column of values"""
+        if target_type == "float":
+            return self.number_parser.parse_many(values)
+        elif target_type == "decimal":
+            return self.number_parser.parse_many(values, decimal=True, default=Decimal(0))
+        elif target_type == "int":
+            return [int(v) for v in self.number_parser.parse_many(values, default=0)]
+        return [self.coerce_type(v, target_type) for v in values]
+
+    def needs_layout(self):
+        """True if extraction uses word boxes (`boxes` parser, `reocr_lines`)"""
+        if self.options["reocr_lines"]:
+            return True
+        return any(isinstance(v, dict) and v.get("parser") == "boxes" for v in self["fields"].values())
+
+    def extract(self, optimized_str, timings=None, layout=None):
         """
         Given a template file and a string, extract matching data fields.
+
+        If `timings` is a list, a `(kind, name, parser, seconds)` tuple is
+        appended for every field ("field") and plugin ("plugin") run.
+        Parsers working on word boxes get `layout`, see `needs_layout`.
         """
 
         logger.debug("START optimized_str ========================")
@@ -166,11 +293,21 @@ class InvoiceTemplate(OrderedDict):
         output["issuer"] = self["issuer"]
 
         for k, v in self["fields"].items():
+            started = time.perf_counter()
+            field_name = k
+            if isinstance(v, dict):
+                parser_name = v.get("parser")
+            else:
+                parser_name = "static" if k.startswith("static_") else "regex"
+
             if isinstance(v, dict):
                 if "parser" in v:
                     if v["parser"] in PARSERS_MAPPING:
                         parser = PARSERS_MAPPING[v["parser"]]
-                        value = parser.parse(self, v, optimized_str)
+                        if getattr(parser, "NEEDS_LAYOUT", False):
+                            value = parser.parse(self, v, layout)
+                        else:
+                            value = parser.parse(self, v, optimized_str)
                         if value is not None:
                             output[k] = value
                         else:
@@ -203,12 +340,18 @@ class InvoiceTemplate(OrderedDict):
                 else:
                     output[k] = result
 
+            if timings is not None:
+                timings.append(("field", field_name, parser_name, time.perf_counter() - started))
+
         output["currency"] = self.options["currency"]
 
         # Run plugins:
         for plugin_keyword, plugin_func in PLUGIN_MAPPING.items():
             if plugin_keyword in self.keys():
+                started = time.perf_counter()
                 plugin_func.extract(self, optimized_str, output)
+                if timings is not None:
+                    timings.append(("plugin", plugin_keyword, plugin_keyword, time.perf_counter() - started))
 
         # If required fields were found, return output, else log error.
         if "required_fields" not in self.keys():
@@ -0,0 +1,38 @@
+# SPDX-License-Identifier: MIT
+
+"""
+Find the template matching a text.
+
+Templates are tried in order, like a plain loop over `matches_input`, but
+`prepare_input` is run only once per distinct set of preparation options
+(whitespace and accent removal, lowercasing, replacements) instead of once
+per template.
+"""
+
+
+def _prepare_key(template):
+    options = template.options
+    return (
+        options["remove_whitespace"],
+        options["remove_accents"],
+        options["lowercase"],
+        tuple(tuple(r) for r in options["replace"]),
+    )
+
+
+class KeywordIndex(object):
+    """Templates grouped by how they prepare their input"""
+
+    def __init__(self, templates):
+        self.templates = list(templates)
+        self.keys = [_prepare_key(t) for t in self.templates]
+
+    def find(self, extracted_str):
+        """Return (template, optimized_str) of first matching template or (None, None)"""
+        prepared = {}
+        for t, key in zip(self.templates, self.keys):
+            if key not in prepared:
+                prepared[key] = t.prepare_input(extracted_str)
+            if t.matches_input(prepared[key]):
+                return t, prepared[key]
+        return None, None
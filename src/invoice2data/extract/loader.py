@@ -101,3 +101,18 @@ def read_templates(folder=None):
 
                 output.append(InvoiceTemplate(tpl))
     return output
+
+
+def load_templates(folder=None, built_in=True):
+    """
+    Load templates from a user folder, if set, followed by built-in templates.
+
+    This is what the command line tools use for `--template-folder` and
+    `--exclude-built-in-templates`.
+    """
+    templates = []
+    if folder:
+        templates += read_templates(os.path.abspath(folder))
+    if built_in:
+        templates += read_templates()
+    return templates
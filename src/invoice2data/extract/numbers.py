@@ -0,0 +1,71 @@
+# SPDX-License-Identifier: MIT
+
+"""
+Fast parsing of amounts and quantities.
+
+Each template builds one `NumberParser` for its `decimal_separator`. It
+uses `str.translate` instead of regexes and can convert a whole column of
+line item values at once, optionally to `Decimal`.
+"""
+
+from decimal import Decimal
+
+
+class _KeepDigits(dict):
+    """Translation table keeping ASCII digits and spaces, dropping anything else"""
+
+    def __init__(self):
+        # Latin-1 is looked up directly, only rarer characters hit __missing__
+        super(_KeepDigits, self).__init__((i, None) for i in range(256))
+        self.update((ord(c), ord(c)) for c in "0123456789 ")
+
+    def __missing__(self, key):
+        return None
+
+
+_KEEP_DIGITS = _KeepDigits()
+
+
+class NumberParser(object):
+    """
+    Parse numbers like "1.234,56", "Rs 1,939.00" or "12" into float or Decimal.
+
+    The last decimal separator marks the decimals. Any other character but
+    digits (e.g. thousands separators, currency) is dropped. If a space is
+    left in between, only the part after the first space is used.
+    """
+
+    __slots__ = ("decimal_separator",)
+
+    def __init__(self, decimal_separator="."):
+        self.decimal_separator = decimal_separator
+
+    def clean(self, value):
+        """Return value as plain number string with "." as decimal separator"""
+        separator = self.decimal_separator
+        assert value.count(separator) < 3, "Decimal separator cannot be present several times"
+        # Remove any leading spaces
+        value = value.lstrip()
+        index = value.rfind(separator)
+        if index < 0:
+            number = value.translate(_KEEP_DIGITS)
+        else:
+            number = (
+                value[:index].translate(_KEEP_DIGITS) + "." + value[index + len(separator):].translate(_KEEP_DIGITS)
+            )
+        if " " in number:
+            # remove values before space
+            number = number.split(" ")[1]
+        return number
+
+    def parse(self, value, decimal=False):
+        """Parse a single value into float, or Decimal if `decimal` is set"""
+        if decimal:
+            return Decimal(self.clean(value))
+        return float(self.clean(value))
+
+    def parse_many(self, values, decimal=False, default=0.0):
+        """Parse a column of values at once, blank values become `default`"""
+        convert = Decimal if decimal else float
+        clean = self.clean
+        return [convert(clean(v)) if v.strip() else default for v in values]
@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: MIT
+
+"""
+OCR commands of a template.
+
+The `psm`, `whitelist` and `imgcmd` options are turned into an `OCRProfile`
+when the template is loaded. Profiles hold tuples, so they can be shared by
+threads; input readers build a new argument list from them on every call.
+"""
+
+from collections import namedtuple
+
+TESSERACT_PSM3 = (
+    "tesseract",
+    "-c",
+    "tessedit_char_whitelist=/.: abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
+)
+TESSERACT_PSM6 = (
+    "tesseract",
+    "-l",
+    "eng",
+    "--oem",
+    "1",
+    "--psm",
+    "6",
+    "-c",
+    "tessedit_char_whitelist=#-/%.:, abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
+)
+
+WHITELIST = "tessedit_char_whitelist="
+
+
+def _with_whitelist(command, whitelist):
+    if not any(arg.startswith(WHITELIST) for arg in command):
+        return command + ("-c", WHITELIST + whitelist)
+    return tuple(WHITELIST + whitelist if arg.startswith(WHITELIST) else arg for arg in command)
+
+
+class OCRProfile(namedtuple("OCRProfile", ["tesseract", "convert"])):
+    """
+    Tesseract and image conversion commands, without input and output.
+
+    Either is None if the template doesn't set it, the caller's default is
+    used then.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_options(cls, options):
+        """Profile for the `psm`, `whitelist` and `imgcmd` template options"""
+        tesseract = None
+        if "psm" in options:
+            if str(options["psm"]) == "3":
+                tesseract = TESSERACT_PSM3
+            else:
+                tesseract = TESSERACT_PSM6[:6] + (str(options["psm"]),) + TESSERACT_PSM6[7:]
+        if options.get("whitelist") is not None:
+            tesseract = _with_whitelist(tesseract or TESSERACT_PSM6, options["whitelist"])
+        convert = tuple(options["imgcmd"]) if options.get("imgcmd") else None
+        return cls(tesseract, convert)
+
+    def commands(self, tesseract=None, convert=None):
+        """(tesseract, convert) commands, defaults for what the profile doesn't set"""
+        return self.tesseract or tesseract, self.convert or convert
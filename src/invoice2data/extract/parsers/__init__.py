@@ -1,5 +1,7 @@
 # SPDX-License-Identifier: MIT
 
+from . import boxes  # noqa: F401
+from . import fixed_width  # noqa: F401
 from . import lines  # noqa: F401
 from . import regex  # noqa: F401
 from . import static  # noqa: F401
@@ -0,0 +1,155 @@
+# SPDX-License-Identifier: MIT
+
+"""
+Parser to extract line items from the word boxes of an OCRed image.
+
+Instead of matching every text line with a regex, words are put in columns
+by their horizontal position and in rows by their vertical position. Needs
+the page layout (see `invoice2data.layout`), so it only works with input
+readers providing `to_layout` (png, hocr).
+"""
+
+import bisect
+import logging
+
+from .lines import coerce_rows
+
+logger = logging.getLogger(__name__)
+
+# Parsed from the layout of the page instead of its text
+NEEDS_LAYOUT = True
+
+DEFAULT_OPTIONS = {"row_tolerance": 0.5}
+
+
+def _center_y(word):
+    return word.top + word.height / 2.0
+
+
+def _find_line(template, regex, lines):
+    for index, line in enumerate(lines):
+        if template.engine.search(regex, template.prepare_input(line.text)):
+            return index
+    return None
+
+
+def _anchor_box(template, regex, line):
+    """Horizontal extent of the header words matched by an anchor regex
+
+    The line is prepared like in `_find_line`, word by word so that
+    matches map back to words; replacements spanning words don't apply.
+    """
+    texts = [template.prepare_input(word.text) for word in line.words]
+    separator = "" if template.options["remove_whitespace"] else " "
+    match = template.engine.search(regex, separator.join(texts))
+    if not match:
+        return None
+    boxes = []
+    offset = 0
+    for word, text in zip(line.words, texts):
+        if offset < match.end() and offset + len(text) > match.start():
+            boxes.append((word.left, word.right))
+        offset += len(text) + len(separator)
+    return (min(b[0] for b in boxes), max(b[1] for b in boxes)) if boxes else None
+
+
+def _column_bounds(template, columns, layout, header):
+    """Return (left bounds, names) of columns sorted from left to right
+
+    A column is either `[left, right]` as fractions of the page width or a
+    regex finding its title in the header line. Columns are split half way
+    between neighbours.
+    """
+    boxes = []
+    for name, spec in columns.items():
+        if isinstance(spec, (list, tuple)):
+            box = (spec[0] * layout.width, spec[1] * layout.width)
+        elif header is None:
+            logger.warning("Column %s needs a start line to find its title", name)
+            return None
+        else:
+            box = _anchor_box(template, spec, header)
+            if box is None:
+                logger.warning("Column title %s of %s not found in %r", spec, name, header.text)
+                return None
+        boxes.append((box, name))
+    boxes.sort()
+    lefts = [float("-inf")]
+    for ((_, previous_right), _), ((left, _), _) in zip(boxes, boxes[1:]):
+        lefts.append((previous_right + left) / 2.0)
+    return lefts, [name for _, name in boxes]
+
+
+def _cluster_rows(words, tolerance):
+    """Group words whose vertical centers are close, top to bottom"""
+    if not words:
+        return []
+    heights = sorted(w.height for w in words)
+    limit = heights[len(heights) // 2] * tolerance
+    words = sorted(words, key=_center_y)
+    rows = [[words[0]]]
+    center = _center_y(words[0])
+    for word in words[1:]:
+        y = _center_y(word)
+        if y - center > limit:
+            rows.append([word])
+            center = y
+        else:
+            rows[-1].append(word)
+            center += (y - center) / len(rows[-1])
+    return rows
+
+
+def parse(template, _settings, layout):
+    """Extract rows of words between the start and end lines"""
+
+    settings = DEFAULT_OPTIONS.copy()
+    settings.update(_settings)
+
+    assert "columns" in settings, "Columns missing"
+
+    if layout is None:
+        logger.warning("boxes parser needs word boxes, use an input reader with to_layout")
+        return None
+
+    lines = layout.lines
+    header = None
+    top = float("-inf")
+    bottom = float("inf")
+    if "start" in settings:
+        index = _find_line(template, settings["start"], lines)
+        if index is None:
+            logger.warning("no lines found - start %s not found", settings["start"])
+            return None
+        header = lines[index]
+        top = header.box[3]
+        lines = lines[index + 1:]
+    if "end" in settings:
+        index = _find_line(template, settings["end"], lines)
+        if index is None:
+            logger.warning("no lines found - end %s not found", settings["end"])
+            return None
+        bottom = lines[index].box[1]
+        lines = lines[:index]
+
+    bounds = _column_bounds(template, settings["columns"], layout, header)
+    if bounds is None:
+        return None
+    lefts, names = bounds
+
+    words = [w for line in lines for w in line.words if top <= _center_y(w) < bottom]
+    required = settings.get("required", [])
+    rows = []
+    for row_words in _cluster_rows(words, settings["row_tolerance"]):
+        cells = {}
+        for word in sorted(row_words, key=lambda w: w.left):
+            index = bisect.bisect_right(lefts, (word.left + word.right) / 2.0) - 1
+            cells.setdefault(names[index], []).append(word.text)
+        row = {name: " ".join(texts) for name, texts in cells.items()}
+        if rows and not all(name in row for name in required):
+            # Continuation of the previous item, e.g. a wrapped description
+            for name, value in row.items():
+                rows[-1][name] = "%s\n%s" % (rows[-1][name], value) if name in rows[-1] else value
+            continue
+        rows.append(row)
+    return coerce_rows(template, settings, rows)
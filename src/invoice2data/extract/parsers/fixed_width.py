@@ -0,0 +1,114 @@
+# SPDX-License-Identifier: MIT
+
+"""
+Parser to extract line items from fixed width columns.
+
+`pdftotext -layout` keeps the columns of a table aligned, so instead of
+matching every row with a regex, rows are cut at the column offsets. The
+offsets are given in the template or found from the column titles in the
+header line (the line matched by `start`).
+"""
+
+import logging
+
+from .lines import coerce_rows
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS = {"min_gap": 2}
+
+
+def _line_bounds(content, start, end):
+    """Start and end offsets of the line holding content[start:end]"""
+    line_start = content.rfind("\n", 0, start) + 1
+    line_end = content.find("\n", end)
+    return line_start, len(content) if line_end == -1 else line_end
+
+
+def _header_spans(template, header, min_gap):
+    """Columns of a header line, titles being separated by min_gap spaces"""
+    regex = r"\S+(?: {1,%d}\S+)*" % (min_gap - 1) if min_gap > 1 else r"\S+"
+    return [
+        (m.start(), m.end(), m.group(0).lower().replace(" ", "_"), False)
+        for m in template.engine.finditer(regex, header)
+    ]
+
+
+def _title_spans(template, columns, header):
+    spans = []
+    for name, spec in columns.items():
+        if isinstance(spec, (list, tuple)):
+            spans.append((spec[0], spec[1], name, True))
+            continue
+        match = template.engine.search(spec, header)
+        if not match:
+            logger.warning("Column title %s of %s not found in %r", spec, name, header)
+            return None
+        spans.append((match.start(), match.end(), name, False))
+    return spans
+
+
+def _slices(spans):
+    """(name, start, end) to cut rows at
+
+    `[start, end]` spans from the template are used as is. Columns found by
+    their title reach half way to their neighbours, as numbers are often
+    right aligned and text left aligned to the title.
+    """
+    spans = sorted(spans)
+    slices = []
+    for index, (start, end, name, exact) in enumerate(spans):
+        if not exact:
+            start = (spans[index - 1][1] + start) // 2 if index > 0 else 0
+            end = (end + spans[index + 1][0]) // 2 if index + 1 < len(spans) else None
+        slices.append((name, start, end))
+    return slices
+
+
+def parse(template, _settings, content):
+    """Cut the lines between start and end into columns"""
+
+    settings = DEFAULT_OPTIONS.copy()
+    settings.update(_settings)
+
+    assert "start" in settings, "Lines start regex missing"
+    assert "end" in settings, "Lines end regex missing"
+
+    engine = template.engine
+    start = engine.search(settings["start"], content)
+    if not start:
+        logger.warning("no lines found - start %s not found", settings["start"])
+        return None
+    header_start, header_end = _line_bounds(content, start.start(), start.end())
+    end = engine.search(settings["end"], content[header_end:])
+    if not end:
+        logger.warning("no lines found - end %s not found", settings["end"])
+        return None
+    body_end = content.rfind("\n", 0, header_end + end.start()) + 1
+    header = content[header_start:header_end]
+
+    if "columns" in settings:
+        spans = _title_spans(template, settings["columns"], header)
+    else:
+        spans = _header_spans(template, header, settings["min_gap"])
+    if not spans:
+        return None
+    slices = _slices(spans)
+
+    required = settings.get("required", [])
+    rows = []
+    for line in content[header_end + 1:body_end].split("\n"):
+        if not line.strip():
+            continue
+        row = {}
+        for name, begin, stop in slices:
+            value = line[begin:stop].strip()
+            if value:
+                row[name] = value
+        if rows and not all(name in row for name in required):
+            # Continuation of the previous item, e.g. a wrapped description
+            for name, value in row.items():
+                rows[-1][name] = "%s\n%s" % (rows[-1][name], value) if name in rows[-1] else value
+            continue
+        rows.append(row)
+    return coerce_rows(template, settings, rows)
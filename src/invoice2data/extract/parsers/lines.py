@@ -4,9 +4,10 @@ Parser to extract individual lines from an invoice.
 Initial work and maintenance by Holger Brunn @hbrunn
 """
 
-import re
 import logging
 
+from ..columns import LineColumns
+
 logger = logging.getLogger(__name__)
 
 DEFAULT_OPTIONS = {"line_separator": r"\n"}
@@ -24,8 +25,9 @@ def parse(template, _settings, content):
     assert "end" in settings, "Lines end regex missing"
     assert "line" in settings, "Line regex missing"
 
-    start = re.search(settings["start"], content)
-    end = re.search(settings["end"], content)
+    engine = template.engine
+    start = engine.search(settings["start"], content)
+    end = engine.search(settings["end"], content)
     if not start or not end:
         logger.warning("no lines found - start %s, end %s", start, end)
         return
@@ -34,12 +36,12 @@ def parse(template, _settings, content):
     current_row = {}
     if "first_line" not in settings and "last_line" not in settings:
         settings["first_line"] = settings["line"]
-    for line in re.split(settings["line_separator"], content):
+    for line in engine.split(settings["line_separator"], content):
         # if the line has empty lines in it , skip them
         if not line.strip("").strip("\n") or not line:
             continue
         if "first_line" in settings:
-            match = re.search(settings["first_line"], line)
+            match = engine.search(settings["first_line"], line)
             if match:
                 if "last_line" not in settings:
                     if current_row:
@@ -53,7 +55,7 @@ def parse(template, _settings, content):
                 }
                 continue
         if "last_line" in settings:
-            match = re.search(settings["last_line"], line)
+            match = engine.search(settings["last_line"], line)
             if match:
                 for field, value in match.groupdict().items():
                     current_row[field] = "%s%s%s" % (
@@ -65,7 +67,7 @@ def parse(template, _settings, content):
                     lines.append(current_row)
                 current_row = {}
                 continue
-        match = re.search(settings["line"], line)
+        match = engine.search(settings["line"], line)
         if match:
             for field, value in match.groupdict().items():
                 current_row[field] = "%s%s%s" % (
@@ -77,11 +79,23 @@ def parse(template, _settings, content):
         logger.debug("ignoring *%s* because it doesn't match anything", line)
     if current_row:
         lines.append(current_row)
+    return coerce_rows(template, settings, lines)
+
+
+def coerce_rows(template, settings, lines):
+    """Apply `types` and `columnar` settings to parsed rows"""
+    # Coerce typed columns in one go rather than cell by cell
+    types = settings.get("types", {})
+    if settings.get("columnar", template.options.get("columnar_lines")):
+        lines = LineColumns.from_rows(lines)
+        for name, target_type in types.items():
+            if name in lines.columns:
+                lines.coerce(name, lambda values: template.coerce_types(values, target_type))
+        return lines
 
-    types = settings.get("types", [])
-    for row in lines:
-        for name in row.keys():
-            if name in types:
-                row[name] = template.coerce_type(row[name], types[name])
+    for name, target_type in types.items():
+        rows = [row for row in lines if name in row]
+        for row, value in zip(rows, template.coerce_types([row[name] for row in rows], target_type)):
+            row[name] = value
 
     return lines
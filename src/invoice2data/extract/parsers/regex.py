@@ -9,9 +9,12 @@ By default it ignores duplicates and returns:
 - array for multiple matches
 
 For more detailed parsing "type" and "group" settings can be specified.
+
+Each regex of a list is matched on its own, results keep the order of the
+list (all matches of the first regex, then the second one, ...), so matches
+of different regexes may overlap.
 """
 
-import re
 import logging
 from collections import OrderedDict
 
@@ -25,15 +28,14 @@ def parse(template, settings, content, legacy=False):
     result = []
     if isinstance(settings["regex"], list):
         for regex in settings["regex"]:
-            matches = re.findall(regex, content)
+            matches = template.engine.findall(regex, content)
             if matches:
                 result += matches
     else:
-        result = re.findall(settings["regex"], content)
+        result = template.engine.findall(settings["regex"], content)
 
     if "type" in settings:
-        for k, v in enumerate(result):
-            result[k] = template.coerce_type(v, settings["type"])
+        result = template.coerce_types(result, settings["type"])
 
     if "group" in settings:
         if settings["group"] == "sum":
@@ -2,7 +2,6 @@
 Plugin to extract tables from an invoice.
 """
 
-import re
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,6 +12,10 @@ DEFAULT_OPTIONS = {"field_separator": r"\s+", "line_separator": r"\n"}
 def extract(self, content, output):
     """Try to extract tables from an invoice"""
 
+    engine = self.engine
+    # Tables often share start/end anchors. Locate and split each body once.
+    bodies = {}
+
     for table in self["tables"]:
 
         # First apply default options.
@@ -25,34 +28,51 @@ def extract(self, content, output):
         assert "end" in table, "Table end regex missing"
         assert "body" in table, "Table body regex missing"
 
-        start = re.search(table["start"], content)
-        end = re.search(table["end"], content)
-
-        if not start or not end:
-            logger.warning("no table body found - start %s, end %s", start, end)
+        # Regexes are compiled once and cached by the engine.
+        fields = set(engine.compile(table["body"]).groupindex)
+        if fields and fields.issubset(output):
+            logger.debug("all fields of table %s already set, skipping", table["body"])
             continue
 
-        table_body = content[start.end() : end.start()]
+        key = (table["start"], table["end"], table["line_separator"])
+        if key not in bodies:
+            start = engine.search(table["start"], content)
+            end = engine.search(table["end"], content)
+            if not start or not end:
+                logger.warning("no table body found - start %s, end %s", start, end)
+                bodies[key] = None
+            else:
+                table_body = content[start.end() : end.start()]
+                bodies[key] = [
+                    line for line in engine.split(table["line_separator"], table_body)
+                    # if the line has empty lines in it , skip them
+                    if line and line.strip("\n")
+                ]
+        lines = bodies[key]
+        if lines is None:
+            continue
 
-        for line in re.split(table["line_separator"], table_body):
-            # if the line has empty lines in it , skip them
-            if not line.strip("").strip("\n") or not line:
+        for line in lines:
+            match = engine.search(table["body"], line)
+            if not match:
+                logger.debug("ignoring *%s* because it doesn't match anything", line)
                 continue
 
-            match = re.search(table["body"], line)
-            if match:
-                for field, value in match.groupdict().items():
-                    # If a field name already exists, do not overwrite it
-                    if field in output:
-                        continue
-
-                    if field.startswith("date") or field.endswith("date"):
-                        output[field] = self.parse_date(value)
-                        if not output[field]:
-                            logger.error("Date parsing failed on date '%s'", value)
-                            return None
-                    elif field.startswith("amount"):
-                        output[field] = self.parse_number(value)
-                    else:
-                        output[field] = value
-            logger.debug("ignoring *%s* because it doesn't match anything", line)
+            for field, value in match.groupdict().items():
+                # If a field name already exists, do not overwrite it
+                if field in output:
+                    continue
+
+                if field.startswith("date") or field.endswith("date"):
+                    output[field] = self.parse_date(value)
+                    if not output[field]:
+                        logger.error("Date parsing failed on date '%s'", value)
+                        return None
+                elif field.startswith("amount"):
+                    output[field] = self.parse_number(value)
+                else:
+                    output[field] = value
+
+            # Stop once every named group of this table is resolved.
+            if fields.issubset(output):
+                break
@@ -0,0 +1,183 @@
+# SPDX-License-Identifier: MIT
+
+"""
+Pluggable regular expression engines.
+
+Parsers and plugins don't call the `re` module directly. They go through
+the engine selected for the template (option `regex_engine`) or the
+global default set with `set_default_engine`. Available engines:
+
+- `re`: Python standard library (default).
+- `regex`: the `regex` module. Supports a per-call `timeout` in seconds
+  (option `regex_timeout`), so a pathological pattern can't stall a run.
+- `re2`: Google RE2 binding (`pip install google-re2`). Guarantees linear
+  time matching, but doesn't support lookarounds, backreferences and a few
+  other constructs. Use `unsupported()` to check patterns up front.
+
+Patterns an engine can't handle are transparently run with `re` and a
+warning is logged once per pattern.
+"""
+
+import re
+import logging
+
+try:
+    import re._parser as sre_parse  # Python >= 3.11
+except ImportError:
+    import sre_parse
+
+logger = logging.getLogger(__name__)
+
+_STDLIB_PATTERN = type(re.compile(""))
+_default_engine = {"name": "re", "timeout": None}
+_engines = {}
+
+
+def _walk(node):
+    """Yield (opcode name, argument) for every node of a parsed pattern"""
+    for op, av in node:
+        yield str(op), av
+        for child in _children(av):
+            for item in _walk(child):
+                yield item
+
+
+def _children(av):
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (list, tuple)):
+        for x in av:
+            for child in _children(x):
+                yield child
+
+
+def pattern_features(pattern):
+    """Return set of advanced regex constructs used by pattern"""
+    features = set()
+    for op, av in _walk(sre_parse.parse(pattern)):
+        if op in ("ASSERT", "ASSERT_NOT"):
+            features.add("lookbehind" if av[0] < 0 else "lookahead")
+        elif op == "GROUPREF":
+            features.add("backreference")
+        elif op == "GROUPREF_EXISTS":
+            features.add("conditional group")
+        elif op in ("ATOMIC_GROUP", "POSSESSIVE_REPEAT"):
+            features.add("atomic group or possessive repeat")
+    return features
+
+
+class StdlibEngine(object):
+    """Backtracking engine from the standard library `re` module"""
+
+    name = "re"
+    unsupported_features = frozenset()
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._cache = {}
+
+    def _compile(self, pattern, flags):
+        return re.compile(pattern, flags)
+
+    def unsupported(self, pattern):
+        """Return list of reasons why pattern can't run on this engine"""
+        try:
+            features = pattern_features(pattern)
+        except re.error as e:
+            return ["invalid pattern: %s" % e]
+        return sorted(features & self.unsupported_features)
+
+    def compile(self, pattern, flags=0):
+        key = (pattern, flags)
+        compiled = self._cache.get(key)
+        if compiled is None:
+            reasons = self.unsupported(pattern)
+            if reasons:
+                logger.warning(
+                    "regex engine %s can't handle %r (%s), using re",
+                    self.name, pattern, ", ".join(reasons),
+                )
+                compiled = re.compile(pattern, flags)
+            else:
+                compiled = self._compile(pattern, flags)
+            self._cache[key] = compiled
+        return compiled
+
+    def _call(self, method, *args):
+        return method(*args)
+
+    def search(self, pattern, string, flags=0):
+        return self._call(self.compile(pattern, flags).search, string)
+
+    def findall(self, pattern, string, flags=0):
+        return self._call(self.compile(pattern, flags).findall, string) or []
+
+    def finditer(self, pattern, string, flags=0):
+        return self._call(self.compile(pattern, flags).finditer, string) or iter(())
+
+    def split(self, pattern, string, flags=0):
+        return self._call(self.compile(pattern, flags).split, string) or [string]
+
+
+class RegexModuleEngine(StdlibEngine):
+    """Engine backed by the `regex` module, with optional timeout"""
+
+    name = "regex"
+
+    def _compile(self, pattern, flags):
+        import regex
+
+        return regex.compile(pattern, flags | regex.VERSION0)
+
+    def _call(self, method, *args):
+        if self.timeout is None or isinstance(method.__self__, _STDLIB_PATTERN):
+            return method(*args)
+        try:
+            return method(*args, timeout=self.timeout)
+        except TimeoutError:
+            logger.error("regex %r timed out after %ss", method.__self__.pattern, self.timeout)
+            return None
+
+
+class RE2Engine(StdlibEngine):
+    """Linear time engine backed by Google RE2"""
+
+    name = "re2"
+    unsupported_features = frozenset(
+        [
+            "lookahead",
+            "lookbehind",
+            "backreference",
+            "conditional group",
+            "atomic group or possessive repeat",
+        ]
+    )
+
+    def _compile(self, pattern, flags):
+        import re2
+
+        return re2.compile(pattern, flags)
+
+
+ENGINE_MAPPING = {"re": StdlibEngine, "regex": RegexModuleEngine, "re2": RE2Engine}
+
+
+def set_default_engine(name, timeout=None):
+    """Set engine used by templates without a `regex_engine` option"""
+    assert name in ENGINE_MAPPING, "Unknown regex engine %s" % name
+    _default_engine["name"] = name
+    _default_engine["timeout"] = timeout
+
+
+def get_engine(name=None, timeout=None):
+    """Return shared engine instance, the global default if name is None"""
+    if name is None:
+        name = _default_engine["name"]
+        if timeout is None:
+            timeout = _default_engine["timeout"]
+    key = (name, timeout)
+    engine = _engines.get(key)
+    if engine is None:
+        assert name in ENGINE_MAPPING, "Unknown regex engine %s" % name
+        engine = _engines.setdefault(key, ENGINE_MAPPING[name](timeout))
+    return engine
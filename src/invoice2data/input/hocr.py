@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Reads hOCR files, e.g. written by `tesseract image out hocr`."""
+
+
+def to_layout(path, cmdlist=None, conv_cmdlist=None):
+    """Lines and word boxes of an hOCR file.
+
+    Parameters
+    ----------
+    path : str
+        path of hOCR file
+
+    Returns
+    -------
+    layout : invoice2data.layout.Layout
+        lines with their boxes
+
+    """
+    from ..layout import parse_hocr
+
+    with open(path, encoding="utf-8") as fp:
+        return parse_hocr(fp.read())
+
+
+def to_text(path, cmdlist=None, conv_cmdlist=None):
+    """Text of an hOCR file.
+
+    Parameters
+    ----------
+    path : str
+        path of hOCR file
+
+    Returns
+    -------
+    extracted_str : str
+        returns text rebuilt from the words of the hOCR file
+
+    """
+    return to_layout(path).text().encode("utf-8")
+
+
+def to_text_and_layout(path, cmdlist=None, conv_cmdlist=None):
+    """Text and layout of an hOCR file, see `to_text` and `to_layout`"""
+    layout = to_layout(path)
+    return layout.text().encode("utf-8"), layout
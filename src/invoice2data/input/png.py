@@ -2,13 +2,66 @@
 import logging
 logger = logging.getLogger(__name__)
 
-def to_text(path, cmdlist=None, conv_cmdlist=None):
+TESSERACT_COMMAND = (
+    "tesseract",
+    "-l",
+    "eng",
+    "--oem",
+    "1",
+    "--psm",
+    "6",
+    "-c",
+    "tessedit_char_whitelist=#-/.: abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
+)
+
+
+def _communicate(procs, cancel=None):
+    """Wait for the output of the last process of a pipeline, kill all if cancel gets set
+
+    Every process is waited for, and the parent's end of the pipes between
+    them closed, so none is left behind as a zombie or open descriptor.
+    """
+    import subprocess
+
+    # The downstream process holds its own copy, and upstream ones get
+    # SIGPIPE if it exits early
+    for p in procs[:-1]:
+        p.stdout.close()
+    try:
+        if cancel is None:
+            return procs[-1].communicate()
+        while True:
+            try:
+                return procs[-1].communicate(timeout=0.1)
+            except subprocess.TimeoutExpired:
+                if cancel.is_set():
+                    for p in procs:
+                        p.kill()
+                    procs[-1].communicate()
+                    return b"", None
+    finally:
+        for p in procs[:-1]:
+            p.wait()
+
+
+def to_text(path, cmdlist=None, conv_cmdlist=None, cancel=None, configs=(), output="stdout"):
     """Wraps Tesseract OCR.
 
     Parameters
     ----------
     path : str
         path of electronic invoice in JPG or PNG format
+    cmdlist : sequence of str, optional
+        tesseract command without input and output, not modified
+    conv_cmdlist : sequence of str, optional
+        imagemagick command the image is piped through first, without
+        input and output, not modified
+    cancel : threading.Event, optional
+        kill the OCR processes and return empty output once set
+    configs : sequence of str, optional
+        tesseract config files added after the output, e.g. ("tsv",)
+    output : str
+        tesseract output base, files are written there instead of stdout
 
     Returns
     -------
@@ -25,73 +78,140 @@ def to_text(path, cmdlist=None, conv_cmdlist=None):
     if not spawn.find_executable("convert"):
         raise EnvironmentError("imagemagick not installed.")
 
-    # convert = "convert -density 350 %s -depth 8 tiff:-" % (path)
-    if conv_cmdlist != None:
-        """convert = [
-            "convert",
-            "-brightness-contrast",
-            "-70x10",
-            "-density",
-            "350",
-            "-depth",
-            "8",
-            "-alpha",
-            "off",
-            "tiff:-",
-            path,
-        ]"""
-        conv_cmdlist.append(path)
-        conv_cmdlist.append("tiff:-")
-        logger.error(f'Image conversion cmd {conv_cmdlist}')
-
-        convert = conv_cmdlist
-
-        p1 = subprocess.Popen(convert, stdout=subprocess.PIPE)
-        if cmdlist == None:
-            tess = [
-                "tesseract",
-                "-l",
-                "eng",
-                "--oem",
-                "1",
-                "--psm",
-                "6",
-                "-c",
-                "tessedit_char_whitelist=#-/.: abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
-                p1.stdin,
-                "stdout",
-            ]
-            p2 = subprocess.Popen(tess, stdin=p1.stdout, stdout=subprocess.PIPE)
-        else:
-            cmdlist.append("stdin")
-            cmdlist.append("stdout")
-            tess = cmdlist
-            p2 = subprocess.Popen(tess, stdin=p1.stdout, stdout=subprocess.PIPE)
-
-    else:
-        #tess = ["tesseract", "-c", "tessedit_char_whitelist=/.: abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", path, "stdout"]
-        if cmdlist == None:
-            tess = [
-                "tesseract",
-                "-l",
-                "eng",
-                "--oem",
-                "1",
-                "--psm",
-                "6",
-                "-c",
-                "tessedit_char_whitelist=#-/.: abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
-                path,
-                "stdout",
-            ]
-        else:
-            cmdlist.append(path)
-            cmdlist.append("stdout")
-            tess = cmdlist
-        p2 = subprocess.Popen(tess,  stdout=subprocess.PIPE)
-    out, err = p2.communicate()
+    procs = []
+    source = path
+    if conv_cmdlist is not None:
+        convert = list(conv_cmdlist) + [path, "tiff:-"]
+        logger.error(f'Image conversion cmd {convert}')
+        procs.append(subprocess.Popen(convert, stdout=subprocess.PIPE))
+        source = "stdin"
+
+    tess = list(cmdlist if cmdlist is not None else TESSERACT_COMMAND) + [source, output] + list(configs)
+    procs.append(subprocess.Popen(tess, stdin=procs[0].stdout if procs else None, stdout=subprocess.PIPE))
+    out, err = _communicate(procs, cancel)
     logger.error(f'conversion command {tess} ')
 
     extracted_str = out
 
     return extracted_str
+
+
+def to_layout(path, cmdlist=None, conv_cmdlist=None, cancel=None):
+    """Like `to_text`, but also keeps the box of every text line.
+
+    Tesseract writes TSV output, the text is rebuilt from its words.
+
+    Returns
+    -------
+    layout : invoice2data.layout.Layout
+        lines with their boxes, `layout.text()` gives the extracted text
+
+    """
+    from ..layout import parse_tsv
+
+    return parse_tsv(to_text(path, cmdlist, conv_cmdlist, cancel, configs=("tsv",)).decode("utf-8"))
+
+
+def to_text_and_layout(path, cmdlist=None, conv_cmdlist=None, cancel=None):
+    """Like `to_text`, but also returns the layout, from the same OCR run.
+
+    Tesseract writes its plain text and TSV output side by side, so the text
+    is exactly what `to_text` returns, the layout is parsed from the TSV.
+
+    Returns
+    -------
+    (extracted_str, layout) : (str, invoice2data.layout.Layout)
+
+    """
+    import os
+    import shutil
+    import tempfile
+    from ..layout import parse_tsv
+
+    folder = tempfile.mkdtemp(prefix="invoice2data-")
+    try:
+        base = os.path.join(folder, "ocr")
+        to_text(path, cmdlist, conv_cmdlist, cancel, configs=("txt", "tsv"), output=base)
+        outputs = []
+        for extension in (".txt", ".tsv"):
+            # Missing if cancelled
+            if os.path.exists(base + extension):
+                with open(base + extension, "rb") as fp:
+                    outputs.append(fp.read())
+            else:
+                outputs.append(b"")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return outputs[0], parse_tsv(outputs[1].decode("utf-8"))
+
+
+def _image_to_text(path, cmdlist=None, region=None, scale=None):
+    """OCR an image after optional crop and resize with Pillow, piped to tesseract"""
+    import io
+    import subprocess
+    from distutils import spawn
+    from PIL import Image
+
+    if not spawn.find_executable("tesseract"):
+        raise EnvironmentError("tesseract not installed.")
+
+    with Image.open(path) as img:
+        if region is not None:
+            width, height = img.size
+            left, top, right, bottom = region
+            img = img.crop((int(left * width), int(top * height), int(right * width), int(bottom * height)))
+        if scale is not None:
+            img = img.resize((max(1, int(img.size[0] * scale)), max(1, int(img.size[1] * scale))))
+        buf = io.BytesIO()
+        img.save(buf, "PNG")
+
+    tess = list(cmdlist) if cmdlist else ["tesseract", "-l", "eng", "--oem", "1", "--psm", "6"]
+    tess += ["stdin", "stdout"]
+    out, err = subprocess.Popen(tess, stdin=subprocess.PIPE, stdout=subprocess.PIPE).communicate(buf.getvalue())
+    logger.debug("OCR command %s, region %s, scale %s", tess, region, scale)
+    return out
+
+
+def region_to_text(path, region, cmdlist=None, scale=None):
+    """OCR only a region of the image, e.g. the header to identify the template.
+
+    Parameters
+    ----------
+    path : str
+        path of electronic invoice in JPG or PNG format
+    region : tuple of float
+        (left, top, right, bottom) as fractions of width and height
+    cmdlist : list of str, optional
+        tesseract command without input and output, not modified
+    scale : float, optional
+        resize factor applied to the cropped region
+
+    Returns
+    -------
+    extracted_str : str
+        returns extracted text from the region
+
+    """
+    return _image_to_text(path, cmdlist, region=region, scale=scale)
+
+
+def fast_to_text(path, scale=0.5, cmdlist=None):
+    """Quick OCR of a downscaled image, enough to identify the template.
+
+    Parameters
+    ----------
+    path : str
+        path of electronic invoice in JPG or PNG format
+    scale : float
+        resize factor applied before OCR
+    cmdlist : list of str, optional
+        tesseract command without input and output, not modified. Default
+        has no character whitelist.
+
+    Returns
+    -------
+    extracted_str : str
+        returns extracted text from image
+
+    """
+    return _image_to_text(path, cmdlist, scale=scale)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Job queue in a SQLite file, shared by workers on several hosts.
+
+Producers add jobs (file path, tid and options), workers claim them one at
+a time. A claim is a lease: if the worker doesn't finish or renew it in
+time, e.g. because its host died, the job can be claimed again. Failed
+jobs are retried until `max_attempts`. Results are stored with the job.
+
+Claims run in an immediate transaction, so only one worker gets a job. The
+database uses SQLite's rollback journal rather than WAL, which needs
+shared memory on one host. Across hosts, the shared filesystem has to
+support file locks (NFSv4, SMB; not every NFSv3 setup does).
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import time
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    tid TEXT,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until);
+"""
+
+
+def worker_name():
+    """Default name of a worker: host and process id"""
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class Job(object):
+    """A claimed job"""
+
+    __slots__ = ("id", "path", "tid", "options", "attempts")
+
+    def __init__(self, id, path, tid, options, attempts):
+        self.id = id
+        self.path = path
+        self.tid = tid
+        self.options = options
+        self.attempts = attempts
+
+    def __repr__(self):
+        return "<Job %d %s tid=%s attempt=%d>" % (self.id, self.path, self.tid, self.attempts)
+
+
+class JobQueue(object):
+    """
+    Jobs of a SQLite database file.
+
+    Parameters
+    ----------
+    path : str
+        database file, created if missing
+    lease : float
+        seconds a claimed job belongs to its worker
+    max_attempts : int
+        claims of a job before it fails for good
+    timeout : float
+        seconds to wait for a lock held by another process
+    """
+
+    def __init__(self, path, lease=600, max_attempts=3, timeout=60):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # Transactions are started explicitly
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.executescript(SCHEMA)
+
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def enqueue(self, path, tid=None, options=None):
+        """Add a job, return its id"""
+        return self.enqueue_many([(path, tid, options)])[0]
+
+    def enqueue_many(self, jobs):
+        """Add (path, tid, options) jobs in one transaction, return their ids"""
+        now = time.time()
+        ids = []
+        self._transaction()
+        try:
+            for path, tid, options in jobs:
+                cursor = self.conn.execute(
+                    "INSERT INTO jobs (path, tid, options, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, tid, json.dumps(options or {}, sort_keys=True), PENDING, now, now),
+                )
+                ids.append(cursor.lastrowid)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return ids
+
+    def claim(self, worker):
+        """Claim the oldest pending job or one with an expired lease
+
+        Returns a `Job`, or None if there's nothing to do.
+        """
+        now = time.time()
+        self._transaction()
+        try:
+            # Expired leases of jobs out of attempts
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, error = 'lease expired', worker = NULL, updated_at = ? "
+                "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, now, RUNNING, now, self.max_attempts),
+            )
+            row = self.conn.execute(
+                "SELECT id, path, tid, options, attempts FROM jobs "
+                "WHERE status = ? OR (status = ? AND lease_until < ?) ORDER BY id LIMIT 1",
+                (PENDING, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                self.conn.execute("COMMIT")
+                return None
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, worker = ?, lease_until = ?, updated_at = ? "
+                "WHERE id = ?",
+                (RUNNING, worker, now + self.lease, now, row[0]),
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return Job(row[0], row[1], row[2], json.loads(row[3]), row[4] + 1)
+
+    def _update_owned(self, job_id, worker, sql, params):
+        """Update a job still leased to worker, False if the lease was lost"""
+        cursor = self.conn.execute(
+            sql + " WHERE id = ? AND status = ? AND worker = ?", params + (job_id, RUNNING, worker)
+        )
+        return cursor.rowcount == 1
+
+    def renew(self, job_id, worker):
+        """Extend the lease of a job, False if it was lost"""
+        now = time.time()
+        return self._update_owned(
+            job_id, worker, "UPDATE jobs SET lease_until = ?, updated_at = ?", (now + self.lease, now)
+        )
+
+    def complete(self, job_id, worker, result):
+        """Store the result of a job, False if the lease was lost"""
+        return self._update_owned(
+            job_id,
+            worker,
+            "UPDATE jobs SET status = ?, result = ?, error = NULL, lease_until = NULL, updated_at = ?",
+            (DONE, json.dumps(result, ensure_ascii=False), time.time()),
+        )
+
+    def fail(self, job_id, worker, error, retry=True):
+        """Give a job back for a retry, or fail it when out of attempts
+
+        Returns False if the lease was lost.
+        """
+        return self._update_owned(
+            job_id,
+            worker,
+            "UPDATE jobs SET status = CASE WHEN ? AND attempts < ? THEN ? ELSE ? END, worker = NULL, "
+            "error = ?, lease_until = NULL, updated_at = ?",
+            (int(retry), self.max_attempts, PENDING, FAILED, error, time.time()),
+        )
+
+    def pending_options(self):
+        """Distinct options of jobs waiting to be claimed"""
+        rows = self.conn.execute("SELECT DISTINCT options FROM jobs WHERE status = ?", (PENDING,))
+        return [json.loads(options) for options, in rows]
+
+    def counts(self):
+        """Number of jobs per status"""
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def jobs(self, status=None):
+        """Yield jobs as dicts, results decoded"""
+        sql = "SELECT id, path, tid, status, attempts, worker, result, error FROM jobs"
+        params = ()
+        if status is not None:
+            sql += " WHERE status = ?"
+            params = (status,)
+        for row in self.conn.execute(sql + " ORDER BY id", params):
+            job = dict(zip(("id", "path", "tid", "status", "attempts", "worker", "result", "error"), row))
+            if job["result"] is not None:
+                job["result"] = json.loads(job["result"])
+            yield job
+
+    def close(self):
+        self.conn.close()
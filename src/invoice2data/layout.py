@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Word and line boxes of an OCRed page.
+
+Tesseract's TSV output (`tesseract image stdout tsv`) has one row per
+page, block, paragraph, line and word. `parse_tsv` keeps the words,
+grouped by text line, so the text can be rebuilt and a line traced back to
+the part of the image it came from, e.g. to OCR it again. `parse_hocr`
+reads the same from hOCR (`tesseract image stdout hocr`).
+"""
+
+import csv
+import re
+from html.parser import HTMLParser
+
+
+class Word(object):
+    """One recognized word and its box in pixels"""
+
+    __slots__ = ("text", "left", "top", "width", "height", "conf")
+
+    def __init__(self, text, left, top, width, height, conf=-1.0):
+        self.text = text
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.conf = conf
+
+    @property
+    def right(self):
+        return self.left + self.width
+
+    @property
+    def bottom(self):
+        return self.top + self.height
+
+    def __repr__(self):
+        return "Word(%r, %d, %d, %d, %d)" % (self.text, self.left, self.top, self.width, self.height)
+
+
+class TextLine(object):
+    """Words of a text line, in reading order"""
+
+    __slots__ = ("words", "block")
+
+    def __init__(self, words, block=None):
+        self.words = words
+        # (block, paragraph) the line belongs to
+        self.block = block
+
+    @property
+    def text(self):
+        return " ".join(w.text for w in self.words)
+
+    @property
+    def box(self):
+        """(left, top, right, bottom) in pixels"""
+        return (
+            min(w.left for w in self.words),
+            min(w.top for w in self.words),
+            max(w.right for w in self.words),
+            max(w.bottom for w in self.words),
+        )
+
+    def __repr__(self):
+        return "TextLine(%r)" % self.text
+
+
+class Layout(object):
+    """Text lines of a page of `width` x `height` pixels"""
+
+    __slots__ = ("width", "height", "lines")
+
+    def __init__(self, width, height, lines):
+        self.width = width
+        self.height = height
+        self.lines = lines
+
+    def text(self):
+        """Text like tesseract's plain output, paragraphs separated by blank lines"""
+        parts = []
+        block = None
+        for line in self.lines:
+            if parts and line.block != block:
+                parts.append("")
+            block = line.block
+            parts.append(line.text)
+        return "\n".join(parts) + "\n"
+
+    def words(self):
+        return [w for line in self.lines for w in line.words]
+
+    def region(self, box, pad=0):
+        """Box in pixels, grown by `pad` pixels, as fractions of the page size"""
+        left, top, right, bottom = box
+        return (
+            max(0, left - pad) / float(self.width),
+            max(0, top - pad) / float(self.height),
+            min(self.width, right + pad) / float(self.width),
+            min(self.height, bottom + pad) / float(self.height),
+        )
+
+
+def parse_tsv(data):
+    """Build a `Layout` from tesseract TSV output (str)"""
+    width = height = 0
+    lines = []
+    current = None
+    key = None
+    for row in csv.DictReader(data.splitlines(), delimiter="\t", quoting=csv.QUOTE_NONE):
+        level = row["level"]
+        if level == "1":
+            width, height = int(row["width"]), int(row["height"])
+            continue
+        text = (row.get("text") or "").strip()
+        if level != "5" or not text:
+            continue
+        line_key = (row["page_num"], row["block_num"], row["par_num"], row["line_num"])
+        if line_key != key:
+            key = line_key
+            current = TextLine([], line_key[:3])
+            lines.append(current)
+        current.words.append(
+            Word(text, int(row["left"]), int(row["top"]), int(row["width"]), int(row["height"]), float(row["conf"]))
+        )
+    return Layout(width, height, lines)
+
+
+_BBOX = re.compile(r"bbox (\d+) (\d+) (\d+) (\d+)")
+_WCONF = re.compile(r"x_wconf (\d+)")
+_LINE_CLASSES = ("ocr_line", "ocr_caption", "ocr_header", "ocr_textfloat")
+
+
+class _HocrParser(HTMLParser):
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.width = self.height = 0
+        self.lines = []
+        self.classes = []
+        self.paragraph = 0
+        self.word = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        cls = attrs.get("class") or ""
+        title = attrs.get("title") or ""
+        self.classes.append(cls)
+        bbox = _BBOX.search(title)
+        if cls == "ocr_page" and bbox:
+            self.width, self.height = int(bbox.group(3)), int(bbox.group(4))
+        elif cls == "ocr_par":
+            self.paragraph += 1
+        elif cls in _LINE_CLASSES:
+            self.lines.append(TextLine([], (0, self.paragraph)))
+        elif cls == "ocrx_word" and bbox:
+            conf = _WCONF.search(title)
+            self.word = ([int(v) for v in bbox.groups()], float(conf.group(1)) if conf else -1.0, [])
+
+    def handle_endtag(self, tag):
+        cls = self.classes.pop() if self.classes else ""
+        if cls == "ocrx_word" and self.word is not None:
+            (left, top, right, bottom), conf, parts = self.word
+            text = "".join(parts).strip()
+            if text and self.lines:
+                self.lines[-1].words.append(Word(text, left, top, right - left, bottom - top, conf))
+            self.word = None
+
+    def handle_data(self, data):
+        if self.word is not None:
+            self.word[2].append(data)
+
+
+def parse_hocr(data):
+    """Build a `Layout` from hOCR (str) of a single page"""
+    parser = _HocrParser()
+    parser.feed(data)
+    parser.close()
+    return Layout(parser.width, parser.height, [line for line in parser.lines if line.words])
@@ -2,13 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import shutil
+import inspect
 import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import join
 import logging
 import sys
-import copy 
 import re
+import time
 
 from .input import pdftotext
 from .input import pdfminer_wrapper
@@ -17,13 +21,29 @@ from .input import tesseract4
 from .input import gvision
 from .input import txt
 from .input import png
+from .input import hocr
 
-from invoice2data.extract.loader import read_templates
+from invoice2data.extract.loader import read_templates, load_templates
+from invoice2data.extract import regex_engine
+from invoice2data.extract.columns import LineColumns
+from invoice2data.extract.keyword_index import KeywordIndex
+from invoice2data.extract import parsers
 
 from .output import to_csv
 from .output import to_json
 from .output import to_xml
+from .output import to_sqlite
 from invoice2data.decorators import timeit
+from invoice2data import template_profiler
+from invoice2data import evaluate
+from invoice2data import retest
+from invoice2data import worker
+from invoice2data.manifest import Manifest, DONE, FAILED
+from invoice2data.utils import file_hash, iter_files
+from invoice2data.dedup import DuplicateIndex
+from invoice2data.background_io import BackgroundIO
+from invoice2data.profiling import MODES, Profiler
+from invoice2data.memory import NULL_STAGE, MemoryTracker, format_summary
 
 
 logger = logging.getLogger(__name__)
@@ -36,14 +56,331 @@ input_mapping = {
     "gvision": gvision,
     "txt": txt,
     "png": png,
+    "hocr": hocr,
 }
 
-output_mapping = {"csv": to_csv, "json": to_json, "xml": to_xml, "none": None}
-cmdlist_psm3 = ["tesseract", "-c", "tessedit_char_whitelist=/.: abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"]
-cmdlist_psm6 = ["tesseract", "-l", "eng", "--oem", "1", "--psm", "6", "-c", "tessedit_char_whitelist=#-/%.:, abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"]
+# Sub-commands, e.g. `invoice2data profile-templates ...`. Anything else is
+# handled by the regular extraction command line.
+command_mapping = {"profile-templates": template_profiler.main, "evaluate": evaluate.main,
+                   "retest": retest.main, "worker": worker.main, "enqueue": worker.enqueue_main}
+
+output_mapping = {"csv": to_csv, "json": to_json, "xml": to_xml, "sqlite": to_sqlite, "none": None}
+
+
+class ExtractionResult(object):
+    """
+    Outcome of extracting one invoice.
+
+    Attributes
+    ----------
+    path : str
+        extracted file
+    template : InvoiceTemplate or None
+        template used
+    identified_by : str or None
+        how the template was found: "tid", "header_region", "quick_ocr" or
+        "keywords"
+    output : dict or None
+        extracted fields, None if the template's required fields are missing
+    missed, corrected, issue_lines, qtyerr, noofitem
+        line item reconciliation, see `post_process`
+    timings : dict
+        seconds spent per stage: "identify", "ocr" and "extract"
+    text : str or None
+        OCR/PDF text, if the extractor keeps it
+    memory : dict
+        peak, net allocations and RSS per stage and of the whole
+        "invoice", with memory accounting enabled (see `MemoryTracker`)
+    error : str or None
+        exception raised while extracting
+    """
+
+    __slots__ = ("path", "template", "identified_by", "output", "missed", "corrected", "issue_lines", "qtyerr",
+                 "noofitem", "timings", "text", "memory", "error")
+
+    def __init__(self, path):
+        self.path = path
+        self.template = None
+        self.identified_by = None
+        self.output = None
+        self.missed = -1
+        self.corrected = -1
+        self.issue_lines = []
+        self.qtyerr = ""
+        self.noofitem = -1
+        self.timings = {}
+        self.text = None
+        self.memory = {}
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None and bool(self.output)
+
+    @property
+    def template_name(self):
+        return self.template["template_name"] if self.template is not None else None
+
+    def stats(self):
+        """(missed, corrected, issue_lines, qtyerr, noofitem)"""
+        return self.missed, self.corrected, self.issue_lines, self.qtyerr, self.noofitem
+
+    def set_stats(self, stats):
+        self.missed, self.corrected, self.issue_lines, self.qtyerr, self.noofitem = stats
+
+    def __repr__(self):
+        return "<ExtractionResult %s template=%s ok=%s>" % (self.path, self.template_name, self.ok)
+
+
+class ExtractorMetrics(object):
+    """Counters of an `Extractor`, safe to update from several threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files = 0
+        self.extracted = 0
+        self.failed = 0
+        self.no_template = 0
+        self.reconciled = 0
+        self.seconds = {}
+
+    def add(self, result):
+        with self._lock:
+            self.files += 1
+            if result.error is not None:
+                self.failed += 1
+            elif result.template is None:
+                self.no_template += 1
+            elif result.output:
+                self.extracted += 1
+                if result.missed in (0, -1) and not result.issue_lines and result.qtyerr != "NoMatch":
+                    self.reconciled += 1
+            for stage, seconds in result.timings.items():
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def snapshot(self):
+        """Copy of the counters as dict"""
+        with self._lock:
+            return {
+                "files": self.files,
+                "extracted": self.extracted,
+                "failed": self.failed,
+                "no_template": self.no_template,
+                "reconciled": self.reconciled,
+                "seconds": dict(self.seconds),
+            }
+
+
+class Extractor(object):
+    """
+    Extracts invoices with a fixed set of templates.
+
+    Everything that doesn't depend on the invoice is prepared once: the
+    keyword and tid indexes, the templates' OCR profiles and compiled
+    regexes. `extract` doesn't modify shared state besides caches and
+    `metrics`, so one extractor can serve many threads.
+
+    Parameters
+    ----------
+    templates : list of InvoiceTemplate, optional
+        default: built-in templates
+    input_module : str or module
+        key of `input_mapping` or input module
+    cmdlist, conv_cmdlist : sequence of str, optional
+        OCR commands for templates that don't set them, see `OCRProfile`
+    two_pass : bool
+        without tid, identify the template by a quick OCR of a downscaled
+        image (png input only)
+    force_commands : bool
+        use cmdlist and conv_cmdlist for all templates, ignoring their OCR
+        options and alternatives, e.g. to compare OCR configs
+    keep_text : bool
+        keep the OCR/PDF text in `ExtractionResult.text`
+    profiler : invoice2data.profiling.Profiler, optional
+        profiles every extraction
+    memory : invoice2data.memory.MemoryTracker, optional
+        records memory used per invoice and stage in `ExtractionResult.memory`
+    """
+
+    def __init__(self, templates=None, input_module="png", cmdlist=None, conv_cmdlist=None, two_pass=False,
+                 force_commands=False, keep_text=False, profiler=None, memory=None):
+        self.templates = list(templates) if templates is not None else read_templates()
+        if isinstance(input_module, str):
+            input_module = input_mapping[input_module]
+        self.input_module = input_module
+        # Only OCR readers take commands
+        self.takes_commands = "cmdlist" in inspect.signature(input_module.to_text).parameters
+        self.cmdlist = tuple(cmdlist) if cmdlist else None
+        self.conv_cmdlist = tuple(conv_cmdlist) if conv_cmdlist else None
+        self.two_pass = two_pass
+        self.force_commands = force_commands
+        self.keep_text = keep_text
+        self.profiler = profiler
+        self.memory = memory
+        self.keyword_index = KeywordIndex(self.templates)
+        # Invoices not identified before OCR also get word boxes, from the
+        # same OCR run, if any template may need them
+        self.any_layout = any(t.needs_layout() for t in self.templates)
+        self.tid_index = {}
+        for t in self.templates:
+            for tid in t.options.get("tid", []):
+                self.tid_index.setdefault(str(tid), t)
+        self.metrics = ExtractorMetrics()
+
+    def commands(self, t):
+        """(cmdlist, conv_cmdlist) to OCR an invoice of template t (or None)"""
+        if t is None or self.force_commands:
+            return self.cmdlist, self.conv_cmdlist
+        return t.ocr_profile.commands(self.cmdlist, self.conv_cmdlist)
+
+    def template_for_tid(self, tid):
+        return self.tid_index.get(str(tid)) if tid is not None else None
+
+    def extract(self, source, tid=None, suffix=""):
+        """Extract an invoice given as path or as bytes.
+
+        Parameters
+        ----------
+        source : str or bytes
+            path of the invoice, or its content
+        tid : str, optional
+            id of the template to use, skips identification
+        suffix : str
+            file extension of `source` given as bytes, e.g. ".png"
+
+        Returns
+        -------
+        ExtractionResult
+        """
+        if not isinstance(source, bytes):
+            return self._extract(source, tid)
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(source)
+            return self._extract(path, tid)
+        finally:
+            os.remove(path)
+
+    def _extract(self, path, tid):
+        result = ExtractionResult(path)
+        try:
+            with self._stage(result, "invoice"):
+                if self.profiler is not None:
+                    self.profiler.run(path, self._run, path, tid, result)
+                else:
+                    self._run(path, tid, result)
+        except Exception as ex:
+            logger.error("Exception occured in invoice conversion " + str(ex))
+            result.error = str(ex)
+        self.metrics.add(result)
+        return result
+
+    def _stage(self, result, name):
+        """Memory accounting of a stage, if enabled"""
+        if self.memory is None:
+            return NULL_STAGE
+        if name == "invoice":
+            return self.memory.invoice(result.memory, result.path)
+        return self.memory.stage(result.memory, name)
+
+    def _ocr(self, path, t, result, cmdlist, conv_cmdlist):
+        """Return (text, layout), layout only if the template, or without one any template, needs it"""
+        input_module = self.input_module
+        started = time.perf_counter()
+        layout = None
+        needs_layout = t.needs_layout() if t is not None else self.any_layout
+        with self._stage(result, "ocr"):
+            if needs_layout and hasattr(input_module, "to_text_and_layout"):
+                # Plain text for keyword matching and extraction, boxes from the same OCR run
+                extracted_str, layout = input_module.to_text_and_layout(path, cmdlist=cmdlist,
+                                                                        conv_cmdlist=conv_cmdlist)
+                extracted_str = extracted_str.decode("utf-8")
+            elif needs_layout and t is not None and hasattr(input_module, "to_layout"):
+                # Keep word and line boxes, for the boxes parser or to OCR rows again
+                layout = input_module.to_layout(path, cmdlist=cmdlist, conv_cmdlist=conv_cmdlist)
+                extracted_str = layout.text()
+            elif self.takes_commands:
+                extracted_str = input_module.to_text(path, cmdlist=cmdlist, conv_cmdlist=conv_cmdlist)
+                extracted_str = extracted_str.decode("utf-8")
+            else:
+                extracted_str = input_module.to_text(path).decode("utf-8")
+        result.timings["ocr"] = result.timings.get("ocr", 0.0) + time.perf_counter() - started
+        return extracted_str, layout
+
+    def _run(self, path, tid, result):
+        input_module = self.input_module
+        logger.info("Input tid is %s and Input module is %s", tid, input_module.__name__)
+
+        started = time.perf_counter()
+        with self._stage(result, "identify"):
+            t = self.template_for_tid(tid)
+            if t is not None:
+                result.identified_by = "tid"
+                logger.info("Template found based on tid %s %s", tid, t["issuer"])
+            if t is None and hasattr(input_module, "region_to_text"):
+                t = identify_template(path, self.templates, input_module)
+                result.identified_by = "header_region" if t is not None else None
+            if t is None and self.two_pass and hasattr(input_module, "fast_to_text"):
+                fast_str = input_module.fast_to_text(path).decode("utf-8")
+                t, _ = self.keyword_index.find(fast_str)
+                result.identified_by = "quick_ocr" if t is not None else None
+                logger.info("Quick OCR pass found template %s", t["template_name"] if t else None)
+        result.timings["identify"] = time.perf_counter() - started
+
+        if t is not None and t.options["ocr_alternatives"] and not self.force_commands:
+            result.template = t
+            started = time.perf_counter()
+            with self._stage(result, "ocr"):
+                raced = race_ocr(path, t, input_module, self.cmdlist, self.conv_cmdlist)
+            result.timings["ocr"] = time.perf_counter() - started
+            result.output = raced[0]
+            result.set_stats(raced[1:])
+            return
+
+        cmdlist, conv_cmdlist = self.commands(t)
+        extracted_str, layout = self._ocr(path, t, result, cmdlist, conv_cmdlist)
+        if self.keep_text:
+            result.text = extracted_str
+        logger.info("OCR time: identify %.2fs, full %.2fs", result.timings["identify"], result.timings["ocr"])
+
+        logger.debug("START pdftotext result ===========================")
+        logger.debug(extracted_str)
+        logger.debug("END pdftotext result =============================")
+
+        started = time.perf_counter()
+        if t is None:
+            t, optimized_str = self.keyword_index.find(extracted_str)
+            if t is None:
+                logger.error("No template for %s", path)
+                return
+            result.identified_by = "keywords"
+            if not t.needs_layout():
+                layout = None
+            elif layout is None and hasattr(input_module, "to_layout"):
+                # Reader without to_text_and_layout
+                cmdlist, conv_cmdlist = self.commands(t)
+                layout = self._ocr(path, t, result, cmdlist, conv_cmdlist)[1]
+                started = time.perf_counter()
+        else:
+            optimized_str = t.prepare_input(extracted_str)
+        result.template = t
+        with self._stage(result, "extract"):
+            output = result.output = t.extract(optimized_str, layout=layout)
+        if output and "decimal" in t.options:
+            with self._stage(result, "post_process"):
+                mismatched = []
+                stats = post_process(output, t.options, mismatched)
+                if mismatched and layout is not None:
+                    replaced = reocr_lines(path, t, output, layout, input_module, mismatched)
+                    stats = merge_replaced_stats(stats, replaced, output, t.options)
+                result.set_stats(stats)
+        result.timings["extract"] = time.perf_counter() - started
+
 
 @timeit
-def extract_data(invoicefile, templates=None, input_module="png", cmdlist=None, conv_cmdlist=None, tid=None):
+def extract_data(invoicefile, templates=None, input_module="png", cmdlist=None, conv_cmdlist=None, tid=None,
+                 two_pass=False, timings=None, profiler=None):
     """Extracts structured data from PDF/image invoices.
 ˜
     This function uses the text extracted from a PDF file or image and
@@ -52,6 +389,9 @@ def extract_data(invoicefile, templates=None, input_module="png", cmdlist=None,
     Reads template if no template assigned
     Required fields are matches from templates
 
+    Use `Extractor` to extract many invoices with the same settings, it
+    only prepares templates once and returns an `ExtractionResult`.
+
     Parameters
     ----------
     invoicefile : str
@@ -60,11 +400,21 @@ def extract_data(invoicefile, templates=None, input_module="png", cmdlist=None,
         Templates are loaded using `read_template` function in `loader.py`
     input_module : {'pdftotext', 'pdfminer', 'tesseract'}, optional
         library to be used to extract text from given `invoicefile`,
+    two_pass : bool, optional
+        without tid, identify the template by a quick OCR of a downscaled
+        image, then OCR again with the template settings (png input only)
+    timings : dict, optional
+        filled with seconds spent in "identify" (OCR to find the template),
+        "ocr" (OCR of the whole invoice) and "extract"
+    profiler : invoice2data.profiling.Profiler, optional
+        profiles the extraction, see `invoice2data.profiling`
 
     Returns
     -------
-    dict or False
-        extracted and matched fields or False if no template matches
+    dict, tuple or False
+        extracted fields if the template was found by its keywords,
+        (output, missed, corrected, issue_lines, qtyerr, noofitem) if it
+        was known before OCR, False on errors
 
     Notes
     -----
@@ -85,71 +435,252 @@ def extract_data(invoicefile, templates=None, input_module="png", cmdlist=None,
      'currency': 'INR', 'desc': 'Invoice IBZY2087 from OYO'}
 
     """
-    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
     try:
-        t = None
-        if templates is None:
-            templates = read_templates()
+        extractor = Extractor(templates, input_module, cmdlist, conv_cmdlist, two_pass, profiler=profiler)
+    except Exception as ex:
+        logger.error("Exception occured in invoice conversion " + str(ex))
+        return False
+    result = extractor.extract(invoicefile, tid)
+    if timings is not None:
+        timings.update(result.timings)
+    if result.error is not None:
+        return False
+    if result.identified_by == "keywords":
+        return result.output
+    return ((result.output if result.template is not None else []),) + result.stats()
+
+
+def reconciliation_score(result, options):
+    """Sort key of an extraction result, (0, 0, 0, 0) if it fully reconciles.
+
+    Counts missing output, missed lines, lines where qty * rate != total and
+    a total quantity mismatch, as reported by `post_process`. Templates
+    without the decimal option are not reconciled, any output will do.
+    """
+    output, missed, corrected, issue_lines, qtyerr, noofitem = result
+    if not output:
+        return (1, 0, 0, 0)
+    if "decimal" not in options:
+        return (0, 0, 0, 0)
+    return (0, abs(missed), len(issue_lines), int(qtyerr == "NoMatch"))
+
+
+def _ocr_attempt(invoicefile, t, input_module, options, profile, cmdlist, conv_cmdlist, cancel):
+    cmdlist, conv_cmdlist = profile.commands(cmdlist, conv_cmdlist)
+    kwargs = {}
+    if "cancel" in inspect.signature(input_module.to_text).parameters:
+        kwargs["cancel"] = cancel
+    layout = None
+    if t.needs_layout() and hasattr(input_module, "to_layout"):
+        layout = input_module.to_layout(invoicefile, cmdlist=cmdlist, conv_cmdlist=conv_cmdlist, **kwargs)
+        extracted_str = layout.text()
+    else:
+        extracted_str = input_module.to_text(invoicefile, cmdlist=cmdlist, conv_cmdlist=conv_cmdlist, **kwargs)
+        extracted_str = extracted_str.decode("utf-8")
+    if cancel.is_set():
+        return None
+    output = t.extract(t.prepare_input(extracted_str), layout=layout)
+    if output and "decimal" in options:
+        return (output,) + tuple(post_process(output, options))
+    return output, -1, -1, [], "", -1
 
-        input_module = input_mapping[input_module]
-        
-        logger.error("Input tid is %s and Input module is %s", tid, input_module)
-        for tt in templates:
-            if t != None:
+
+def race_ocr(invoicefile, t, input_module, cmdlist=None, conv_cmdlist=None, max_workers=None):
+    """OCR with the template config and its `ocr_alternatives` concurrently.
+
+    Every result is scored with `reconciliation_score`. The first one that
+    fully reconciles wins, OCR still running for the others is killed
+    (if the input module supports `cancel`) and pending ones never start.
+    Without such a result, the best scoring one is returned.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        number of configs OCRed at once. Default: number of CPUs
+
+    Returns
+    -------
+    tuple
+        (output, missed, corrected, issue_lines, qtyerr, noofitem), like
+        `extract_data` with a known template
+    """
+    configs = [{}] + list(t.options["ocr_alternatives"])
+    cancel = threading.Event()
+    best = None
+    pool = ThreadPoolExecutor(max_workers=min(len(configs), max_workers or os.cpu_count() or 1))
+    futures = {}
+    try:
+        for index, (config, profile) in enumerate(zip(configs, t.ocr_profiles)):
+            options = dict(t.options, **config)
+            future = pool.submit(_ocr_attempt, invoicefile, t, input_module, options, profile, cmdlist, conv_cmdlist,
+                                 cancel)
+            futures[future] = index
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as ex:
+                logger.error("OCR config %d of %s failed: %s", futures[future], t["template_name"], ex)
+                continue
+            if result is None:
+                continue
+            score = reconciliation_score(result, t.options)
+            logger.info("OCR config %d of %s scored %s", futures[future], t["template_name"], score)
+            if best is None or score < best[0]:
+                best = (score, futures[future], result)
+            if score == (0, 0, 0, 0):
                 break
-            if "tid" in tt.options:
-                for tid_option in tt.options["tid"]:
-                    if str(tid_option) == tid:
-                        t = tt
-                        logger.error(f'Template found based on tid {t.options["tid"]} {t["issuer"]}')
-                        
-                
-        if t != None and "psm" in t.options:
-            logger.error("PSM is %d", t.options["psm"])
-            if str(t.options["psm"]) == "3":
-                cmdlist = copy.deepcopy(cmdlist_psm3)
-            else:
-                cmdlist_psm6[6] = str(t.options["psm"])
-                cmdlist = copy.deepcopy(cmdlist_psm6)
-        
-        if t!=None and "imgcmd" in t.options:
-            logger.error("imgcmd is %s", t.options["imgcmd"])
-            conv_cmdlist = t.options["imgcmd"]
-            
-        # print(templates[0])
-        extracted_str = input_module.to_text(invoicefile, cmdlist=cmdlist, conv_cmdlist=conv_cmdlist).decode("utf-8")
+    finally:
+        cancel.set()
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=True)
 
-        logger.debug("START pdftotext result ===========================")
-        logger.error(extracted_str)
-        logger.debug("END pdftotext result =============================")
+    if best is None:
+        return None, -1, -1, [], "", -1
+    logger.info("Using OCR config %d of %s", best[1], t["template_name"])
+    return best[2]
 
-        logger.debug("Testing {} template files".format(len(templates)))
-        missed = -1
-        corrected = -1
-        issue_lines = []
-        qtyerr = ""
-        noofitem = -1
-        output = []
-        if t == None:
-            for t in templates:
-                optimized_str = t.prepare_input(extracted_str)
-
-                if t.matches_input(optimized_str):
-                    return t.extract(optimized_str)
-        else:
-            optimized_str = t.prepare_input(extracted_str) 
-            output = t.extract(optimized_str)
-            if t != None and "decimal" in t.options:
-                missed, corrected, issue_lines, qtyerr, noofitem = post_process(output, t.options)
-            
-            return output, missed, corrected, issue_lines, qtyerr, noofitem
 
-        logger.error("No template for %s", invoicefile)
-        return output, missed, corrected, issue_lines, qtyerr, noofitem
-    except Exception as ex:
-        logger.error("Exception occured in invoice conversion "+ str(ex))
+def _lines_settings(t):
+    if "lines" in t:
+        return t["lines"]
+    settings = t["fields"].get("lines")
+    if isinstance(settings, dict) and settings.get("parser") == "lines":
+        return settings
+    return None
+
+
+def reocr_lines(invoicefile, t, output, layout, input_module, mismatched):
+    """OCR line items where qty * rate != total again, one row at a time.
+
+    The rows are found in `layout` (from `to_layout`) by the `lines` regexes.
+    Only the part of a row right of the description is cropped, upscaled by
+    the `reocr_scale` option and OCRed as a single line restricted to the
+    `reocr_whitelist` characters. The row is parsed again with the `lines`
+    settings and replaces the old one if qty * rate now matches total
+    without correction.
+
+    Parameters
+    ----------
+    output : dict
+        result of `InvoiceTemplate.extract`, its lines are updated in place
+    layout : invoice2data.layout.Layout
+        lines and boxes of the OCRed invoice
+    mismatched : list of int
+        rows not matching before correction, as filled by `post_process`
+
+    Returns
+    -------
+    list of int
+        replaced rows, numbered like `mismatched`, they were post processed
+        and match without correction
+    """
+    settings = _lines_settings(t)
+    if settings is None or "first_line" in settings or "last_line" in settings:
+        logger.info("Can't OCR rows again, template %s has no single line items", t["template_name"])
+        return []
+    engine = t.engine
+    rows = []
+    started = False
+    for line in layout.lines:
+        text = t.prepare_input(line.text)
+        if not started:
+            started = engine.search(settings["start"], text) is not None
+        elif engine.search(settings["end"], text):
+            break
+        elif engine.search(settings["line"], text):
+            rows.append(line)
+    if len(rows) != len(output["lines"]):
+        logger.info("Found %d rows for %d line items, not OCRing rows again", len(rows), len(output["lines"]))
+        return []
+    # post_process skips, and doesn't count, items without description
+    described = [index for index, item in enumerate(output["lines"]) if "description" in item]
+
+    cmdlist = ["tesseract", "--psm", "7", "-c", "tessedit_char_whitelist=" + t.options["reocr_whitelist"]]
+    single_row = dict(settings, start=r"\A", end=r"\Z")
+    replaced = []
+    for count in mismatched:
+        item = output["lines"][described[count]]
+        line = rows[described[count]]
+        # Keep what precedes the numbers, the whitelist would garble it
+        end = t.prepare_input(line.text).find(item["description"])
+        if end == -1:
+            continue
+        end += len(item["description"])
+        prefix = []
+        for word in line.words:
+            if len(" ".join(w.text for w in prefix)) >= end:
+                break
+            prefix.append(word)
+        numbers = line.words[len(prefix):]
+        if not numbers:
+            continue
+        box = (numbers[0].left, line.box[1], line.box[2], line.box[3])
+        region = layout.region(box, pad=max(2, (box[3] - box[1]) // 4))
+        text = input_module.region_to_text(invoicefile, region, cmdlist, scale=t.options["reocr_scale"])
+        text = " ".join(w.text for w in prefix) + " " + text.decode("utf-8").strip()
+        parsed = parsers.lines.parse(t, single_row, t.prepare_input(text))
+        if not parsed or len(parsed) != 1 or "description" not in parsed[0]:
+            continue
+        candidate = dict(parsed[0])
+        candidate_mismatched = []
+        try:
+            post_process({"lines": [candidate]}, t.options, candidate_mismatched)
+        except (KeyError, ValueError, ZeroDivisionError):
+            continue
+        if candidate_mismatched:
+            logger.info("Row %r still doesn't match after OCR: %r", line.text, text)
+            continue
+        logger.info("Row %r replaced by %r", line.text, text)
+        for name, value in candidate.items():
+            item[name] = value
+        replaced.append(count)
+    return replaced
+
+
+def merge_replaced_stats(stats, replaced, output, options):
+    """Update the stats of `post_process` for rows replaced by `reocr_lines`.
+
+    Replaced rows were post processed on their own, so the rest of the
+    output isn't processed again. They now match: they leave the issue
+    lines, or no longer count as corrected. The total quantity is checked
+    again as their quantities changed.
+
+    Returns
+    -------
+    tuple
+        stats in the order returned by `post_process`
+    """
+    missed, corrected, issue_lines, qtyerr, noofitem = stats
+    if not replaced:
+        return stats
+    for count in replaced:
+        if count in issue_lines:
+            issue_lines.remove(count)
+        elif options['correction_priority'] == 'qty':
+            corrected -= 1
+    if 'totalqty' in output:
+        qtyerr, totalqty = test_qty_basedontotalqty(output, output['totalqty'])
+    return missed, corrected, issue_lines, qtyerr, noofitem
 
-    return False
+
+def identify_template(invoicefile, templates, input_module):
+    """Find template by OCRing only the header regions templates declare.
+
+    Each distinct `header_region` is OCRed once, with a generic config, and
+    matched against the keywords of the templates using it. Returns None if
+    no template matches, then the whole page has to be OCRed.
+    """
+    texts = {}
+    for t in templates:
+        if t.header_region is None:
+            continue
+        if t.header_region not in texts:
+            texts[t.header_region] = input_module.region_to_text(invoicefile, t.header_region).decode("utf-8")
+        if t.matches_input(t.prepare_input(texts[t.header_region])):
+            logger.info("Template %s found in header region %s", t["template_name"], t.header_region)
+            return t
+    return None
 
 
 def create_parser():
@@ -192,6 +723,38 @@ def create_parser():
         "--debug", dest="debug", action="store_true", help="Enable debug information."
     )
 
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        help="Profile each file and write the profiles to this folder: collapsed stacks for flame graphs, "
+        "or cProfile stats with --profile-mode cprofile.",
+    )
+
+    parser.add_argument(
+        "--memory",
+        dest="memory",
+        action="store_true",
+        help="Trace memory allocations and log peak, net allocations and RSS per file and stage. Needs Python 3.9.",
+    )
+
+    parser.add_argument(
+        "--memory-threshold",
+        dest="memory_threshold",
+        type=float,
+        default=None,
+        help="With --memory, log the top allocation sites of stages peaking above this many MB. Snapshots "
+        "allocations at the start of every file, off by default",
+    )
+
+    parser.add_argument(
+        "--profile-mode",
+        dest="profile_mode",
+        choices=MODES,
+        default="sample",
+        help="sample: sampled stacks per stage, including subprocess waits. cprofile: deterministic, "
+        "one file at a time. Default: sample",
+    )
+
     parser.add_argument(
         "--copy",
         "-c",
@@ -229,11 +792,105 @@ def create_parser():
         action="store_true",
     )
 
+    parser.add_argument(
+        "--regex-engine",
+        dest="regex_engine",
+        choices=regex_engine.ENGINE_MAPPING.keys(),
+        help="Regex engine for templates without the regex_engine option. Default: re",
+    )
+
+    parser.add_argument(
+        "--regex-timeout",
+        dest="regex_timeout",
+        type=float,
+        help="Timeout in seconds per regex call, only used by the regex engine.",
+    )
+
+    parser.add_argument(
+        "--two-pass",
+        dest="two_pass",
+        default=False,
+        action="store_true",
+        help="Without --tid, find the template with a quick low resolution OCR pass, "
+        "then OCR again with the template settings.",
+    )
+
+    parser.add_argument(
+        "--manifest",
+        dest="manifest",
+        help="Record each processed file (hash, tid, status, result location) in this file. "
+        "Default with --resume: <output-name>.manifest.jsonl",
+    )
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        default=False,
+        action="store_true",
+        help="Skip files the manifest lists as completed, retry failed ones.",
+    )
+
+    parser.add_argument(
+        "--dedup",
+        dest="dedup",
+        default=False,
+        action="store_true",
+        help="Reuse the result of an earlier file with identical content instead of processing it again.",
+    )
+
+    parser.add_argument(
+        "--dedup-perceptual",
+        dest="dedup_perceptual",
+        default=False,
+        action="store_true",
+        help="With --dedup, also match re-encoded copies of images by perceptual hash (same tid only).",
+    )
+
+    parser.add_argument(
+        "--dedup-distance",
+        dest="dedup_distance",
+        type=int,
+        default=0,
+        help="Maximum differing bits of perceptual hashes to count as duplicate. Default: 0",
+    )
+
+    parser.add_argument(
+        "--dedup-window",
+        dest="dedup_window",
+        type=int,
+        default=10000,
+        help="Number of recent results kept for duplicate detection. Default: 10000",
+    )
+
+    parser.add_argument(
+        "--io-queue",
+        dest="io_queue",
+        type=int,
+        default=100,
+        help="Number of processed files waiting to be copied, moved or stored before extraction pauses. "
+        "Default: 100",
+    )
+
+    parser.add_argument(
+        "--extension",
+        dest="extensions",
+        action="append",
+        help="Only take files with this extension from directories and glob patterns, e.g. .pdf. "
+        "Can be given several times. Default: all files",
+    )
+
+    parser.add_argument(
+        "--tid-pattern",
+        dest="tid_pattern",
+        help="Only process files whose name matches this regex. If it has a group, "
+        "the group is the tid of the file, instead of --tid.",
+    )
+
     parser.add_argument(
         "input_files",
-        type=argparse.FileType("r"),
         nargs="+",
-        help="File or directory to analyze.",
+        help="Files, directories (searched recursively) or glob patterns to analyze. "
+        "Files are found and opened as they are processed.",
     )
 
     parser.add_argument(
@@ -264,8 +921,57 @@ def generate_output(output, output_name="invoices-output", output_date_format="%
         output_module = output_mapping[output_module]
         output_module.write_to_file(output, output_name, output_date_format)
 
+class _Missing(object):
+    """Field left out of a filename, whatever its format spec"""
+
+    def __format__(self, spec):
+        return ""
+
+
+class _FilenameFields(dict):
+    def __missing__(self, key):
+        return _Missing()
+
+
+def format_filename(filename_format, res):
+    """Name for a copied or moved file, fields missing in `res` are left out"""
+    fields = _FilenameFields((k, v) for k, v in res.items() if v is not None)
+    name = filename_format.format_map(fields)
+    # Spaces left by missing fields
+    name = re.sub(r" {2,}", " ", name).strip()
+    return re.sub(r" +(\.\w+)$", r"\1", name)
+
+
+def store_result(args, path, res, content_hash, tid, location, sqlite_writer, manifest):
+    """Store result of a processed file, copy or move it and mark it done"""
+    try:
+        if sqlite_writer is not None:
+            sqlite_writer.add(res, path, key=content_hash)
+        if args.copy:
+            filename = format_filename(args.filename, res)
+            shutil.copyfile(path, join(args.copy, filename))
+            location = location or join(args.copy, filename)
+        if args.move:
+            filename = format_filename(args.filename, res)
+            shutil.move(path, join(args.move, filename))
+            location = location or join(args.move, filename)
+        if manifest is not None:
+            if sqlite_writer is not None:
+                # Make sure the result is stored before marking it done
+                sqlite_writer.flush()
+            manifest.record(path, content_hash, DONE, tid=tid, location=location,
+                            result=res if sqlite_writer is None else None)
+    except Exception as ex:
+        if manifest is not None:
+            manifest.record(path, content_hash, FAILED, tid=tid, error=str(ex))
+        raise
+
+
 def main(args=None):
     """Take folder or single file and analyze each."""
+    if args is None and len(sys.argv) > 1 and sys.argv[1] in command_mapping:
+        return command_mapping[sys.argv[1]](sys.argv[2:])
+
     if args is None:
         parser = create_parser()
         args = parser.parse_args()
@@ -281,43 +987,125 @@ def main(args=None):
         imgcmd = args.imgcmd.split("+")
     else:
         imgcmd = None
-    templates = []
-    # Load templates from external folder if set.
-    if args.template_folder:
-        templates += read_templates(os.path.abspath(args.template_folder))
-
-    # Load internal templates, if not disabled.
-    if not args.exclude_built_in_templates:
-        templates += read_templates()
+    templates = load_templates(args.template_folder, not args.exclude_built_in_templates)
+
+    if args.regex_engine:
+        regex_engine.set_default_engine(args.regex_engine, args.regex_timeout)
+        for t in templates:
+            for pattern, reasons in t.check_regex_engine().items():
+                logger.warning("%s: %r not supported by %s engine (%s)",
+                               t["template_name"], pattern, t.engine.name, ", ".join(reasons))
+
+    memory = None
+    if args.memory:
+        try:
+            memory = MemoryTracker(args.memory_threshold * 1048576 if args.memory_threshold else None)
+        except RuntimeError as ex:
+            raise SystemExit("--memory: %s" % ex)
     output = []
+    # SQLite output is written as files are processed, not at the end.
+    sqlite_writer = None
+    if args.output_format == "sqlite":
+        sqlite_writer = to_sqlite.SQLiteWriter(args.output_name, args.output_date_format)
+
+    manifest = None
+    if args.manifest or args.resume:
+        manifest = Manifest(args.manifest or args.output_name + ".manifest.jsonl")
+    # Where results end up, if not in the output file written at the end
+    location = None
+    if sqlite_writer is not None:
+        location = sqlite_writer.path
+    elif args.output_format != "none":
+        location = args.output_name
+
+    duplicates = None
+    if args.dedup:
+        duplicates = DuplicateIndex(args.dedup_window, args.dedup_perceptual, args.dedup_distance)
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile, args.profile_mode)
+    extractor = Extractor(templates, args.input_reader, cmdlist, imgcmd, args.two_pass, profiler=profiler,
+                          memory=memory)
+    # Copies, moves and stored results, done while the next file is extracted
+    io = BackgroundIO(args.io_queue)
+    # Files of this run without a result, with missed line items or not stored
+    failed = 0
+    # Queued I/O, the manifest and the database are flushed even if the run
+    # is interrupted, the output file is only written for complete runs
+    completed = False
+    try:
+        tid_pattern = re.compile(args.tid_pattern) if args.tid_pattern else None
+        for path in iter_files(args.input_files, args.extensions):
+            tid = args.tid
+            if tid_pattern is not None:
+                match = tid_pattern.search(os.path.basename(path))
+                if not match:
+                    continue
+                if match.groups():
+                    tid = match.group(1)
+            content_hash = file_hash(path) if manifest is not None or duplicates is not None else None
+            if args.resume and manifest.is_done(content_hash):
+                logger.info("Skipping %s, already processed", path)
+                previous = manifest.result(content_hash)
+                if previous is not None:
+                    output.append(previous)
+                continue
 
-    for f in args.input_files:
-        res, missed, corrected, issue_lines, qtyerr, noofitem = extract_data(f.name, templates=templates, input_module=args.input_reader, cmdlist=cmdlist, conv_cmdlist=imgcmd, tid=args.tid)
-        if res:
-            logger.info(res)
-            output.append(res)
-            if args.copy:
-                filename = args.filename.format(
-                    #date=res["date"].strftime("%Y-%m-%d"),
-                    date=res["date"],
-                    invoice_number=res["invoice_number"],
-                    desc=res["desc"],
-                )
-                shutil.copyfile(f.name, join(args.copy, filename))
-            if args.move:
-                filename = args.filename.format(
-                    date=res["date"],
-                    invoice_number=res["invoice_number"],
-                    desc=res["desc"],
-                )
-                shutil.move(f.name, join(args.move, filename))
-        f.close()
-
-    generate_output(output, output_name=args.output_name, output_date_format=args.output_date_format, output_module=args.output_format)
-
-    sys.exit(missed)
-
-def post_process(output, options):
+            fingerprint = None
+            res = None
+            if duplicates is not None:
+                fingerprint = duplicates.fingerprint(path, tid, content_hash)
+                res = duplicates.find(fingerprint)
+                if res is not None:
+                    logger.info("%s is a duplicate, reusing earlier result", path)
+            if res is None:
+                result = extractor.extract(path, tid)
+                if memory is not None:
+                    logger.info("Memory of %s: %s", path, ", ".join(
+                        "%s peak %d net %d RSS %d" % (stage, m["peak"], m["net"], m["rss"])
+                        for stage, m in result.memory.items()))
+                if result.missed not in (0, -1):
+                    failed += 1
+                res = result.output if result.error is None else None
+                if fingerprint is not None and res:
+                    duplicates.add(fingerprint, res)
+            if res:
+                logger.info(res)
+                output.append(res)
+                io.submit(path, store_result, args, path, res, content_hash, tid, location, sqlite_writer, manifest)
+            else:
+                failed += 1
+                if manifest is not None:
+                    io.submit(path, manifest.record, path, content_hash, FAILED, tid)
+        completed = True
+    finally:
+        errors = io.close()
+        if errors:
+            logger.error("Storing %d of the processed files failed: %s", len(errors),
+                         ", ".join(name for name, ex in errors))
+            failed += len(errors)
+
+        if profiler is not None:
+            logger.info("Profiles written to %s, aggregated in %s", args.profile, profiler.close())
+
+        if manifest is not None:
+            manifest.close()
+
+        run_memory = {}
+        with memory.stage(run_memory, "output") if memory is not None else NULL_STAGE:
+            if sqlite_writer is not None:
+                # Results that couldn't be written are logged by the writer
+                failed += len(sqlite_writer.close())
+            elif completed:
+                generate_output(output, output_name=args.output_name, output_date_format=args.output_date_format,
+                                output_module=args.output_format)
+        if memory is not None:
+            logger.info("Memory per stage:\n%s", format_summary(memory.close()))
+
+    sys.exit(1 if failed else 0)
+
+def post_process(output, options, mismatched=None):
     option = options['decimal']
     pattern_qty = "(\d+)\W?(\d{%d}).*" % option[0]['qty']
     pattern_rate = "(\d+)\W?(\d{%d}).*" % option[0]['rate']
@@ -382,6 +1170,8 @@ def post_process(output, options):
 
             err, prod, tot = test_line_basedontotal(items)
             logger.info(f"Qty*rate = {prod} and total = {tot} -- {err} ")
+            if err == "NoMatch" and mismatched is not None:
+                mismatched.append(count)
 
             if (err == "NoMatch") and (options['correction_priority'] == 'qty'):
                 correct_qty(items)
@@ -434,9 +1224,12 @@ def test_line_basedontotal(line_item):
         return "NoMatch", product_of_qtyrate, total_of_item
 
 def test_qty_basedontotalqty(items, totalqty):
-    total_qty = 0.0
-    for line in items['lines']:
-        total_qty = total_qty + float(line['qty'])
+    lines = items['lines']
+    if isinstance(lines, LineColumns):
+        qtys = lines.column('qty')
+    else:
+        qtys = [line['qty'] for line in lines]
+    total_qty = sum(float(qty) for qty in qtys)
 
     if abs(total_qty - float(totalqty)) <= 1:
         return "Match", "{:.2f}".format(total_qty)
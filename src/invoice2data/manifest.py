@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint manifest for resumable batch runs.
+
+Every processed input gets a record with its content hash, tid, status
+and where its result went. Records are appended to a JSON lines file and
+flushed as soon as a file finishes, so a crashed or interrupted run can be
+resumed with `--resume`: completed files are skipped, failed ones retried.
+If results only live in an output file written at the end of the run
+(csv, json, xml), they are kept in the manifest to rebuild it.
+"""
+
+import datetime
+import json
+import logging
+import os
+
+from .extract.columns import LineColumns
+
+logger = logging.getLogger(__name__)
+
+DONE = "done"
+FAILED = "failed"
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _convert(o):
+    if isinstance(o, datetime.datetime):
+        return o.strftime(DATE_FORMAT)
+    if isinstance(o, LineColumns):
+        return o.to_dicts()
+    return str(o)
+
+
+def _restore_dates(result):
+    for k, v in result.items():
+        if (k.startswith("date") or k.endswith("date")) and isinstance(v, str):
+            try:
+                result[k] = datetime.datetime.strptime(v, DATE_FORMAT)
+            except ValueError:
+                pass
+    return result
+
+
+class Manifest(object):
+    """
+    Append-only log of processed inputs, keyed by content hash.
+
+    Parameters
+    ----------
+    path : str
+        JSON lines file. Existing records are loaded, the last record of
+        an input wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line may be cut off by a crash
+                        logger.warning("Skipping broken manifest line in %s", path)
+                        continue
+                    self.records[record["hash"]] = record
+        self.fp = open(path, "a")
+
+    def get(self, content_hash):
+        return self.records.get(content_hash)
+
+    def is_done(self, content_hash):
+        record = self.records.get(content_hash)
+        return record is not None and record["status"] == DONE
+
+    def record(self, path, content_hash, status, tid=None, location=None, result=None, error=None):
+        """Append record for a finished input and flush it to disk"""
+        record = {
+            "hash": content_hash,
+            "path": path,
+            "tid": tid,
+            "status": status,
+            "location": location,
+            "error": error,
+            "time": datetime.datetime.now().strftime(DATE_FORMAT),
+        }
+        if result is not None:
+            record["result"] = result
+        line = json.dumps(record, default=_convert, ensure_ascii=False)
+        self.fp.write(line + "\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        # Keep the serialized form, like a freshly loaded manifest
+        self.records[content_hash] = json.loads(line)
+        return record
+
+    def result(self, content_hash):
+        """Stored result of a completed input, with dates as datetime"""
+        record = self.records.get(content_hash)
+        if record is None or "result" not in record:
+            return None
+        return _restore_dates(dict(record["result"]))
+
+    def close(self):
+        self.fp.close()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Memory used per invoice and per stage, to size workers and find leaks.
+
+`MemoryTracker` traces Python allocations with tracemalloc. For every
+stage of an extraction ("identify", "ocr", "extract", "post_process", and
+"output" in the command line tool) it records:
+
+peak
+    bytes allocated at most during the stage, above what was allocated
+    when it started
+net
+    bytes still allocated after the stage, i.e. kept by it
+rss
+    resident set size of the process after the stage
+
+If a stage peaks above `threshold` bytes, the source lines holding the
+most memory, compared to the start of the invoice, are logged and kept
+in the record. tracemalloc is global: with several threads extracting at
+once, numbers of concurrent invoices mix. Peaks per stage need
+`tracemalloc.reset_peak`, i.e. Python 3.9 or later.
+"""
+
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        import resource
+
+        # Peak instead of current size, in KiB on Linux and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def process_memory():
+    """RSS, PSS and private memory of this process in bytes, as dict
+
+    PSS counts pages shared with other processes, e.g. forked workers,
+    divided by the number of sharers, private memory only pages no one
+    else maps. Both need Linux (/proc/self/smaps_rollup), they are None
+    elsewhere.
+    """
+    memory = {"rss": rss(), "pss": None, "private": None}
+    try:
+        with open("/proc/self/smaps_rollup") as fp:
+            # Skip the address range line
+            next(fp, None)
+            fields = dict(line.split(":", 1) for line in fp if ":" in line)
+    except (IOError, OSError):
+        return memory
+    kilobytes = {name: int(value.split()[0]) for name, value in fields.items() if value.strip().endswith("kB")}
+    memory["pss"] = kilobytes.get("Pss", 0) * 1024
+    memory["private"] = (kilobytes.get("Private_Clean", 0) + kilobytes.get("Private_Dirty", 0)) * 1024
+    return memory
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, tracker, record, name, label=None):
+        self.tracker = tracker
+        self.record = record
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.tracker._begin(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracker._end(self)
+        return False
+
+
+class MemoryTracker(object):
+    """
+    Records tracemalloc peaks, net allocations and RSS per stage.
+
+    Parameters
+    ----------
+    threshold : int, optional
+        bytes; stages peaking above it get their top allocation sites
+        logged and recorded
+    top : int
+        number of allocation sites recorded
+
+    Raises
+    ------
+    RuntimeError
+        before Python 3.9, where tracemalloc can only report the peak
+        since tracing started
+    """
+
+    def __init__(self, threshold=None, top=10):
+        if not hasattr(tracemalloc, "reset_peak"):
+            raise RuntimeError("memory accounting needs Python 3.9 or later (tracemalloc.reset_peak)")
+        self.threshold = threshold
+        self.top = top
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        self._lock = threading.RLock()
+        # Open stages, outermost first
+        self._open = []
+        self._snapshot = None
+        # stage -> [count, max peak, total net, max rss]
+        self.totals = OrderedDict()
+
+    def invoice(self, record, label):
+        """Context of a whole invoice, `record` (dict) gets the stages"""
+        return _Stage(self, record, "invoice", label)
+
+    def stage(self, record, name):
+        """Context of one stage of an invoice"""
+        return _Stage(self, record, name)
+
+    def _fold_peak(self):
+        """Pass the peak so far to all open stages and restart it"""
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self._open:
+            stage.peak = max(stage.peak, peak)
+        tracemalloc.reset_peak()
+
+    def _begin(self, stage):
+        with self._lock:
+            self._fold_peak()
+            if stage.label is None:
+                stage.label = self._open[0].label if self._open else "-"
+            stage.start = tracemalloc.get_traced_memory()[0]
+            stage.peak = stage.start
+            if stage.name == "invoice" and self.threshold is not None:
+                self._snapshot = tracemalloc.take_snapshot()
+            self._open.append(stage)
+
+    def _end(self, stage):
+        with self._lock:
+            self._fold_peak()
+            self._open.remove(stage)
+            current = tracemalloc.get_traced_memory()[0]
+            entry = OrderedDict(
+                [("peak", stage.peak - stage.start), ("net", current - stage.start), ("rss", rss())]
+            )
+            if self.threshold is not None and entry["peak"] > self.threshold:
+                entry["top"] = self._top_sites()
+                logger.warning(
+                    "%s of %s peaked at %.1f MB, top allocations:\n%s",
+                    stage.name,
+                    stage.label,
+                    entry["peak"] / 1048576.0,
+                    "\n".join("  %10d  %s" % (size, site) for site, size in entry["top"]),
+                )
+            stage.record[stage.name] = entry
+            totals = self.totals.setdefault(stage.name, [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] = max(totals[1], entry["peak"])
+            totals[2] += entry["net"]
+            totals[3] = max(totals[3], entry["rss"])
+            if stage.name == "invoice":
+                self._snapshot = None
+
+    def _top_sites(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        )
+        if self._snapshot is not None:
+            stats = snapshot.compare_to(self._snapshot, "lineno")
+            sizes = [(str(stat.traceback), stat.size_diff) for stat in stats]
+        else:
+            sizes = [(str(stat.traceback), stat.size) for stat in snapshot.statistics("lineno")]
+        return sorted(sizes, key=lambda item: -item[1])[:self.top]
+
+    def summary(self):
+        """Per stage: count, max peak, total net and max RSS as dict"""
+        with self._lock:
+            return OrderedDict(
+                (name, OrderedDict([("count", n), ("max_peak", peak), ("net", net), ("max_rss", max_rss)]))
+                for name, (n, peak, net, max_rss) in self.totals.items()
+            )
+
+    def close(self):
+        """Stop tracing if the tracker started it, return `summary`"""
+        summary = self.summary()
+        if self.started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return summary
+
+
+def format_summary(summary):
+    """Render `MemoryTracker.summary` as text"""
+    lines = []
+    for name, entry in summary.items():
+        megabytes = [entry[key] / 1048576.0 for key in ("max_peak", "net", "max_rss")]
+        lines.append("%-12s %6d  max peak %8.1f MB  net %8.1f MB  max RSS %8.1f MB"
+                     % tuple([name, entry["count"]] + megabytes))
+    return "\n".join(lines)
@@ -2,11 +2,15 @@ import json
 import datetime
 import codecs
 
+from ..extract.columns import LineColumns
+
 
 def myconverter(o):
-    """function to serialise datetime"""
+    """function to serialise datetime and columnar lines"""
     if isinstance(o, datetime.datetime):
         return o.__str__()
+    if isinstance(o, LineColumns):
+        return o.to_dicts()
 
 
 def write_to_file(data, path, date_format="%Y-%m-%d"):
@@ -0,0 +1,190 @@
+import json
+import sqlite3
+import hashlib
+import datetime
+import logging
+from collections import OrderedDict
+
+from ..extract.columns import LineColumns
+from ..utils import file_hash
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    file_hash TEXT PRIMARY KEY,
+    file_name TEXT,
+    issuer TEXT,
+    invoice_number TEXT,
+    date TEXT,
+    amount REAL,
+    currency TEXT,
+    description TEXT,
+    fields TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS line_items (
+    file_hash TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    fields TEXT NOT NULL,
+    PRIMARY KEY (file_hash, position)
+);
+"""
+
+
+class SQLiteWriter(object):
+    """Writes invoices and their line items to a SQLite database.
+
+    Invoices are keyed by the hash of the input file, so processing the same
+    file again replaces its rows. Rows are buffered and written with
+    `executemany` in one transaction per `batch_size` invoices. The database
+    uses WAL mode, so several workers can append to it at the same time.
+
+    Parameters
+    ----------
+    path : str
+        database file, created if missing. Appends .sqlite if missing.
+    date_format : str
+        Date format used for date fields
+    batch_size : int
+        number of invoices written per transaction
+
+    Examples
+    --------
+        >>> writer = SQLiteWriter("invoices.sqlite")
+        >>> writer.add(result, file_name="invoice.pdf")
+        >>> writer.close()
+
+    """
+
+    def __init__(self, path, date_format="%Y-%m-%d", batch_size=100, timeout=30):
+        self.date_format = date_format
+        self.batch_size = batch_size
+        self.pending = []
+        if not path.endswith(".sqlite"):
+            path = path + ".sqlite"
+        self.path = path
+        # May be created and used in different threads, but by one at a time
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def _convert(self, o):
+        if isinstance(o, (datetime.date, datetime.datetime)):
+            return o.strftime(self.date_format)
+        if isinstance(o, LineColumns):
+            return o.to_dicts()
+        return str(o)
+
+    def _dumps(self, value):
+        return json.dumps(value, default=self._convert, ensure_ascii=False, sort_keys=True)
+
+    def add(self, result, file_name=None, key=None):
+        """Queue one extraction result, keyed by `key` or the hash of `file_name`
+
+        Without both, the hash of the result itself is used.
+        """
+        if key is None:
+            if file_name is not None:
+                key = file_hash(file_name)
+            else:
+                key = hashlib.sha256(self._dumps(result).encode("utf-8")).hexdigest()
+        self.pending.append((key, file_name, result))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return key
+
+    def flush(self):
+        """Write queued results in a single transaction
+
+        If writing fails, e.g. the database stays locked, the results stay
+        queued for the next flush and the error is raised.
+        """
+        if not self.pending:
+            return
+        # A file queued twice is written once, with its last result
+        pending = OrderedDict()
+        for key, file_name, result in self.pending:
+            pending.pop(key, None)
+            pending[key] = (file_name, result)
+        self.pending = [(key, file_name, result) for key, (file_name, result) in pending.items()]
+        now = datetime.datetime.now().isoformat()
+        invoices = []
+        lines = []
+        for key, (file_name, result) in pending.items():
+            fields = dict((k, v) for k, v in result.items() if k != "lines")
+            amount = result.get("amount")
+            date = result.get("date")
+            invoices.append(
+                (
+                    key,
+                    file_name,
+                    result.get("issuer"),
+                    result.get("invoice_number"),
+                    self._convert(date) if date is not None else None,
+                    amount if isinstance(amount, (int, float)) else None,
+                    result.get("currency"),
+                    result.get("desc"),
+                    self._dumps(fields),
+                    now,
+                )
+            )
+            for position, line in enumerate(result.get("lines") or []):
+                lines.append((key, position, self._dumps(line.to_dict() if hasattr(line, "to_dict") else line)))
+        with self.conn:
+            self.conn.executemany("DELETE FROM line_items WHERE file_hash = ?", [(i[0],) for i in invoices])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", invoices
+            )
+            self.conn.executemany("INSERT INTO line_items VALUES (?, ?, ?)", lines)
+        self.pending = []
+
+    def close(self):
+        """Write queued results and close the database
+
+        Returns the keys of results given up because they couldn't be
+        written, they are logged with their files.
+        """
+        dropped = []
+        try:
+            self.flush()
+        except sqlite3.Error as ex:
+            dropped = [key for key, file_name, result in self.pending]
+            logger.error("Writing %d results to %s failed: %s, not stored: %s", len(dropped), self.path, ex,
+                         ", ".join(file_name or key for key, file_name, result in self.pending))
+            self.pending = []
+        self.conn.close()
+        return dropped
+
+
+def write_to_file(data, path, date_format="%Y-%m-%d", file_names=None):
+    """Export extracted fields to a SQLite database
+
+    Appends .sqlite to path if missing. Existing databases are updated, not
+    overwritten: invoices already stored for the same input are replaced.
+
+    Parameters
+    ----------
+    data : list of dict
+        Extracted fields per invoice
+    path : str
+        database file
+    date_format : str
+        Date format used for date fields
+    file_names : list of str, optional
+        input file of each invoice, used as key (hash of file content)
+
+    Examples
+    --------
+        >>> from invoice2data.output import to_sqlite
+        >>> to_sqlite.write_to_file(data, "/exported/invoices.sqlite", file_names=["invoice.pdf"])
+
+    """
+    writer = SQLiteWriter(path, date_format)
+    try:
+        for i, result in enumerate(data):
+            writer.add(result, file_names[i] if file_names else None)
+        writer.flush()
+    finally:
+        writer.close()
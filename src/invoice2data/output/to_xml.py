@@ -2,6 +2,8 @@ import xml.etree.ElementTree as ET
 import datetime
 from xml.dom import minidom
 
+from ..extract.columns import LineColumns
+
 
 def prettify(elem):
     """Return a pretty-printed XML string for the Element."""
@@ -19,8 +21,8 @@ def dict_to_tags(parent, data, date_format):
             tag.text = str(v)
         elif isinstance(v, datetime.date):
             tag.text = v.strftime(date_format)
-        elif isinstance(v, list):
-            for e in v:
+        elif isinstance(v, (list, LineColumns)):
+            for e in v.iter_dicts() if isinstance(v, LineColumns) else v:
                 item = ET.SubElement(tag, "item")
                 dict_to_tags(item, e, date_format)
 
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Prepare templates once, then fork workers sharing them.
+
+Forked processes share the memory pages of their parent until either
+writes to them. Templates loaded before forking would be shared by all
+workers, if Python didn't write to them: the cyclic garbage collector
+updates the header of every object it visits. `preload` loads everything
+workers need (compiled regexes, dateparser language data, keyword
+indexes), then moves all objects into the permanent generation with
+`gc.freeze`, where the collector leaves them alone. Reference counts are
+still written where objects are used, so the pages workers touch most
+get copied, but the bulk of template state stays shared.
+
+`fork_workers` forks the workers and collects what they return. Needs
+`os.fork`, i.e. not Windows.
+"""
+
+import gc
+import json
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Parsed once per template, loads dateparser's data for its languages
+WARM_UP_DATE = "01/02/2020"
+
+
+def warm_up(templates):
+    """Compile the regexes of templates and load their date parsing data"""
+    for t in templates:
+        engine = t.engine
+        for pattern in t.iter_patterns():
+            try:
+                engine.compile(pattern)
+            except Exception as ex:
+                logger.warning("Can't compile %r of %s: %s", pattern, t["template_name"], ex)
+        t.prepare_input(WARM_UP_DATE)
+        t.parse_date(WARM_UP_DATE)
+
+
+def preload(templates):
+    """Warm templates up and keep the garbage collector off them
+
+    Call right before forking, everything allocated so far is frozen.
+    """
+    warm_up(templates)
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    else:
+        logger.warning("gc.freeze needs Python 3.7, forked workers will copy more memory")
+
+
+def fork_workers(count, target):
+    """Fork `count` workers running target(index), return their results
+
+    `target` runs in the child, its return value must be JSON serializable;
+    it is sent back through a pipe. Failed workers return None.
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("forking workers needs os.fork, not available on %s" % sys.platform)
+    children = []
+    for index in range(count):
+        read_fd, write_fd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            code = 1
+            try:
+                result = target(index)
+                with os.fdopen(write_fd, "w") as fp:
+                    json.dump(result, fp)
+                code = 0
+            except BaseException:
+                logger.exception("Worker %d failed", index)
+            finally:
+                # Don't run the parent's exit handlers
+                os._exit(code)
+        os.close(write_fd)
+        children.append((pid, read_fd))
+
+    results = []
+    for index, (pid, read_fd) in enumerate(children):
+        with os.fdopen(read_fd) as fp:
+            data = fp.read()
+        _, status = os.waitpid(pid, 0)
+        if status != 0 or not data:
+            logger.error("Worker %d (pid %d) exited with status %d", index, pid, status)
+            results.append(None)
+        else:
+            results.append(json.loads(data))
+    return results
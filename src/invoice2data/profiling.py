@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Profile invoice extraction, for flame graphs or pstats.
+
+A `Profiler` wraps each extraction, in one of two modes:
+
+sample
+    A thread records the stack of the extracting thread every `interval`
+    seconds. Each run is written as collapsed stacks (`<run>.collapsed`,
+    one `frame;frame;frame count` line per stack), the format read by
+    flamegraph.pl, speedscope and inferno; `profile.collapsed` sums all
+    runs. Time spent waiting for tesseract or convert shows up as
+    `[subprocess wait]` leaves.
+cprofile
+    Each run is profiled by cProfile and written as `<run>.prof`;
+    `profile.pstats` aggregates all runs. Runs are serialized, cProfile
+    can't profile threads side by side.
+
+Sampled stacks are rooted at the stage they belong to, `[identify]`,
+`[ocr]` or `[extract]` (as in `ExtractionResult.timings`), so subprocess
+waits are counted for the OCR pass that started them. With cProfile the
+waits are part of the cumulative time of the stage functions
+(`identify_template`, `Extractor._ocr`, `race_ocr`, ...).
+
+Usage::
+
+    invoice2data --profile profiles/ invoice.png
+
+    with Profiler("profiles/") as profiler:
+        extractor = Extractor(profiler=profiler)
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+MODES = ("sample", "cprofile")
+
+# (file, function) where a stage starts, the innermost one on the stack wins
+STAGE_FUNCTIONS = {
+    ("main.py", "identify_template"): "identify",
+    ("png.py", "fast_to_text"): "identify",
+    ("main.py", "_ocr"): "ocr",
+    ("main.py", "race_ocr"): "ocr",
+    ("main.py", "reocr_lines"): "ocr",
+    ("invoice_template.py", "extract"): "extract",
+    ("main.py", "post_process"): "extract",
+}
+
+# Leaves where a thread waits for a child process
+WAIT_FUNCTIONS = {
+    ("subprocess.py", "communicate"),
+    ("subprocess.py", "_communicate"),
+    ("subprocess.py", "wait"),
+    ("subprocess.py", "_wait"),
+    ("subprocess.py", "_try_wait"),
+    ("selectors.py", "select"),
+}
+
+
+def _frame_key(code):
+    return os.path.basename(code.co_filename), code.co_name
+
+
+def collapse_stack(frame):
+    """Collapsed stack of a frame: stage, then frames from the outermost"""
+    names = []
+    stage = None
+    waiting = False
+    while frame is not None:
+        key = _frame_key(frame.f_code)
+        if not names:
+            waiting = key in WAIT_FUNCTIONS
+        if stage is None:
+            stage = STAGE_FUNCTIONS.get(key)
+        names.append("%s (%s:%d)" % (key[1], key[0], frame.f_code.co_firstlineno))
+        frame = frame.f_back
+    names.append("[%s]" % (stage or "other"))
+    names.reverse()
+    if waiting:
+        names.append("[subprocess wait]")
+    return ";".join(name.replace(";", ":") for name in names)
+
+
+class Profiler(object):
+    """
+    Profiles runs and writes one file per run plus an aggregate.
+
+    Safe to use from several threads, e.g. by a shared `Extractor`.
+
+    Parameters
+    ----------
+    folder : str
+        where profiles are written, created if missing
+    mode : {"sample", "cprofile"}
+    interval : float
+        seconds between samples
+    """
+
+    def __init__(self, folder, mode="sample", interval=0.005):
+        if mode not in MODES:
+            raise ValueError("Unknown profile mode %r, use one of %s" % (mode, ", ".join(MODES)))
+        self.folder = folder
+        self.mode = mode
+        self.interval = interval
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.runs = 0
+        self.stacks = Counter()
+        self.stats = None
+        self._lock = threading.Lock()
+        # cProfile can only profile one run at a time
+        self._cprofile_lock = threading.Lock()
+        # thread id -> stack counts of the run in that thread
+        self._active = {}
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def _run_name(self, name):
+        with self._lock:
+            self.runs += 1
+            return "%04d-%s" % (self.runs, os.path.basename(name).replace(os.sep, "_"))
+
+    def run(self, name, func, *args, **kwargs):
+        """Return func(*args, **kwargs), profiled as run `name`"""
+        run_name = self._run_name(name)
+        if self.mode == "cprofile":
+            return self._run_cprofile(run_name, func, args, kwargs)
+        return self._run_sampled(run_name, func, args, kwargs)
+
+    def _run_cprofile(self, run_name, func, args, kwargs):
+        with self._cprofile_lock:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                profile.dump_stats(os.path.join(self.folder, run_name + ".prof"))
+                with self._lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+
+    def _run_sampled(self, run_name, func, args, kwargs):
+        stacks = Counter()
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._active[thread_id] = stacks
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="invoice2data-profiler")
+                self._sampler.daemon = True
+                self._sampler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                del self._active[thread_id]
+                self.stacks.update(stacks)
+            write_collapsed(os.path.join(self.folder, run_name + ".collapsed"), stacks)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[collapse_stack(frame)] += 1
+
+    def close(self):
+        """Stop sampling and write the aggregated profile, return its path"""
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self.mode == "sample":
+            path = os.path.join(self.folder, "profile.collapsed")
+            write_collapsed(path, self.stacks)
+            return path
+        path = os.path.join(self.folder, "profile.pstats")
+        if self.stats is not None:
+            self.stats.dump_stats(path)
+        return path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_collapsed(path, stacks):
+    with open(path, "w") as fp:
+        for stack, count in sorted(stacks.items()):
+            fp.write("%s %d\n" % (stack, count))
+
+
+def read_collapsed(path):
+    """Read a collapsed stacks file as dict"""
+    stacks = {}
+    with open(path) as fp:
+        for line in fp:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            stacks[stack] = stacks.get(stack, 0) + int(count)
+    return stacks
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Re-run templates on cached OCR text while developing them.
+
+`invoice2data retest record` OCRs sample invoices once and keeps, per
+sample, the text, the template it was routed to, a hash of that template,
+the output and the expected output (`<name>.json` next to the sample, as
+written by `--output-format json`).
+
+`invoice2data retest run` loads the templates again and, for samples whose
+template changed since the last run, only runs `prepare_input`, `extract`
+and `post_process` on the cached text, in parallel. It prints a field
+level diff against the previous output and stores the new one. Samples
+without a template are matched against changed templates by keywords.
+With `--watch` it runs whenever a .yml file in the template folder is
+saved.
+
+Templates reading word boxes (the boxes parser) need the layout of the
+page and are not supported.
+
+Usage::
+
+    invoice2data retest record --cache retest/ --input-reader png --tid-pattern "^_(\\d+)_" bills/
+    invoice2data retest run --cache retest/ --template-folder my-templates --watch
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .evaluate import field_matches, load_truth, select_files
+from .extract.keyword_index import KeywordIndex
+from .extract.loader import load_templates
+from .output.to_json import myconverter
+from .utils import file_hash, walk_files
+
+logger = logging.getLogger(__name__)
+
+
+def _default(o):
+    value = myconverter(o)
+    return str(o) if value is None else value
+
+
+def to_json_value(output):
+    """Output as stored in the cache, dates and columns converted"""
+    return json.loads(json.dumps(output, default=_default))
+
+
+def template_hash(t):
+    """Hash of the template's content, changes whenever its .yml does"""
+    return hashlib.sha256(json.dumps(t, default=str).encode("utf-8")).hexdigest()
+
+
+def diff_outputs(old, new, prefix=""):
+    """List of (field, old, new) of values differing between two outputs
+
+    Line items are compared one by one, e.g. `lines[2].qty`.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for key in sorted(set(old) | set(new), key=str):
+            changes += diff_outputs(old.get(key), new.get(key), "%s.%s" % (prefix, key) if prefix else key)
+        return changes
+    if isinstance(old, list) and isinstance(new, list):
+        changes = []
+        for index in range(max(len(old), len(new))):
+            changes += diff_outputs(
+                old[index] if index < len(old) else None,
+                new[index] if index < len(new) else None,
+                "%s[%d]" % (prefix, index),
+            )
+        return changes
+    if old != new:
+        return [(prefix, old, new)]
+    return []
+
+
+class SampleCache(object):
+    """
+    Folder of cached samples, one JSON file each.
+
+    A sample is a dict with "source", "tid", "text", "template",
+    "template_hash", "output", "stats" and "expected".
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def samples(self):
+        samples = []
+        for path in sorted(walk_files(self.folder, (".json",))):
+            with open(path) as json_file:
+                sample = json.load(json_file)
+            sample["id"] = os.path.splitext(os.path.basename(path))[0]
+            samples.append(sample)
+        return samples
+
+    def save(self, sample):
+        path = os.path.join(self.folder, sample["id"] + ".json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(sample, json_file, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+def sample_id(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return "%s-%s" % (name, file_hash(path)[:12])
+
+
+def record(cache, extractor, files, workers=None):
+    """OCR files, a list of (path, tid), and store them as samples
+
+    Returns the number of samples stored.
+    """
+    stored = 0
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        results = pool.map(lambda item: extractor.extract(*item), files)
+        for (path, tid), result in zip(files, results):
+            if result.text is None:
+                logger.warning("No text of %s to cache (error or template with OCR alternatives)", path)
+                continue
+            t = result.template
+            stats = list(result.stats()) if t is not None and "decimal" in t.options else None
+            cache.save({
+                "id": sample_id(path),
+                "source": path,
+                "tid": tid,
+                "text": result.text,
+                "template": result.template_name,
+                "template_hash": template_hash(t) if t is not None else None,
+                "output": to_json_value(result.output),
+                "stats": stats,
+                "expected": load_truth(path),
+            })
+            stored += 1
+    return stored
+
+
+def rerun(t, text):
+    """(output, stats) of a template on cached text"""
+    from .main import post_process
+
+    if t.needs_layout():
+        logger.warning("%s needs word boxes, they are not cached", t["template_name"])
+    output = t.extract(t.prepare_input(text))
+    stats = None
+    if output and "decimal" in t.options:
+        stats = list(post_process(output, t.options))
+    return output, stats
+
+
+def changed_samples(templates, samples, names=None, rerun_all=False):
+    """(sample, template) of samples to run again
+
+    Samples of changed templates (or of `names`, or all with `rerun_all`)
+    and samples without a template matching a changed one.
+    """
+    hashes = {(s["template"], s["template_hash"]) for s in samples}
+    changed = {}
+    for t in templates:
+        name = t["template_name"]
+        if names:
+            selected = name in names
+        else:
+            current = template_hash(t)
+            selected = rerun_all or any(n == name and h != current for n, h in hashes)
+        if selected:
+            changed[name] = t
+    keyword_index = KeywordIndex(list(changed.values()))
+    selected = []
+    for sample in samples:
+        if sample["template"] is None:
+            t, _ = keyword_index.find(sample["text"])
+        else:
+            t = changed.get(sample["template"])
+        if t is not None:
+            selected.append((sample, t))
+    return selected
+
+
+def retest(cache, templates, names=None, rerun_all=False, workers=None, update=True):
+    """Run changed templates on their cached samples
+
+    Returns a report: per sample its template, the changed fields and the
+    fields not matching the expected output.
+    """
+    started = time.perf_counter()
+    selected = changed_samples(templates, cache.samples(), names, rerun_all)
+    report = OrderedDict()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        results = pool.map(lambda item: rerun(item[1], item[0]["text"]), selected)
+        for (sample, t), (output, stats) in zip(selected, results):
+            new_output = to_json_value(output)
+            expected = sample.get("expected") or {}
+            report[sample["id"]] = OrderedDict(
+                [
+                    ("source", sample["source"]),
+                    ("template", t["template_name"]),
+                    ("changes", diff_outputs(sample["output"], new_output)),
+                    ("stats", stats),
+                    ("wrong", sorted(k for k, v in expected.items() if not field_matches(v, (output or {}).get(k)))),
+                ]
+            )
+            if update:
+                sample.update(template=t["template_name"], template_hash=template_hash(t), output=new_output,
+                              stats=stats)
+                cache.save(sample)
+    logger.info("Ran %d samples in %.2fs", len(selected), time.perf_counter() - started)
+    return report
+
+
+def format_report(report):
+    """Render report as plain text"""
+    lines = []
+    for sid, entry in report.items():
+        status = "%d changed" % len(entry["changes"]) if entry["changes"] else "unchanged"
+        if entry["wrong"]:
+            status += ", not as expected: " + ", ".join(entry["wrong"])
+        lines.append("%s (%s): %s" % (sid, entry["template"], status))
+        for field, old, new in entry["changes"]:
+            lines.append("  %s: %r -> %r" % (field, old, new))
+    changed = sum(1 for entry in report.values() if entry["changes"])
+    lines.append("%d samples run, %d changed" % (len(report), changed))
+    return "\n".join(lines)
+
+
+def _templates_mtime(folder):
+    return max([os.stat(path).st_mtime for path in walk_files(folder, (".yml",))] or [0])
+
+
+def create_parser():
+    """Returns argument parser"""
+    parser = argparse.ArgumentParser(
+        prog="invoice2data retest",
+        description="Re-run changed templates on cached OCR text of sample invoices.",
+    )
+    parser.add_argument("--cache", required=True, help="Folder of cached samples.")
+    parser.add_argument(
+        "--template-folder",
+        "-t",
+        dest="template_folder",
+        help="Folder containing invoice templates in yml file. Always adds built-in templates.",
+    )
+    parser.add_argument(
+        "--exclude-built-in-templates",
+        dest="exclude_built_in_templates",
+        default=False,
+        help="Ignore built-in templates.",
+        action="store_true",
+    )
+    parser.add_argument("--workers", type=int, help="Samples processed in parallel. Default: number of CPUs")
+    parser.add_argument("--debug", action="store_true", help="Enable debug information.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    record_parser = commands.add_parser("record", help="OCR samples and cache their text and output.")
+    record_parser.add_argument("--input-reader", dest="input_reader", default="png", help="Default: png")
+    record_parser.add_argument("--tid", dest="tid", help="Use template with this tid for all files.")
+    record_parser.add_argument(
+        "--tid-pattern",
+        dest="tid_pattern",
+        help="Regex on the file name, group 1 is the tid of the file. Files not matching are skipped.",
+    )
+    record_parser.add_argument(
+        "--extension",
+        dest="extensions",
+        action="append",
+        help="Extension of files when walking folders, can be repeated. Default: all files",
+    )
+    record_parser.add_argument("input_files", nargs="+", help="Files, folders or glob patterns of invoices.")
+
+    run_parser = commands.add_parser("run", help="Run changed templates on cached samples.")
+    run_parser.add_argument(
+        "--template", dest="names", action="append", help="Run this template (file name), changed or not."
+    )
+    run_parser.add_argument("--all", dest="rerun_all", action="store_true", help="Run all samples.")
+    run_parser.add_argument("--dry-run", dest="dry_run", action="store_true", help="Don't store new outputs.")
+    run_parser.add_argument("--watch", action="store_true", help="Run again whenever a template is saved.")
+    run_parser.add_argument("--interval", type=float, default=1.0, help="Seconds between checks with --watch.")
+    return parser
+
+
+def run(argv=None):
+    """Run `invoice2data retest`
+
+    Returns the number of samples stored by `record`, the last report of
+    `run`.
+    """
+    args = create_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.ERROR)
+    cache = SampleCache(args.cache)
+
+    def templates():
+        return load_templates(args.template_folder, not args.exclude_built_in_templates)
+
+    if args.command == "record":
+        from .main import Extractor
+
+        extractor = Extractor(templates(), args.input_reader, keep_text=True)
+        files = select_files(args.input_files, args.extensions, args.tid, args.tid_pattern)
+        stored = record(cache, extractor, files, args.workers)
+        print("%d of %d samples cached in %s" % (stored, len(files), args.cache))
+        return stored
+
+    report = retest(cache, templates(), args.names, args.rerun_all, args.workers, not args.dry_run)
+    print(format_report(report))
+    if not args.watch:
+        return report
+    if not args.template_folder:
+        raise SystemExit("--watch needs --template-folder")
+    mtime = _templates_mtime(args.template_folder)
+    try:
+        while True:
+            time.sleep(args.interval)
+            current = _templates_mtime(args.template_folder)
+            if current == mtime:
+                continue
+            mtime = current
+            try:
+                report = retest(cache, templates(), args.names, False, args.workers, not args.dry_run)
+            except Exception as ex:
+                # e.g. a template saved half way
+                logger.error("Loading or running templates failed: %s", ex)
+                continue
+            print(format_report(report))
+    except KeyboardInterrupt:
+        return report
+
+
+def main(argv=None):
+    """Entry point of `invoice2data retest`"""
+    run(argv)
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Profile templates on a corpus of already extracted texts.
+
+Runs stored OCR/PDF texts (e.g. `.txt` files as read by the `txt` input
+reader) through template matching and `InvoiceTemplate.extract` and
+reports where the time goes: per template, field, parser, plugin and
+regex pattern, with match counts and the slowest inputs per pattern.
+
+Usage::
+
+    invoice2data profile-templates --template-folder my-templates corpus/
+"""
+
+import argparse
+import json
+import logging
+import time
+from collections import defaultdict, OrderedDict
+
+from .extract.loader import load_templates
+from .input import txt
+from .utils import iter_files
+
+logger = logging.getLogger(__name__)
+
+
+class PatternStats(object):
+    """Time spent and matches found by one regex pattern"""
+
+    def __init__(self):
+        self.calls = 0
+        self.matches = 0
+        self.seconds = 0.0
+        self.inputs = defaultdict(float)
+
+
+class ProfilingEngine(object):
+    """Wraps a regex engine and records time and matches per pattern"""
+
+    def __init__(self, engine, template_name, stats):
+        self.engine = engine
+        self.template_name = template_name
+        self.stats = stats
+        self.current_input = None
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def _record(self, pattern, started, matches):
+        elapsed = time.perf_counter() - started
+        stats = self.stats[(self.template_name, pattern)]
+        stats.calls += 1
+        stats.matches += matches
+        stats.seconds += elapsed
+        stats.inputs[self.current_input] += elapsed
+
+    def search(self, pattern, string, flags=0):
+        started = time.perf_counter()
+        match = self.engine.search(pattern, string, flags)
+        self._record(pattern, started, 1 if match else 0)
+        return match
+
+    def findall(self, pattern, string, flags=0):
+        started = time.perf_counter()
+        result = self.engine.findall(pattern, string, flags)
+        self._record(pattern, started, len(result))
+        return result
+
+    def finditer(self, pattern, string, flags=0):
+        started = time.perf_counter()
+        result = list(self.engine.finditer(pattern, string, flags))
+        self._record(pattern, started, len(result))
+        return iter(result)
+
+    def split(self, pattern, string, flags=0):
+        started = time.perf_counter()
+        result = self.engine.split(pattern, string, flags)
+        self._record(pattern, started, len(result) - 1)
+        return result
+
+
+class TemplateProfiler(object):
+    """
+    Collects timings of templates run on a corpus of texts.
+
+    Parameters
+    ----------
+    templates : list of `InvoiceTemplate`
+        Templates to profile. Their regex engine is wrapped while extracting, then restored.
+    tid : str, optional
+        Use the template with this tid instead of keyword matching.
+    """
+
+    def __init__(self, templates, tid=None):
+        self.templates = templates
+        self.tid = tid
+        self.patterns = defaultdict(PatternStats)
+        self.template_times = defaultdict(lambda: [0, 0.0])
+        self.field_times = defaultdict(lambda: [0, 0.0])
+        self.parser_times = defaultdict(lambda: [0, 0.0])
+        self.plugin_times = defaultdict(lambda: [0, 0.0])
+        self.matching_seconds = 0.0
+        self.unmatched = []
+
+    def _find_template(self, extracted_str):
+        started = time.perf_counter()
+        try:
+            for t in self.templates:
+                if self.tid is not None:
+                    if t.matches_tid(self.tid):
+                        return t, t.prepare_input(extracted_str)
+                    continue
+                optimized_str = t.prepare_input(extracted_str)
+                if t.matches_input(optimized_str):
+                    return t, optimized_str
+            return None, None
+        finally:
+            self.matching_seconds += time.perf_counter() - started
+
+    def profile_file(self, path):
+        """Run one stored text through matching and extraction"""
+        extracted_str = txt.to_text(path).decode("utf-8")
+        t, optimized_str = self._find_template(extracted_str)
+        if t is None:
+            logger.warning("No template for %s", path)
+            self.unmatched.append(path)
+            return None
+
+        name = t["template_name"]
+        timings = []
+        started = time.perf_counter()
+        with t.wrapped_engine(lambda engine: ProfilingEngine(engine, name, self.patterns)) as engine:
+            engine.current_input = path
+            result = t.extract(optimized_str, timings)
+        entry = self.template_times[name]
+        entry[0] += 1
+        entry[1] += time.perf_counter() - started
+
+        for kind, field, parser, seconds in timings:
+            if kind == "field":
+                self._add(self.field_times, (name, field, parser), seconds)
+                self._add(self.parser_times, parser, seconds)
+            else:
+                self._add(self.plugin_times, (name, field), seconds)
+        return result
+
+    @staticmethod
+    def _add(times, key, seconds):
+        times[key][0] += 1
+        times[key][1] += seconds
+
+    def report(self, top=3):
+        """Return collected timings as dict, slowest entries first"""
+
+        def by_time(times):
+            return sorted(times.items(), key=lambda item: -item[1][1])
+
+        report = OrderedDict()
+        report["matching_seconds"] = self.matching_seconds
+        report["unmatched"] = self.unmatched
+        report["templates"] = [
+            OrderedDict([("template", k), ("files", n), ("seconds", s)])
+            for k, (n, s) in by_time(self.template_times)
+        ]
+        report["fields"] = [
+            OrderedDict([("template", k[0]), ("field", k[1]), ("parser", k[2]), ("calls", n), ("seconds", s)])
+            for k, (n, s) in by_time(self.field_times)
+        ]
+        report["parsers"] = [
+            OrderedDict([("parser", k), ("calls", n), ("seconds", s)]) for k, (n, s) in by_time(self.parser_times)
+        ]
+        report["plugins"] = [
+            OrderedDict([("template", k[0]), ("plugin", k[1]), ("calls", n), ("seconds", s)])
+            for k, (n, s) in by_time(self.plugin_times)
+        ]
+        report["patterns"] = []
+        for (name, pattern), stats in sorted(self.patterns.items(), key=lambda item: -item[1].seconds):
+            slowest = sorted(stats.inputs.items(), key=lambda item: -item[1])[:top]
+            report["patterns"].append(
+                OrderedDict(
+                    [
+                        ("template", name),
+                        ("pattern", pattern),
+                        ("calls", stats.calls),
+                        ("matches", stats.matches),
+                        ("seconds", stats.seconds),
+                        ("slowest_inputs", [OrderedDict([("input", i), ("seconds", s)]) for i, s in slowest]),
+                    ]
+                )
+            )
+        return report
+
+
+def format_report(report, limit=20):
+    """Render report as plain text tables"""
+    lines = ["Template matching: %.3fs, unmatched inputs: %d" % (report["matching_seconds"], len(report["unmatched"]))]
+
+    def section(title, rows, columns):
+        lines.append("")
+        lines.append(title)
+        for row in rows[:limit]:
+            lines.append("  %9.2fms  " % (row["seconds"] * 1000) + "  ".join(str(row[c]) for c in columns))
+
+    section("Templates (total time, files, template)", report["templates"], ["files", "template"])
+    section("Fields (total time, calls, parser, template, field)", report["fields"],
+            ["calls", "parser", "template", "field"])
+    section("Parsers (total time, calls, parser)", report["parsers"], ["calls", "parser"])
+    section("Plugins (total time, calls, template, plugin)", report["plugins"], ["calls", "template", "plugin"])
+    section("Patterns (total time, calls, matches, template, pattern)", report["patterns"],
+            ["calls", "matches", "template", "pattern"])
+    for row in report["patterns"][:limit]:
+        if row["slowest_inputs"]:
+            lines.append("")
+            lines.append("Slowest inputs for %s: %r" % (row["template"], row["pattern"]))
+            for item in row["slowest_inputs"]:
+                lines.append("  %9.2fms  %s" % (item["seconds"] * 1000, item["input"]))
+    return "\n".join(lines)
+
+
+def iter_corpus(paths, extension=".txt"):
+    """Yield text files given directly or found in given directories"""
+    return iter_files(paths, (extension,))
+
+
+def create_parser():
+    """Returns argument parser"""
+    parser = argparse.ArgumentParser(
+        prog="invoice2data profile-templates",
+        description="Profile templates on stored texts and report time per template, field, parser and regex.",
+    )
+    parser.add_argument(
+        "--template-folder",
+        "-t",
+        dest="template_folder",
+        help="Folder containing invoice templates in yml file. Always adds built-in templates.",
+    )
+    parser.add_argument(
+        "--exclude-built-in-templates",
+        dest="exclude_built_in_templates",
+        default=False,
+        help="Ignore built-in templates.",
+        action="store_true",
+    )
+    parser.add_argument("--tid", dest="tid", help="Use template with this tid instead of keyword matching.")
+    parser.add_argument(
+        "--extension", default=".txt", help="Extension of text files when walking folders. Default: .txt"
+    )
+    parser.add_argument("--limit", type=int, default=20, help="Rows shown per section. Default: 20")
+    parser.add_argument("--top", type=int, default=3, help="Slowest inputs listed per pattern. Default: 3")
+    parser.add_argument("--json", dest="json_file", help="Also write the full report to this JSON file.")
+    parser.add_argument("corpus", nargs="+", help="Text files or folders of text files.")
+    return parser
+
+
+def run(argv=None):
+    """Run `invoice2data profile-templates`, return its report"""
+    args = create_parser().parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    templates = load_templates(args.template_folder, not args.exclude_built_in_templates)
+    profiler = TemplateProfiler(templates, tid=args.tid)
+    for path in iter_corpus(args.corpus, args.extension):
+        profiler.profile_file(path)
+
+    report = profiler.report(top=args.top)
+    print(format_report(report, limit=args.limit))
+    if args.json_file:
+        with open(args.json_file, "w") as json_file:
+            json.dump(report, json_file, indent=4)
+    return report
+
+
+def main(argv=None):
+    """Entry point of `invoice2data profile-templates`"""
+    run(argv)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import glob
+import hashlib
+import os
+import re
+
+_GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Return sha256 hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _wanted(name, extensions):
+    if name.startswith("."):
+        return False
+    return extensions is None or name.lower().endswith(extensions)
+
+
+def walk_files(top, extensions=None):
+    """Yield files below a directory, in directory order, with os.scandir
+
+    Files are yielded as directories are read, so huge folders don't have
+    to be listed first. Hidden files are skipped.
+    """
+    stack = [top]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.name.startswith("."):
+                        stack.append(entry.path)
+                elif _wanted(entry.name, extensions):
+                    yield entry.path
+
+
+def iter_files(paths, extensions=None):
+    """Yield files given directly, found in directories or matching globs.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        files, directories (searched recursively) and glob patterns
+    extensions : tuple of str, optional
+        lowercase extensions of files to take from directories and globs,
+        e.g. (".pdf", ".png"). Files given directly are always yielded.
+    """
+    if extensions is not None:
+        extensions = tuple(e.lower() for e in extensions)
+    for path in paths:
+        if os.path.isdir(path):
+            for name in walk_files(path, extensions):
+                yield name
+        elif not os.path.exists(path) and _GLOB_MAGIC.search(path):
+            for match in glob.iglob(path, recursive=True):
+                if os.path.isdir(match):
+                    for name in walk_files(match, extensions):
+                        yield name
+                elif _wanted(os.path.basename(match), extensions):
+                    yield match
+        else:
+            yield path
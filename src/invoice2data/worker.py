@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Workers extracting invoices from a shared job queue.
+
+`invoice2data enqueue` adds files to a queue (see `invoice2data.jobqueue`),
+`invoice2data worker` processes them, as many workers on as many hosts as
+there are, given they see the queue and the files at the same paths.
+Templates are loaded once per worker and each set of job options gets its
+own `Extractor`, so jobs run on warm templates. With `--processes`, one
+parent prepares templates and extractors, then forks the workers, which
+share that state (see `invoice2data.prefork`).
+
+Usage::
+
+    invoice2data enqueue --queue /shared/jobs.sqlite --tid-pattern "^_(\\d+)_" /shared/bills/
+    invoice2data worker --queue /shared/jobs.sqlite --template-folder /shared/templates --processes 32
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+from .evaluate import select_files
+from .extract.loader import load_templates
+from .jobqueue import JobQueue, worker_name
+from .memory import process_memory
+from .output.to_json import myconverter
+from .prefork import fork_workers, preload
+
+logger = logging.getLogger(__name__)
+
+# Job options and their defaults
+JOB_OPTIONS = {"input_reader": "png", "two_pass": False}
+
+
+def _default(o):
+    value = myconverter(o)
+    return str(o) if value is None else value
+
+
+def result_record(result):
+    """JSON-ready record of an `ExtractionResult` stored with its job"""
+    return json.loads(
+        json.dumps(
+            {
+                "template": result.template_name,
+                "identified_by": result.identified_by,
+                "output": result.output,
+                "missed": result.missed,
+                "corrected": result.corrected,
+                "issue_lines": result.issue_lines,
+                "qtyerr": result.qtyerr,
+                "noofitem": result.noofitem,
+                "timings": result.timings,
+            },
+            default=_default,
+        )
+    )
+
+
+class _LeaseKeeper(object):
+    """Renews the lease of the running job, on its own connection"""
+
+    def __init__(self, queue, worker):
+        self.queue = JobQueue(queue.path, queue.lease, queue.max_attempts)
+        self.worker = worker
+        self.job_id = None
+        self.lost = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="invoice2data-lease")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self, job_id):
+        with self._lock:
+            self.job_id = job_id
+            self.lost = False
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease / 3.0):
+            with self._lock:
+                if self.job_id is not None and not self.queue.renew(self.job_id, self.worker):
+                    logger.warning("Lost the lease of job %d", self.job_id)
+                    self.lost = True
+                    self.job_id = None
+
+    def close(self):
+        self._stop.set()
+        self.thread.join()
+        self.queue.close()
+
+
+class Worker(object):
+    """
+    Claims jobs from a queue and extracts them.
+
+    Parameters
+    ----------
+    queue : JobQueue
+    templates : list of InvoiceTemplate
+    name : str, optional
+        worker name stored with claimed jobs, default: host and pid
+    """
+
+    def __init__(self, queue, templates, name=None):
+        self.queue = queue
+        self.templates = templates
+        self.name = name or worker_name()
+        self.extractors = {}
+
+    def extractor(self, options):
+        """Extractor for job options, created once per distinct options"""
+        from .main import Extractor
+
+        settings = dict(JOB_OPTIONS)
+        for key, value in options.items():
+            if key in settings:
+                settings[key] = value
+            else:
+                logger.warning("Ignoring unknown job option %s", key)
+        key = tuple(sorted(settings.items()))
+        if key not in self.extractors:
+            self.extractors[key] = Extractor(self.templates, settings["input_reader"],
+                                             two_pass=settings["two_pass"])
+        return self.extractors[key]
+
+    def process(self, job):
+        """Extract a claimed job and store its outcome"""
+        try:
+            result = self.extractor(job.options).extract(job.path, job.tid)
+        except Exception as ex:
+            # e.g. an unknown input reader
+            logger.error("Job %d failed: %s", job.id, ex)
+            return self.queue.fail(job.id, self.name, str(ex), retry=False)
+        if result.error is not None:
+            # Possibly passing, e.g. a file not yet synced or a killed tesseract
+            return self.queue.fail(job.id, self.name, result.error)
+        if result.template is None:
+            return self.queue.fail(job.id, self.name, "no template", retry=False)
+        if not result.output:
+            return self.queue.fail(job.id, self.name, "required fields missing", retry=False)
+        return self.queue.complete(job.id, self.name, result_record(result))
+
+    def run(self, max_jobs=None, poll=2.0, exit_when_empty=False):
+        """Process jobs until interrupted, return the number processed
+
+        Parameters
+        ----------
+        max_jobs : int, optional
+            stop after that many jobs
+        poll : float
+            seconds to wait when the queue is empty
+        exit_when_empty : bool
+            stop instead of waiting for new jobs
+        """
+        processed = 0
+        keeper = _LeaseKeeper(self.queue, self.name)
+        try:
+            while max_jobs is None or processed < max_jobs:
+                job = self.queue.claim(self.name)
+                if job is None:
+                    if exit_when_empty:
+                        break
+                    time.sleep(poll)
+                    continue
+                logger.info("Processing %r", job)
+                keeper.watch(job.id)
+                stored = self.process(job)
+                keeper.watch(None)
+                if not stored:
+                    logger.warning("Result of job %d dropped, its lease expired", job.id)
+                processed += 1
+        finally:
+            keeper.close()
+        return processed
+
+
+def _add_queue_arguments(parser):
+    parser.add_argument("--queue", required=True, help="SQLite job queue file, created if missing.")
+    parser.add_argument("--lease", type=float, default=600, help="Seconds a claimed job is leased. Default: 600")
+    parser.add_argument(
+        "--max-attempts", dest="max_attempts", type=int, default=3, help="Claims of a job before it fails. Default: 3"
+    )
+    parser.add_argument("--debug", action="store_true", help="Enable debug information.")
+
+
+def create_enqueue_parser():
+    """Returns argument parser of `invoice2data enqueue`"""
+    parser = argparse.ArgumentParser(prog="invoice2data enqueue", description="Add invoices to a job queue.")
+    _add_queue_arguments(parser)
+    parser.add_argument("--input-reader", dest="input_reader", default="png", help="Default: png")
+    parser.add_argument("--two-pass", dest="two_pass", action="store_true", help="See invoice2data --two-pass.")
+    parser.add_argument("--tid", dest="tid", help="Template tid of all files.")
+    parser.add_argument(
+        "--tid-pattern",
+        dest="tid_pattern",
+        help="Regex on the file name, group 1 is the tid of the file. Files not matching are skipped.",
+    )
+    parser.add_argument(
+        "--extension",
+        dest="extensions",
+        action="append",
+        help="Extension of files when walking folders, can be repeated. Default: all files",
+    )
+    parser.add_argument("input_files", nargs="+", help="Files, folders or glob patterns of invoices.")
+    return parser
+
+
+def create_parser():
+    """Returns argument parser of `invoice2data worker`"""
+    parser = argparse.ArgumentParser(prog="invoice2data worker", description="Extract invoices from a job queue.")
+    _add_queue_arguments(parser)
+    parser.add_argument(
+        "--template-folder",
+        "-t",
+        dest="template_folder",
+        help="Folder containing invoice templates in yml file. Always adds built-in templates.",
+    )
+    parser.add_argument(
+        "--exclude-built-in-templates",
+        dest="exclude_built_in_templates",
+        default=False,
+        help="Ignore built-in templates.",
+        action="store_true",
+    )
+    parser.add_argument("--name", help="Worker name stored with its jobs. Default: host:pid")
+    parser.add_argument("--max-jobs", dest="max_jobs", type=int, help="Stop after this many jobs.")
+    parser.add_argument("--poll", type=float, default=2.0, help="Seconds between checks of an empty queue.")
+    parser.add_argument(
+        "--exit-when-empty", dest="exit_when_empty", action="store_true", help="Stop when the queue is empty."
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Worker processes forked from one parent holding the templates. Default: 1",
+    )
+    parser.add_argument(
+        "--no-preload",
+        dest="preload",
+        action="store_false",
+        help="With --processes, fork before preparing templates, e.g. to compare memory use.",
+    )
+    return parser
+
+
+def enqueue(argv=None):
+    """Run `invoice2data enqueue`, return the ids of the jobs added"""
+    args = create_enqueue_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    queue = JobQueue(args.queue, args.lease, args.max_attempts)
+    options = {"input_reader": args.input_reader, "two_pass": args.two_pass}
+    files = select_files(args.input_files, args.extensions, args.tid, args.tid_pattern)
+    ids = queue.enqueue_many([(path, tid, options) for path, tid in files])
+    logger.info("Added %d jobs to %s: %s", len(ids), args.queue, queue.counts())
+    queue.close()
+    return ids
+
+
+def enqueue_main(argv=None):
+    """Entry point of `invoice2data enqueue`"""
+    enqueue(argv)
+
+
+def run_forked(args, templates):
+    """Fork `args.processes` workers, return their reports
+
+    Returns a list of dicts with the worker name, jobs processed and its
+    memory (`process_memory`) after forking and at the end.
+    """
+    worker = Worker(None, templates)
+    if args.preload:
+        # Extractors for the options of queued jobs and the default ones
+        queue = JobQueue(args.queue, args.lease, args.max_attempts)
+        for options in [{}] + queue.pending_options():
+            worker.extractor(options)
+        # No connection may cross the fork
+        queue.close()
+        preload(templates)
+
+    def work(index):
+        worker.name = "%s-%d" % (args.name or worker_name(), index)
+        worker.queue = JobQueue(args.queue, args.lease, args.max_attempts)
+        started = process_memory()
+        try:
+            processed = worker.run(args.max_jobs, args.poll, args.exit_when_empty)
+        except KeyboardInterrupt:
+            processed = None
+        worker.queue.close()
+        return {"worker": worker.name, "processed": processed, "started": started, "finished": process_memory()}
+
+    return fork_workers(args.processes, work)
+
+
+def _megabytes(value):
+    return "%.1f MB" % (value / 1048576.0) if value is not None else "-"
+
+
+def run(argv=None):
+    """Run `invoice2data worker`
+
+    Returns the number of jobs processed, with `--processes` the reports of
+    `run_forked`.
+    """
+    args = create_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    templates = load_templates(args.template_folder, not args.exclude_built_in_templates)
+    if args.processes > 1:
+        reports = run_forked(args, templates)
+        for report in reports:
+            if report is None:
+                continue
+            sizes = [_megabytes(report[when][key])
+                     for when in ("finished", "started") for key in ("rss", "pss", "private")]
+            logger.info("Worker %s processed %s jobs, RSS %s, PSS %s, private %s (after fork: %s, %s, %s)",
+                        report["worker"], report["processed"], *sizes)
+        return reports
+
+    queue = JobQueue(args.queue, args.lease, args.max_attempts)
+    worker = Worker(queue, templates, args.name)
+    try:
+        processed = worker.run(args.max_jobs, args.poll, args.exit_when_empty)
+    except KeyboardInterrupt:
+        # The running job is claimed again when its lease expires
+        processed = None
+    logger.info("Worker %s processed %s jobs, queue: %s", worker.name, processed, queue.counts())
+    queue.close()
+    return processed
+
+
+def main(argv=None):
+    """Entry point of `invoice2data worker`, exits with 1 if a forked worker failed"""
+    processed = run(argv)
+    if isinstance(processed, list) and None in processed:
+        return 1
@@ -1,6 +1,8 @@
 import os
 import pkg_resources
 import logging
+import shutil
+import tempfile
 
 # Reduce log level of various modules
 logging.getLogger('chardet').setLevel(logging.WARNING)
@@ -14,3 +16,23 @@ def get_sample_files(extension):
             if file.endswith(extension):
                 compare_files.append(os.path.join(path, file))
     return compare_files
+
+
+# Text of an OYO bill, as read by the txt input reader
+OYO_TEXT = 'OYO Oravel Stays\nDate: 31/12/2017\nIBZY2087 Cash at Hotel\nGrand Total Rs 1939\n'
+
+
+def make_work_dir(test, files=None):
+    """Temporary folder removed when `test` ends, also if it fails
+
+    `files` maps relative paths to the text written there.
+    """
+    work_dir = tempfile.mkdtemp(prefix='invoice2data-test-')
+    test.addCleanup(shutil.rmtree, work_dir, True)
+    for name, text in (files or {}).items():
+        path = os.path.join(work_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+    return work_dir
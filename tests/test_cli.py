@@ -2,6 +2,8 @@ import datetime
 import os
 import json
 import shutil
+import threading
+import types
 import csv
 from xml.dom import minidom
 
@@ -13,9 +15,16 @@ import unittest
 
 import pkg_resources
 from invoice2data.main import create_parser, main
+from invoice2data import template_profiler
+from invoice2data import evaluate
+from invoice2data import retest
+from invoice2data import worker
+from invoice2data.jobqueue import JobQueue
+from invoice2data.prefork import fork_workers
 from invoice2data.extract.loader import read_templates
+from invoice2data.input import txt
 
-from .common import get_sample_files
+from .common import OYO_TEXT, get_sample_files, make_work_dir
 
 
 class TestCLI(unittest.TestCase):
@@ -228,6 +237,165 @@ class TestCLI(unittest.TestCase):
 
         shutil.rmtree(os.path.dirname(copy_dir), ignore_errors=True)
 
+    def test_profile_templates(self):
+        corpus_dir = make_work_dir(self, {'oyo.txt': OYO_TEXT})
+        report = template_profiler.run([corpus_dir, '--json', os.path.join(corpus_dir, 'report.json')])
+        # Returned as exit status by the console script
+        self.assertIsNone(template_profiler.main([corpus_dir]))
+        self.assertEqual(report['templates'][0]['template'], 'com.oyo.invoice.yml')
+        self.assertEqual(report['templates'][0]['files'], 1)
+        self.assertTrue(any(row['field'] == 'amount' for row in report['fields']))
+        self.assertTrue(all(row['calls'] == 1 for row in report['patterns']))
+
+    def test_evaluate(self):
+        corpus_dir = make_work_dir(self, {
+            'oyo.txt': OYO_TEXT,
+            'oyo.json': json.dumps([{'amount': 1939.0, 'date': '2017-12-31', 'invoice_number': 'IBZY2088'}]),
+            'unknown.txt': 'Nothing to see here\n',
+        })
+        report = evaluate.run(['--input-reader', 'txt', '--workers', '2', corpus_dir])
+        self.assertIsNone(evaluate.main(['--input-reader', 'txt', corpus_dir]))
+        tids = report['txt']['tids']
+        self.assertEqual(tids['-']['no_template'], 1)
+        stats = tids['com.oyo.invoice.yml']
+        self.assertEqual((stats['files'], stats['extracted'], stats['with_truth'], stats['exact']), (1, 1, 1, 0))
+        self.assertEqual(stats['field_accuracy'], {'amount': 1.0, 'date': 1.0, 'invoice_number': 0.0})
+        self.assertEqual(set(stats['latency']), {'identify', 'ocr', 'extract', 'total'})
+
+    def test_retest(self):
+        work_dir = make_work_dir(self, {'oyo.txt': OYO_TEXT})
+        template_dir = os.path.join(work_dir, 'templates')
+        os.makedirs(template_dir)
+        template = os.path.join(template_dir, 'com.oyo.invoice.yml')
+        shutil.copyfile(pkg_resources.resource_filename(
+            'invoice2data.extract', 'templates/com/com.oyo.invoice.yml'), template)
+        options = ['--cache', os.path.join(work_dir, 'cache'), '--template-folder', template_dir,
+                   '--exclude-built-in-templates']
+        self.assertEqual(retest.run(options + ['record', '--input-reader', 'txt', os.path.join(work_dir, 'oyo.txt')]),
+                         1)
+        # Nothing changed
+        self.assertEqual(retest.run(options + ['run']), {})
+        with open(template) as f:
+            content = f.read()
+        with open(template, 'w') as f:
+            f.write(content.replace('currency: INR', 'currency: EUR'))
+        report = retest.run(options + ['run'])
+        self.assertEqual([entry['changes'] for entry in report.values()], [[('currency', 'INR', 'EUR')]])
+        self.assertEqual(retest.run(options + ['run']), {})
+        self.assertIsNone(retest.main(options + ['run']))
+
+    def test_worker(self):
+        work_dir = make_work_dir(self, {'oyo.txt': OYO_TEXT, 'unknown.txt': 'Nothing to see here\n'})
+        queue_file = os.path.join(work_dir, 'jobs.sqlite')
+        ids = worker.enqueue(['--queue', queue_file, '--input-reader', 'txt', '--extension', '.txt', work_dir])
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(worker.run(['--queue', queue_file, '--exit-when-empty', '--name', 'test']), 2)
+        # Returned as exit status by the console script
+        self.assertIsNone(worker.main(['--queue', queue_file, '--exit-when-empty']))
+        queue = JobQueue(queue_file)
+        jobs = {os.path.basename(job['path']): job for job in queue.jobs()}
+        queue.close()
+        self.assertEqual(jobs['oyo.txt']['status'], 'done')
+        self.assertEqual(jobs['oyo.txt']['result']['output']['invoice_number'], 'IBZY2087')
+        self.assertEqual(jobs['oyo.txt']['result']['template'], 'com.oyo.invoice.yml')
+        self.assertEqual((jobs['unknown.txt']['status'], jobs['unknown.txt']['error']), ('failed', 'no template'))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+    def test_forked_workers(self):
+        work_dir = make_work_dir(self, {'oyo-%d.txt' % i: OYO_TEXT for i in range(6)})
+        queue_file = os.path.join(work_dir, 'jobs.sqlite')
+        worker.enqueue(['--queue', queue_file, '--input-reader', 'txt', '--extension', '.txt', work_dir])
+        reports = worker.run(['--queue', queue_file, '--exit-when-empty', '--processes', '2'])
+        queue = JobQueue(queue_file)
+        counts = queue.counts()
+        queue.close()
+        self.assertEqual(counts, {'done': 6})
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(sum(report['processed'] for report in reports), 6)
+        self.assertTrue(all(report['finished']['rss'] > 0 for report in reports))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+    def test_fork_workers(self):
+        def work(index):
+            if index == 1:
+                raise ValueError("worker %d failed" % index)
+            return {'index': index}
+
+        self.assertEqual(fork_workers(3, work), [{'index': 0}, None, {'index': 2}])
+
+    def test_resume(self):
+        work_dir = make_work_dir(self, {'oyo.txt': OYO_TEXT, 'unknown.txt': 'Nothing to see here\n'})
+        invoice, unknown = os.path.join(work_dir, 'oyo.txt'), os.path.join(work_dir, 'unknown.txt')
+        output_name = os.path.join(work_dir, 'out.json')
+        args = self.parser.parse_args(
+            ['--input-reader', 'txt', '--output-format', 'json', '--output-name', output_name, '--resume',
+             invoice, unknown]
+        )
+        for run in range(2):
+            with self.assertRaises(SystemExit) as cm:
+                main(args)
+            # unknown.txt fails
+            self.assertEqual(cm.exception.code, 1)
+            with open(output_name) as json_file:
+                self.assertEqual(json.load(json_file)[0]['invoice_number'], 'IBZY2087')
+        # Every file skipped
+        args.input_files = [invoice]
+        with self.assertRaises(SystemExit) as cm:
+            main(args)
+        self.assertEqual(cm.exception.code, 0)
+        with open(output_name + '.manifest.jsonl') as manifest_file:
+            records = [json.loads(line) for line in manifest_file]
+        # Completed file is recorded once, the failed one is retried on resume
+        self.assertEqual([r['status'] for r in records], ['done', 'failed', 'failed'])
+
+    def test_interrupted_run(self):
+        work_dir = make_work_dir(self, {'oyo.txt': OYO_TEXT, 'other.txt': OYO_TEXT})
+        copy_dir = os.path.join(work_dir, 'copies')
+        os.makedirs(copy_dir)
+        invoice, other = os.path.join(work_dir, 'oyo.txt'), os.path.join(work_dir, 'other.txt')
+
+        def to_text(path):
+            if path != invoice:
+                raise KeyboardInterrupt
+            return txt.to_text(path)
+
+        reader = types.ModuleType('interrupted_reader')
+        reader.to_text = to_text
+        output_name = os.path.join(work_dir, 'out.json')
+        args = self.parser.parse_args(['--output-format', 'json', '--output-name', output_name, '--manifest',
+                                       os.path.join(work_dir, 'manifest.jsonl'), '--copy', copy_dir,
+                                       '--filename-format', '{invoice_number}.txt', invoice, other])
+        args.input_reader = reader
+        with self.assertRaises(KeyboardInterrupt):
+            main(args)
+        # Background I/O is flushed and stopped: queued copy and manifest record of the first file are done
+        self.assertFalse(any(thread.name == 'invoice2data-io' for thread in threading.enumerate()))
+        self.assertEqual(os.listdir(copy_dir), ['IBZY2087.txt'])
+        with open(args.manifest) as manifest_file:
+            self.assertEqual([json.loads(line)['status'] for line in manifest_file], ['done'])
+        # No output file for an incomplete run
+        self.assertFalse(os.path.exists(output_name))
+
+    def test_directory_input(self):
+        names = ['bills/2017/oyo-1.txt', 'bills/oyo-2.TXT', 'bills/other-3.txt', 'bills/.hidden.txt', 'bills/scan.png']
+        work_dir = make_work_dir(self, {name: OYO_TEXT for name in names})
+        output_name = os.path.join(work_dir, 'out.json')
+        args = self.parser.parse_args(
+            ['--input-reader', 'txt', '--output-format', 'json', '--output-name', output_name,
+             '--extension', '.txt', '--tid-pattern', r'^oyo-', os.path.join(work_dir, 'bills')]
+        )
+        with self.assertRaises(SystemExit):
+            main(args)
+        with open(output_name) as json_file:
+            self.assertEqual(len(json.load(json_file)), 2)
+        pattern = os.path.join(work_dir, '**', '*.txt')
+        args = self.parser.parse_args(['--input-reader', 'txt', '--output-format', 'json', '--output-name',
+                                       output_name, pattern])
+        with self.assertRaises(SystemExit):
+            main(args)
+        with open(output_name) as json_file:
+            self.assertEqual(len(json.load(json_file)), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
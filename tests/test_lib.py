@@ -1,15 +1,39 @@
 import os
+import datetime
+import pstats
+import sqlite3
+import subprocess
+import sys
+import threading
+import tracemalloc
+import types
 
 try:
     from StringIO import StringIO  # noqa: F401
 except ImportError:
     from io import StringIO  # noqa: F401
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
-from invoice2data.main import extract_data
-from invoice2data.input import pdftotext, tesseract, pdfminer_wrapper
-from invoice2data.output import to_csv, to_json, to_xml
-from .common import get_sample_files
+from invoice2data.main import (
+    Extractor, extract_data, format_filename, identify_template, race_ocr, merge_replaced_stats, post_process,
+    reocr_lines,
+)
+from invoice2data.background_io import BackgroundIO
+from invoice2data.evaluate import percentile
+from invoice2data.profiling import Profiler, read_collapsed
+from invoice2data.memory import MemoryTracker
+from invoice2data.template_profiler import TemplateProfiler
+from invoice2data.jobqueue import JobQueue
+from invoice2data.extract.invoice_template import InvoiceTemplate
+from invoice2data.extract.keyword_index import KeywordIndex
+from invoice2data.extract.loader import read_templates
+from invoice2data.extract.regex_engine import get_engine
+from invoice2data.input import pdftotext, tesseract, pdfminer_wrapper, txt, png
+from invoice2data.output import to_csv, to_json, to_xml, to_sqlite
+from invoice2data.dedup import DuplicateIndex
+from invoice2data.layout import parse_tsv
+from .common import OYO_TEXT, get_sample_files, make_work_dir
 
 
 def _extract_data_for_export():
@@ -63,6 +87,400 @@ class TestCLI(unittest.TestCase):
         self.assertTrue(os.path.exists(file_path), "File not made")
         os.remove(file_path)
 
+    def test_output_sqlite(self):
+        file_path = os.path.join(make_work_dir(self), "invoices.sqlite")
+        data = [
+            {'issuer': 'OYO', 'amount': 1939.0, 'date': datetime.datetime(2017, 12, 31), 'invoice_number': 'IBZY2087',
+             'currency': 'INR', 'desc': 'Invoice from OYO', 'lines': [{'qty': 1.0}, {'qty': 2.0}]},
+        ]
+        input_files = get_sample_files('oyo.pdf')
+        to_sqlite.write_to_file(data, file_path, file_names=input_files)
+        data[0]['lines'] = [{'qty': 3.0}]
+        to_sqlite.write_to_file(data, file_path, file_names=input_files)
+        conn = sqlite3.connect(file_path)
+        self.assertEqual(conn.execute("SELECT date, amount FROM invoices").fetchall(), [('2017-12-31', 1939.0)])
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM line_items").fetchone()[0], 1)
+        conn.close()
+
+        # Same file twice in one batch, the last result wins
+        data.append(dict(data[0], lines=[{'qty': 4.0}, {'qty': 5.0}]))
+        to_sqlite.write_to_file(data, file_path, file_names=input_files * 2)
+        conn = sqlite3.connect(file_path)
+        self.assertEqual(conn.execute("SELECT fields FROM line_items ORDER BY position").fetchall(),
+                         [('{"qty": 4.0}',), ('{"qty": 5.0}',)])
+        conn.close()
+
+        # Kept queued while the database is locked, given up and reported on close
+        lock = sqlite3.connect(file_path, isolation_level=None)
+        lock.execute("BEGIN EXCLUSIVE")
+        writer = to_sqlite.SQLiteWriter(file_path, batch_size=1, timeout=0.1)
+        self.assertRaises(sqlite3.OperationalError, writer.add, {'issuer': 'A'}, key='a')
+        self.assertRaises(sqlite3.OperationalError, writer.add, {'issuer': 'B'}, key='b')
+        lock.execute("COMMIT")
+        writer.flush()
+        self.assertEqual(writer.pending, [])
+        lock.execute("BEGIN EXCLUSIVE")
+        self.assertRaises(sqlite3.OperationalError, writer.add, {'issuer': 'C'}, key='c')
+        self.assertEqual(writer.close(), ['c'])
+        lock.execute("COMMIT")
+        self.assertEqual(lock.execute("SELECT file_hash FROM invoices WHERE file_hash IN ('a', 'b', 'c') "
+                                      "ORDER BY file_hash").fetchall(), [('a',), ('b',)])
+        lock.close()
+
+    def test_duplicate_index(self):
+        from PIL import Image
+
+        png_file = get_sample_files('oyo.png')[0]
+        copy_file = "duplicate-for-test.png"
+        with Image.open(png_file) as img:
+            img.convert("RGB").save(copy_file)
+
+        index = DuplicateIndex(max_size=1)
+        index.add(index.fingerprint(png_file), {'amount': 1.0})
+        self.assertEqual(index.find(index.fingerprint(png_file)), {'amount': 1.0})
+        self.assertIsNone(index.find(index.fingerprint(copy_file)))
+
+        index = DuplicateIndex(max_size=1, perceptual=True, max_distance=4)
+        index.add(index.fingerprint(png_file, tid='1'), {'amount': 1.0})
+        self.assertEqual(index.find(index.fingerprint(copy_file, tid='1')), {'amount': 1.0})
+        self.assertIsNone(index.find(index.fingerprint(copy_file, tid='2')))
+
+        # Window of one entry: adding another file evicts the first
+        index.add(index.fingerprint(__file__), {'amount': 2.0})
+        self.assertIsNone(index.find(index.fingerprint(png_file, tid='1')))
+        os.remove(copy_file)
+
+    def test_background_io(self):
+        done = []
+
+        def job(value):
+            if value == 2:
+                raise IOError("disk full")
+            done.append(value)
+
+        io = BackgroundIO(max_pending=1)
+        for value in range(5):
+            io.submit("file%d" % value, job, value)
+        errors = io.close()
+        self.assertEqual(done, [0, 1, 3, 4])
+        self.assertEqual([name for name, ex in errors], ["file2"])
+        self.assertRaises(RuntimeError, io.submit, "late", job, 5)
+
+    def test_percentile(self):
+        values = list(range(1, 11))
+        self.assertEqual([percentile(values, p) for p in (10, 50, 90, 99, 100)], [1, 5, 9, 10, 10])
+        self.assertEqual([percentile([7, 8], p) for p in (0, 50, 51)], [7, 7, 8])
+        self.assertIsNone(percentile([], 50))
+
+    def test_format_filename(self):
+        res = {'date': datetime.datetime(2020, 1, 2), 'invoice_number': 'INV1', 'desc': None}
+        self.assertEqual(format_filename("{date:%Y-%m-%d} {invoice_number} {desc}.pdf", res), "2020-01-02 INV1.pdf")
+        self.assertEqual(format_filename("{date:%Y-%m-%d} {invoice_number} {desc}.pdf", {'desc': 'Hotel'}), "Hotel.pdf")
+
+    def test_identify_template_by_region(self):
+        class FakeOCR(object):
+            calls = []
+
+            @classmethod
+            def region_to_text(cls, path, region):
+                cls.calls.append(region)
+                return b"ACME Stores Ltd" if region == (0.0, 0.0, 1.0, 0.2) else b""
+
+        templates = [
+            InvoiceTemplate(template_name="Other.yml", issuer="Other", keywords=["Other"], fields={}),
+            InvoiceTemplate(template_name="Foo.yml", issuer="Foo", keywords=["Foo"], fields={},
+                            options={"header_region": [0, 0, 1, 0.2]}),
+            InvoiceTemplate(template_name="ACME.yml", issuer="ACME", keywords=["ACME"], fields={},
+                            options={"header_region": 0.2}),
+        ]
+        self.assertIs(identify_template("bill.png", templates, FakeOCR), templates[2])
+        # Same region is OCRed only once
+        self.assertEqual(FakeOCR.calls, [(0.0, 0.0, 1.0, 0.2)])
+
+    def test_ocr_pipeline(self):
+        def pipeline():
+            convert = subprocess.Popen([sys.executable, '-c', 'print("x" * 1000000)'], stdout=subprocess.PIPE)
+            # Reads only the start, like an OCR failing early
+            tess = subprocess.Popen([sys.executable, '-c', 'import sys; print(len(sys.stdin.read(10)))'],
+                                    stdin=convert.stdout, stdout=subprocess.PIPE)
+            return [convert, tess]
+
+        for cancel in (None, threading.Event()):
+            procs = pipeline()
+            out, err = png._communicate(procs, cancel)
+            self.assertEqual(out.strip(), b'10')
+            self.assertTrue(procs[0].stdout.closed)
+            # Upstream process waited for, not left as a zombie
+            self.assertIsNotNone(procs[0].returncode)
+
+    def test_race_ocr(self):
+        class FakeOCR(object):
+            cancelled = []
+
+            @classmethod
+            def to_text(cls, path, cmdlist=None, conv_cmdlist=None, cancel=None):
+                psm = cmdlist[6]
+                if psm == "11":
+                    # Slow config, stopped once another one reconciles
+                    cls.cancelled.append(cancel.wait(10))
+                    return b""
+                items = "2" if psm == "6" else "1"
+                return ("Test\nItems\napple 2.00 1.50 3.00\nEnd\nCount " + items).encode("utf-8")
+
+        t = InvoiceTemplate(
+            template_name="Test.yml", issuer="Test", keywords=["Test"], required_fields=["noofitem"],
+            fields={"noofitem": r"Count (\d+)"},
+            lines={"start": "Items", "end": "End",
+                   "line": r"(?P<description>\w+) (?P<qty>\S+) (?P<rate>\S+) (?P<total>\S+)"},
+            options={"psm": 6, "ocr_alternatives": [{"psm": 11}, {"psm": 4}],
+                     "decimal": [{"qty": 2, "rate": 2, "total": 2, "totalqty": 2}], "correction_priority": "qty"},
+        )
+        output, missed, corrected, issue_lines, qtyerr, noofitem = race_ocr("bill.png", t, FakeOCR, max_workers=3)
+        self.assertEqual((output["noofitem"], missed, issue_lines), ("1", 0, []))
+        self.assertEqual(FakeOCR.cancelled, [True])
+
+    def test_reocr_lines(self):
+        rows = ["Test", "Items", "apple 2.00 1.50 3.00", "pear 1.00 2.00 9.00", "End", "Count 2"]
+        tsv = ["level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext",
+               "1\t1\t0\t0\t0\t0\t0\t0\t1000\t600\t-1\t"]
+        for line_num, row in enumerate(rows):
+            for word_num, word in enumerate(row.split()):
+                tsv.append("5\t1\t1\t1\t%d\t%d\t%d\t%d\t80\t30\t95.0\t%s"
+                           % (line_num, word_num, 100 * word_num, 100 * line_num, word))
+        layout = parse_tsv("\n".join(tsv))
+        self.assertEqual(layout.text(), "\n".join(rows) + "\n")
+        self.assertEqual(layout.lines[3].box, (0, 300, 380, 330))
+
+        class FakeOCR(object):
+            regions = []
+
+            @classmethod
+            def region_to_text(cls, path, region, cmdlist=None, scale=None):
+                cls.regions.append(region)
+                return b"1.00 2.00 2.00\n"
+
+        t = InvoiceTemplate(
+            template_name="Test.yml", issuer="Test", keywords=["Test"], required_fields=["noofitem"],
+            fields={"noofitem": r"Count (\d+)"},
+            lines={"start": "Items", "end": "End",
+                   "line": r"(?P<description>[a-z]+) (?P<qty>\S+) (?P<rate>\S+) (?P<total>\S+)"},
+            options={"reocr_lines": True, "correction_priority": "qty",
+                     "decimal": [{"qty": 2, "rate": 2, "total": 2, "totalqty": 2}]},
+        )
+        output = t.extract(t.prepare_input(layout.text()))
+        output["totalqty"] = "300"
+        mismatched = []
+        stats = post_process(output, t.options, mismatched)
+        self.assertEqual(mismatched, [1])
+        # pear's qty was corrected to 4.50, total qty 6.50 doesn't match
+        self.assertEqual(stats, (0, 1, [], "NoMatch", 2.0))
+        replaced = reocr_lines("bill.png", t, output, layout, FakeOCR, mismatched)
+        self.assertEqual(replaced, [1])
+        self.assertEqual(merge_replaced_stats(stats, replaced, output, t.options), (0, 0, [], "Match", 2.0))
+        # Only the numbers right of the description (x >= 100, less padding) are OCRed again
+        self.assertEqual(len(FakeOCR.regions), 1)
+        self.assertEqual(round(FakeOCR.regions[0][0], 3), 0.093)
+        self.assertEqual(output["lines"][1], {"description": "pear", "qty": "1.00", "rate": "2.00", "total": "2.00"})
+
+    def test_layout_single_ocr(self):
+        # Tesseract's plain text keeps the spacing, the text of a layout doesn't
+        texts = {"test.png": "Test\nCount   2", "other.png": "Other\nTotal   42"}
+
+        class FakeOCR(object):
+            __name__ = "FakeOCR"
+            calls = []
+
+            @classmethod
+            def to_text(cls, path, cmdlist=None, conv_cmdlist=None):
+                cls.calls.append("text")
+                return texts[path].encode("utf-8")
+
+            @classmethod
+            def to_text_and_layout(cls, path, cmdlist=None, conv_cmdlist=None):
+                cls.calls.append("text and layout")
+                tsv = ["level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\t"
+                       "text", "1\t1\t0\t0\t0\t0\t0\t0\t1000\t600\t-1\t"]
+                for line_num, row in enumerate(texts[path].split("\n")):
+                    for word_num, word in enumerate(row.split()):
+                        tsv.append("5\t1\t1\t1\t%d\t%d\t%d\t%d\t80\t30\t95.0\t%s"
+                                   % (line_num, word_num, 100 * word_num, 100 * line_num, word))
+                return texts[path].encode("utf-8"), parse_tsv("\n".join(tsv))
+
+            @classmethod
+            def to_layout(cls, path, cmdlist=None, conv_cmdlist=None):
+                cls.calls.append("layout")
+                return cls.to_text_and_layout(path)[1]
+
+        templates = [
+            InvoiceTemplate(template_name="Test.yml", issuer="Test", keywords=["Test"], required_fields=["noofitem"],
+                            fields={"noofitem": r"Count   (\d+)"}, options={"reocr_lines": True}),
+            InvoiceTemplate(template_name="Other.yml", issuer="Other", keywords=["Other"], required_fields=["total"],
+                            fields={"total": r"Total   (\d+)"}),
+        ]
+        extractor = Extractor(templates, FakeOCR, keep_text=True)
+        # Identified by keywords, boxes come from the same OCR run
+        result = extractor.extract("test.png")
+        self.assertEqual((result.identified_by, result.output["noofitem"]), ("keywords", "2"))
+        self.assertEqual(FakeOCR.calls, ["text and layout"])
+        # Templates without boxes still get tesseract's plain text
+        result = extractor.extract("other.png")
+        self.assertEqual((result.output["total"], result.text), ("42", texts["other.png"]))
+        self.assertEqual(FakeOCR.calls, ["text and layout"] * 2)
+
+    def test_png_text_and_layout(self):
+        bin_dir = make_work_dir(self)
+        # Writes <output base>.txt and .tsv for the configs given, like tesseract
+        fake = (
+            "#!%s\nimport sys\nbase = sys.argv[-3]\nassert sys.argv[-2:] == ['txt', 'tsv']\n"
+            "open(base + '.txt', 'w').write('Total   42\\n')\n"
+            "open(base + '.tsv', 'w').write('level\\tpage_num\\tblock_num\\tpar_num\\tline_num\\tword_num\\t"
+            "left\\ttop\\twidth\\theight\\tconf\\ttext\\n5\\t1\\t1\\t1\\t1\\t1\\t10\\t20\\t30\\t40\\t96\\tTotal\\n')\n"
+            % sys.executable
+        )
+        for name in ('tesseract', 'convert'):
+            with open(os.path.join(bin_dir, name), 'w') as f:
+                f.write(fake)
+            os.chmod(os.path.join(bin_dir, name), 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        try:
+            text, layout = png.to_text_and_layout('bill.png')
+        finally:
+            os.environ['PATH'] = path
+        self.assertEqual(text, b'Total   42\n')
+        self.assertEqual([line.text for line in layout.lines], ['Total'])
+
+    def test_keyword_index(self):
+        templates = read_templates()
+        text = OYO_TEXT
+        t, optimized_str = KeywordIndex(templates).find(text)
+        self.assertEqual(t['template_name'], 'com.oyo.invoice.yml')
+        self.assertEqual(optimized_str, t.prepare_input(text))
+        self.assertEqual(KeywordIndex(templates).find('nothing'), (None, None))
+
+    def test_extract_data_timings(self):
+        file_path = os.path.join(make_work_dir(self, {"invoice.txt": OYO_TEXT}), "invoice.txt")
+        timings = {}
+        res = extract_data(file_path, input_module="txt", two_pass=True, timings=timings)
+        self.assertEqual(res['invoice_number'], 'IBZY2087')
+        self.assertEqual(sorted(timings), ['extract', 'identify', 'ocr'])
+
+    def test_extractor_threads(self):
+        text = OYO_TEXT.encode('utf-8')
+        extractor = Extractor(read_templates(), "txt")
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(extractor.extract, [text] * 8 + [b'nothing']))
+        self.assertTrue(all(r.ok and r.output['amount'] == 1939.0 for r in results[:8]))
+        self.assertEqual(results[0].template_name, 'com.oyo.invoice.yml')
+        self.assertEqual(results[0].identified_by, 'keywords')
+        self.assertIsNone(results[8].template)
+        metrics = extractor.metrics.snapshot()
+        self.assertEqual((metrics['files'], metrics['extracted'], metrics['no_template']), (9, 8, 1))
+
+    def test_profiler(self):
+        folder = make_work_dir(self, {'oyo.txt': OYO_TEXT})
+        text_file = os.path.join(folder, 'oyo.txt')
+
+        def slow_to_text(path):
+            # Input reader waiting for a child process, like tesseract
+            subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(0.2)']).communicate()
+            return txt.to_text(path)
+
+        slow_reader = types.ModuleType('slow_reader')
+        slow_reader.to_text = slow_to_text
+        with Profiler(folder, interval=0.001) as profiler:
+            extractor = Extractor(read_templates(), slow_reader, profiler=profiler)
+            self.assertTrue(extractor.extract(text_file).ok)
+        stacks = read_collapsed(os.path.join(folder, '0001-oyo.txt.collapsed'))
+        self.assertEqual(stacks, read_collapsed(os.path.join(folder, 'profile.collapsed')))
+        waits = sum(n for stack, n in stacks.items() if stack.endswith(';[subprocess wait]'))
+        self.assertGreater(waits, 10)
+        # Waits are counted for the OCR stage
+        self.assertTrue(all(stack.startswith('[ocr];') for stack in stacks if stack.endswith('[subprocess wait]')))
+
+        with Profiler(folder, mode='cprofile') as profiler:
+            extract_data(text_file, input_module='txt', profiler=profiler)
+        stats = pstats.Stats(os.path.join(folder, 'profile.pstats'))
+        self.assertTrue(any(name == 'extract' for _, _, name in stats.stats))
+
+    def test_template_profiler_keeps_engine(self):
+        text_file = os.path.join(make_work_dir(self, {'oyo.txt': OYO_TEXT}), 'oyo.txt')
+        templates = read_templates()
+        # Not the configured engine, which the template falls back to without override
+        override = get_engine('re', timeout=5.0)
+        for t in templates:
+            t.engine = override
+        profiler = TemplateProfiler(templates)
+        self.assertEqual(profiler.profile_file(text_file)['amount'], 1939.0)
+        self.assertTrue(profiler.patterns)
+        self.assertTrue(all(t.engine is override for t in templates))
+
+    @unittest.skipUnless(hasattr(tracemalloc, 'reset_peak'), 'needs Python 3.9')
+    def test_memory_tracker(self):
+        text_file = os.path.join(make_work_dir(self, {'oyo.txt': OYO_TEXT}), 'oyo.txt')
+        # Without a threshold, no allocations snapshot per invoice
+        tracker = MemoryTracker()
+        take_snapshot, tracemalloc.take_snapshot = tracemalloc.take_snapshot, None
+        try:
+            result = Extractor(read_templates(), 'txt', memory=tracker).extract(text_file)
+        finally:
+            tracemalloc.take_snapshot = take_snapshot
+        tracker.close()
+        self.assertNotIn('top', result.memory['invoice'])
+
+        tracker = MemoryTracker(threshold=1 << 20, top=3)
+        result = Extractor(read_templates(), 'txt', memory=tracker).extract(text_file)
+        self.assertEqual(set(result.memory), {'identify', 'ocr', 'extract', 'invoice'})
+        self.assertTrue(all(m['rss'] > 0 for m in result.memory.values()))
+
+        record = {}
+        with tracker.invoice(record, 'big'):
+            with tracker.stage(record, 'extract'):
+                kept = [bytearray(1024) for i in range(4096)]
+            with tracker.stage(record, 'post_process'):
+                temporary = bytearray(2 << 20)
+                del temporary
+        summary = tracker.close()
+        self.assertGreater(record['extract']['net'], 4 << 20)
+        self.assertEqual(len(record['extract']['top']), 3)
+        self.assertIn('test_lib.py', record['extract']['top'][0][0])
+        # Freed before the end of the stage, but counted in its peak
+        self.assertGreater(record['post_process']['peak'], 1 << 20)
+        self.assertLess(record['post_process']['net'], 1 << 20)
+        self.assertGreaterEqual(record['invoice']['peak'], record['extract']['peak'])
+        self.assertEqual(summary['extract']['count'], 2)
+        del kept
+
+    def test_job_queue(self):
+        queue_file = os.path.join(make_work_dir(self), 'jobs.sqlite')
+        queue = JobQueue(queue_file, lease=60, max_attempts=2)
+        first, second = queue.enqueue_many([('a.png', '1', {'input_reader': 'png'}), ('b.png', None, None)])
+        job = queue.claim('w1')
+        self.assertEqual((job.id, job.path, job.tid, job.options, job.attempts),
+                         (first, 'a.png', '1', {'input_reader': 'png'}, 1))
+        self.assertEqual(queue.claim('w2').id, second)
+        self.assertIsNone(queue.claim('w3'))
+
+        # Lease of w1 expires, w3 takes the job over
+        queue.conn.execute("UPDATE jobs SET lease_until = 0 WHERE id = ?", (first,))
+        job = queue.claim('w3')
+        self.assertEqual((job.id, job.attempts), (first, 2))
+        self.assertFalse(queue.complete(first, 'w1', {'output': None}))
+        self.assertTrue(queue.renew(first, 'w3'))
+        self.assertTrue(queue.fail(first, 'w3', 'tesseract killed'))
+
+        # Retried until out of attempts
+        self.assertTrue(queue.fail(second, 'w2', 'tesseract killed'))
+        job = queue.claim('w2')
+        self.assertEqual((job.id, job.attempts), (second, 2))
+        self.assertTrue(queue.complete(second, 'w2', {'output': {'amount': 1.0}}))
+        self.assertIsNone(queue.claim('w2'))
+
+        self.assertEqual(queue.counts(), {'done': 1, 'failed': 1})
+        done = list(queue.jobs('done'))
+        self.assertEqual(done[0]['result'], {'output': {'amount': 1.0}})
+        queue.close()
+
     def test_extract_data_pdfminer(self):
         pdf_files = get_sample_files('.pdf')
         for file in pdf_files:
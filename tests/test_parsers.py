@@ -0,0 +1,324 @@
+import collections
+import unittest
+from collections import OrderedDict
+from decimal import Decimal
+
+from invoice2data.extract.invoice_template import InvoiceTemplate
+from invoice2data.extract import regex_engine
+from invoice2data.extract.plugins import tables
+from invoice2data.extract.parsers import regex as regex_parser
+from invoice2data.extract.parsers import lines as lines_parser
+from invoice2data.extract.parsers import boxes as boxes_parser
+from invoice2data.extract.parsers import fixed_width
+from invoice2data.layout import Layout, TextLine, Word, parse_hocr
+from invoice2data.extract.numbers import NumberParser
+from invoice2data.extract.columns import LineColumns
+from invoice2data.extract.ocr_profile import OCRProfile, TESSERACT_PSM3
+from invoice2data.main import test_qty_basedontotalqty as check_total_qty
+
+
+def _template(fields=None, options=None, **kwargs):
+    tpl = OrderedDict(issuer="Test", keywords=["Test"], fields=fields or OrderedDict())
+    if options:
+        tpl["options"] = options
+    tpl.update(kwargs)
+    return InvoiceTemplate(tpl)
+
+
+class TestRegexEngine(unittest.TestCase):
+    def test_default_engine(self):
+        self.assertEqual(_template().engine.name, "re")
+
+    def test_template_engine_option(self):
+        t = _template(options={"regex_engine": "regex", "regex_timeout": 1.0})
+        self.assertEqual(t.engine.name, "regex")
+        self.assertEqual(t.engine.timeout, 1.0)
+        self.assertEqual(t.engine.findall(r"(\d+)", "a 12 b 34"), ["12", "34"])
+
+    def test_wrapped_engine(self):
+        t = _template()
+        override = regex_engine.get_engine("regex")
+        t.engine = override
+        with t.wrapped_engine(_CountingEngine) as engine:
+            self.assertIs(t.engine, engine)
+            t.engine.search("a", "a")
+        self.assertEqual(engine.calls["a"], 1)
+        self.assertIs(t.engine, override)
+
+    def test_unsupported_patterns(self):
+        t = _template(
+            fields=OrderedDict(
+                amount=r"(?<=Total )(\d+)",
+                invoice_number=r"(\w)\1(\d+)",
+                date=r"Date (\d+)",
+            )
+        )
+        result = t.check_regex_engine("re2")
+        self.assertEqual(result[r"(?<=Total )(\d+)"], ["lookbehind"])
+        self.assertEqual(result[r"(\w)\1(\d+)"], ["backreference"])
+        self.assertNotIn(r"Date (\d+)", result)
+        self.assertEqual(t.check_regex_engine("re"), {})
+
+    def test_fallback_to_re(self):
+        engine = regex_engine.get_engine("re2")
+        # Unsupported pattern never reaches the (possibly missing) re2 module
+        self.assertEqual(engine.search(r"(?<=a)b", "ab").group(0), "b")
+
+
+class TestOCRProfile(unittest.TestCase):
+    def test_profiles_from_options(self):
+        t = _template(options={"psm": 4, "imgcmd": ["convert", "-density", "350"],
+                               "ocr_alternatives": [{"psm": 3, "imgcmd": None}, {"whitelist": "0123456789"}]})
+        tesseract, convert = t.ocr_profile.commands()
+        self.assertEqual(tesseract[5:7], ("--psm", "4"))
+        self.assertEqual(convert, ("convert", "-density", "350"))
+        self.assertEqual(t.ocr_profiles[1].commands(None, ["convert"]), (TESSERACT_PSM3, ["convert"]))
+        self.assertIn("tessedit_char_whitelist=0123456789", t.ocr_profiles[2].tesseract)
+        # Shared module level commands are left alone
+        self.assertEqual(OCRProfile.from_options({"psm": 6}).tesseract[6], "6")
+
+    def test_defaults(self):
+        self.assertEqual(_template().ocr_profile.commands(["tesseract"], None), (["tesseract"], None))
+
+
+class TestRegexParser(unittest.TestCase):
+    content = "Total 12.00\nSub 3.00\nTotal 5.00\nSub 3.00\n"
+
+    def test_list_order_and_dedup(self):
+        t = _template()
+        settings = {"regex": [r"Sub (\d+\.\d+)", r"Total (\d+\.\d+)"]}
+        self.assertEqual(regex_parser.parse(t, settings, self.content), ["3.00", "12.00", "5.00"])
+        self.assertEqual(
+            sorted(regex_parser.parse(t, settings, self.content, True)), ["12.00", "3.00", "5.00"]
+        )
+
+    def test_list_sum(self):
+        t = _template()
+        settings = {"regex": [r"Total (\d+\.\d+)", r"Sub (\d+\.\d+)"], "type": "float", "group": "sum"}
+        self.assertEqual(regex_parser.parse(t, settings, self.content), 23.0)
+
+    def test_list_overlapping(self):
+        t = _template()
+        settings = {"regex": [r"Subtotal (\d+\.\d+)", r"total (\d+\.\d+)"], "type": "float", "group": "sum"}
+        self.assertEqual(regex_parser.parse(t, settings, "Subtotal 10.00\ntotal 5.00"), 25.0)
+        settings = {"regex": [r"Ref (\w+)", r"(\d{4})"]}
+        self.assertEqual(regex_parser.parse(t, settings, "Ref AB1234"), ["AB1234", "1234"])
+
+
+class TestNumbers(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(NumberParser(".").parse("1,234.50"), 1234.5)
+        self.assertEqual(NumberParser(",").parse("1.234,50"), 1234.5)
+        self.assertEqual(NumberParser(".").parse("Rs 1,939.00"), 1939.0)
+        self.assertEqual(NumberParser(".").parse("1939"), 1939.0)
+        self.assertEqual(NumberParser(",").parse("EUR 3,4", decimal=True), Decimal("3.4"))
+
+    def test_parse_many(self):
+        self.assertEqual(NumberParser(".").parse_many(["1.5", " ", "2"]), [1.5, 0.0, 2.0])
+
+    def test_lines_typed_columns(self):
+        t = _template(options={"decimal_separator": ","})
+        settings = {
+            "start": "Items",
+            "end": "Total",
+            "line": r"(?P<pos>\d+)\s+(?P<qty>[\d,]+)\s+(?P<price>[\d.,]+)",
+            "types": {"pos": "int", "qty": "float", "price": "decimal"},
+        }
+        content = "Items\n1  2,5  1.000,10\n2  1  3,20\nTotal"
+        self.assertEqual(
+            lines_parser.parse(t, settings, content),
+            [
+                {"pos": 1, "qty": 2.5, "price": Decimal("1000.10")},
+                {"pos": 2, "qty": 1.0, "price": Decimal("3.20")},
+            ],
+        )
+
+
+class TestColumnarLines(unittest.TestCase):
+    settings = {
+        "start": "Items",
+        "end": "Total",
+        "line": r"(?P<desc>[a-z]+)\s+(?P<qty>\d+)(\s+(?P<price>[\d.]+))?",
+        "types": {"price": "float"},
+    }
+    content = "Items\napple  2  1.50\npear  1\nfig  3  0.25\nTotal"
+
+    def test_same_rows(self):
+        t = _template()
+        rows = lines_parser.parse(t, self.settings, self.content)
+        settings = dict(self.settings, columnar=True)
+        columns = lines_parser.parse(t, settings, self.content)
+        self.assertIsInstance(columns, LineColumns)
+        self.assertEqual(columns, rows)
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(columns[1]["price"], 0.0)
+
+    def test_missing_fields(self):
+        lines = LineColumns.from_rows([{"a": 1.0}, {"b": "x"}])
+        self.assertNotIn("b", lines[0])
+        self.assertEqual(lines.to_dicts(), [{"a": 1.0}, {"b": "x"}])
+
+    def test_template_option_and_row_views(self):
+        t = _template(options={"columnar_lines": True})
+        lines = lines_parser.parse(t, dict(self.settings, types={"qty": "float"}), self.content)
+        self.assertEqual(lines.column("qty").typecode, "d")
+        for row in lines:
+            row["qty"] = str(row["qty"] * 2)
+        self.assertEqual([row["qty"] for row in lines], ["4.0", "2.0", "6.0"])
+        self.assertEqual(check_total_qty({"lines": lines}, "12"), ("Match", "12.00"))
+
+
+def _layout(rows):
+    """Layout from rows of (left, top, text) words, 20 pixels high"""
+    lines = [TextLine([Word(text, left, top, 10 * len(text), 20) for left, top, text in row]) for row in rows]
+    return Layout(1000, 1000, lines)
+
+
+class TestBoxesParser(unittest.TestCase):
+    # Tesseract split the table in lines differently than it's laid out
+    layout = _layout([
+        [(0, 0, "Invoice")],
+        [(0, 100, "Item"), (500, 100, "Qty"), (700, 100, "Amount")],
+        [(0, 140, "Widget"), (70, 142, "2000"), (510, 141, "2")],
+        [(690, 139, "10.00")],
+        [(0, 170, "extra"), (60, 170, "long")],
+        [(0, 200, "Bolt"), (500, 198, "10"), (700, 201, "5.50")],
+        [(0, 300, "Total"), (700, 300, "15.50")],
+    ])
+    settings = {
+        "start": "Item",
+        "end": "Total",
+        "columns": {"description": "Item", "qty": "Qty", "amount": r"Amount"},
+        "required": ["qty"],
+        "types": {"qty": "int"},
+    }
+
+    def test_columns_from_titles(self):
+        self.assertEqual(boxes_parser.parse(_template(), self.settings, self.layout), [
+            {"description": "Widget 2000\nextra long", "qty": 2, "amount": "10.00"},
+            {"description": "Bolt", "qty": 10, "amount": "5.50"},
+        ])
+
+    def test_columns_from_titles_lowercase(self):
+        # Titles are found in the header prepared like the start line
+        settings = dict(self.settings, start="item", end="total",
+                        columns={"description": "item", "qty": "qty", "amount": "amount"})
+        t = _template(options={"lowercase": True})
+        self.assertEqual([line["qty"] for line in boxes_parser.parse(t, settings, self.layout)], [2, 10])
+
+    def test_columns_from_spans(self):
+        settings = dict(self.settings, columns={"description": [0, 0.4], "qty": [0.5, 0.55], "amount": [0.7, 0.8]})
+        lines = boxes_parser.parse(_template(), settings, self.layout)
+        self.assertEqual([line["qty"] for line in lines], [2, 10])
+
+    def test_extract_with_layout(self):
+        t = _template(fields=OrderedDict(lines=dict(self.settings, parser="boxes")), required_fields=["lines"])
+        self.assertTrue(t.needs_layout())
+        text = self.layout.text()
+        self.assertEqual(len(t.extract(text, layout=self.layout)["lines"]), 2)
+        # Without word boxes the field can't be parsed
+        self.assertIsNone(t.extract(text))
+
+    def test_hocr(self):
+        hocr = (
+            "<html><body><div class='ocr_page' title='image \"x.png\"; bbox 0 0 800 600; ppageno 0'>"
+            "<p class='ocr_par'><span class='ocr_line' title='bbox 10 20 200 40'>"
+            "<span class='ocrx_word' title='bbox 10 20 90 40; x_wconf 96'><strong>Total</strong></span> "
+            "<span class='ocrx_word' title='bbox 120 20 200 40; x_wconf 91'>12.50</span>"
+            "</span></p></div></body></html>"
+        )
+        layout = parse_hocr(hocr)
+        self.assertEqual((layout.width, layout.height), (800, 600))
+        self.assertEqual(layout.text(), "Total 12.50\n")
+        self.assertEqual(layout.lines[0].box, (10, 20, 200, 40))
+        self.assertEqual(layout.lines[0].words[1].conf, 91.0)
+
+
+class TestFixedWidthParser(unittest.TestCase):
+    content = (
+        "Invoice 42\n"
+        "  Pos  Description             Qty    Unit Price\n"
+        "  1    Cable 2m, 3 pack          3         12.50\n"
+        "  2    Adapter USB-C 65W        10      1,024.00\n"
+        "       (spare)\n"
+        "\n"
+        "  Total                                 3,277.50\n"
+    )
+
+    def test_columns_from_header(self):
+        self.assertEqual(fixed_width.parse(_template(), {"start": "Pos", "end": "Total"}, self.content), [
+            {"pos": "1", "description": "Cable 2m, 3 pack", "qty": "3", "unit_price": "12.50"},
+            {"pos": "2", "description": "Adapter USB-C 65W", "qty": "10", "unit_price": "1,024.00"},
+            {"description": "(spare)"},
+        ])
+
+    def test_columns_and_types(self):
+        settings = {
+            "start": "Pos",
+            "end": "Total",
+            "columns": {"description": "Description", "qty": "Qty", "price": r"Unit\s+Price", "pos": [0, 6]},
+            "required": ["qty"],
+            "types": {"qty": "int", "price": "float"},
+        }
+        self.assertEqual(fixed_width.parse(_template(), settings, self.content), [
+            {"pos": "1", "description": "Cable 2m, 3 pack", "qty": 3, "price": 12.5},
+            {"pos": "2", "description": "Adapter USB-C 65W\n(spare)", "qty": 10, "price": 1024.0},
+        ])
+
+    def test_missing_end(self):
+        self.assertIsNone(fixed_width.parse(_template(), {"start": "Pos", "end": "Nowhere"}, self.content))
+
+
+class _CountingEngine(object):
+    """Regex engine counting matching calls per pattern"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.calls = collections.Counter()
+
+    def __getattr__(self, name):
+        method = getattr(self.engine, name)
+        if name not in ("search", "match", "findall", "finditer", "split"):
+            return method
+
+        def counted(pattern, *args, **kwargs):
+            self.calls[pattern] += 1
+            return method(pattern, *args, **kwargs)
+        return counted
+
+
+class TestTablesPlugin(unittest.TestCase):
+    content = "Header\nStart\nid 1 name foo\nid 2 name bar\nref X9\nEnd\nFooter"
+
+    def _extract(self, table_settings):
+        t = _template(tables=table_settings)
+        t.engine = _CountingEngine(t.engine)
+        output = {}
+        tables.extract(t, self.content, output)
+        return output, t.engine.calls
+
+    def test_shared_anchors_located_once(self):
+        output, calls = self._extract([
+            {"start": "Start", "end": "End", "body": r"id (?P<id>\d+) name (?P<name>\w+)"},
+            {"start": "Start", "end": "End", "body": r"ref (?P<ref>\w+)"},
+        ])
+        self.assertEqual(output, {"id": "1", "name": "foo", "ref": "X9"})
+        self.assertEqual(calls["Start"], 1)
+        self.assertEqual(calls["End"], 1)
+
+    def test_stops_when_fields_resolved(self):
+        output, calls = self._extract([
+            {"start": "Start", "end": "End", "body": r"id (?P<id>\d+)"},
+        ])
+        self.assertEqual(output, {"id": "1"})
+        self.assertEqual(calls[r"id (?P<id>\d+)"], 1)
+
+    def test_missing_anchor(self):
+        output, calls = self._extract([
+            {"start": "Nowhere", "end": "End", "body": r"id (?P<id>\d+)"},
+        ])
+        self.assertEqual(output, {})
+
+
+if __name__ == '__main__':
+    unittest.main()